@@ -0,0 +1,103 @@
+"""Parity and speed of the token-trie `EntityAnnotator` against the annotations shipped with the repo.
+
+The designs and their `list_of_strings` come from data/results/json/enhanced_objects.json,
+which the `cnt` annotator produced; the entity lists from data/source/lists/csv. A design
+is at parity when the trie yields exactly its shipped `list_of_strings`. With the `cnt`
+submodule in libs/, both annotators are also run on the designs and compared span by span.
+
+The parity check is a gate: it exits non-zero when a design outside `KNOWN_DIFFERENCES`
+differs from its shipped `list_of_strings` (or, with `cnt`, from the `cnt` annotator), or when a known difference has gone away and
+should be dropped from the list. The known differences come from an older state of the
+entity lists and from repeated spans in the shipped annotations, not from the matching rules.
+
+    python benchmarks/bench_annotator.py [--show 10]
+"""
+import sys
+import time
+import logging
+import argparse
+
+import pandas as pd
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.append(str(ROOT / "libs" / "NLP_on_multilingual_coin_datasets"))
+
+from modules.annotator import EntityAnnotator, CntAnnotator, annotation_parity
+from modules.design_sources import FileSource, entity_names
+from modules.scripts import generate_list_of_strings
+
+CSV_DIR = ROOT / "data/source/lists/csv"
+JSON_DIR = ROOT / "data/results/json"
+
+# Standard names in the list version the shipped annotations were made with, alternative names now
+OLD_STANDARD_NAME = "annotated with a name that is now an alternative name"
+# Names the shipped annotations only matched capitalized, e.g. "Silenus" but not "silenus"
+OLD_CASE = "lowercase name not matched in the shipped annotations"
+# The shipped list repeats the preceding entity where the design says "branch"
+REPEATED_SPAN = "shipped annotations repeat the preceding entity instead of \"branch\""
+
+KNOWN_DIFFERENCES = {
+    **dict.fromkeys([1, 541, 1576, 2113, 2134, 3213], OLD_STANDARD_NAME),
+    **dict.fromkeys([1048, 1919, 1932, 2130, 2399], OLD_CASE),
+    **dict.fromkeys([917, 1370, 1489, 1490, 1625, 1627, 1674, 1735, 1950, 2103,
+                     2421, 2580, 2918, 3372, 4022, 4086, 4161, 4183, 4221], REPEATED_SPAN),
+}
+
+
+def load_designs():
+    designs = pd.read_json(JSON_DIR / "enhanced_objects.json")[["design_id", "design_en", "list_of_strings"]]
+    return designs.rename(columns={"design_id": "id"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--show", type=int, default=10, help="designs to print that are not at parity")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    entities = entity_names(FileSource(CSV_DIR).load_entity_table())
+    designs = load_designs()
+
+    start = time.perf_counter()
+    trie = EntityAnnotator(entities)
+    compile_s = time.perf_counter() - start
+    start = time.perf_counter()
+    annotated = trie.annotate_designs(designs)
+    annotate_s = time.perf_counter() - start
+
+    shipped = designs["list_of_strings"].map(lambda pairs: [tuple(pair) for pair in pairs])
+    actual = annotated.apply(generate_list_of_strings, axis=1)
+    equal = (shipped == actual).to_numpy()
+    known = designs["id"].isin(list(KNOWN_DIFFERENCES)).to_numpy()
+    print(f"{len(designs)} designs, {trie.n_entities} entity names")
+    print(f"{'trie: compile':40s} {compile_s:8.3f}s")
+    print(f"{'trie: annotate':40s} {annotate_s:8.3f}s")
+    print(f"{'parity with shipped list_of_strings':40s} {equal.mean():8.1%}")
+    print(f"{'parity without known differences':40s} {equal[~known].mean():8.1%}")
+    for _, row in designs[~equal & ~known].head(args.show).iterrows():
+        print(f"  {row['id']}: {row['design_en']}")
+        print(f"    shipped: {shipped[row.name]}")
+        print(f"    trie:    {actual[row.name]}")
+    resolved = designs.loc[equal & known, "id"].tolist()
+    if resolved:
+        print(f"  now at parity, drop from KNOWN_DIFFERENCES: {resolved}")
+    at_parity = bool(equal[~known].all()) and not resolved
+
+    try:
+        cnt = CntAnnotator(entities)
+    except ImportError:
+        print("cnt submodule not available; skipping the span comparison with its annotator")
+    else:
+        parity, mismatches = annotation_parity(cnt, trie, designs)
+        print(f"{'parity with the cnt annotator':40s} {parity:8.1%}")
+        for _, row in mismatches.head(args.show).iterrows():
+            print(f"  {row['id']}: cnt {row['expected']} trie {row['actual']}")
+        at_parity = at_parity and parity == 1.0
+    return 0 if at_parity else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
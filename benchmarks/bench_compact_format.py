@@ -0,0 +1,93 @@
+"""Output tokens of the compact tabular response format vs JSON, per step.
+
+Responses are rebuilt from the shipped results in data/results/json and rendered as
+pretty-printed JSON (as the prompts ask for), as one JSON object per line, and in the
+compact format of `modules.compact_format`. Comments are kept verbatim in every format,
+so the savings do not include the shorter comments the compact prompts ask for. Step
+"1_1" has no shipped results; its rows reuse the validity and comment of step "2_1".
+
+    python benchmarks/bench_compact_format.py [--designs 10] [--model gpt-4o]
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from modules import compact_format, lenient_json
+from modules.scripts import count_tokens_batch, calculate_output_price
+
+JSON_DIR = ROOT / "data/results/json"
+
+
+def load_step_records():
+    """Response records of every step, with the columns of its compact format."""
+    enhanced = json.loads((JSON_DIR / "enhanced_objects.json").read_text(encoding="utf-8"))
+    spo = json.loads((JSON_DIR / "RE_new_datachallenge.json").read_text(encoding="utf-8"))
+    for entry in spo:
+        entry["predicate"] = entry["p"]
+        entry["validity_sop"] = entry["validity_pred"]
+        entry["comment_sop"] = entry["comment_pred"]
+    sources = {"0": enhanced, "0_1": enhanced, "1": spo, "1_1": spo, "2": spo, "2_1": spo}
+    return {
+        step: [{column: entry[column] for column in compact_format.get_format(step).columns} for entry in entries]
+        for step, entries in sources.items()
+    }
+
+
+def group_by_design(records: list, designs_per_response: int):
+    by_design = {}
+    for record in records:
+        by_design.setdefault(record["design_id"], []).append(record)
+    groups = list(by_design.values())
+    return [[record for group in groups[start:start + designs_per_response] for record in group]
+            for start in range(0, len(groups), designs_per_response)]
+
+
+RENDERERS = {
+    "json": lambda records, step: json.dumps(records, ensure_ascii=False, indent=4),
+    "json_lines": lambda records, step: "\n".join(json.dumps(record, ensure_ascii=False) for record in records),
+    "compact": compact_format.dumps,
+}
+
+
+def decode_seconds(texts: list, decode):
+    start = time.perf_counter()
+    for text in texts:
+        decode(text)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--designs", type=int, default=10, help="designs per response")
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'step':5s} {'rows':>6s} {'json':>9s} {'json_lines':>11s} {'compact':>9s} {'saved':>7s} "
+          f"{'$ saved/1k rows':>16s} {'round trip':>11s} {'decode json':>12s} {'decode compact':>15s}")
+    for step, records in load_step_records().items():
+        responses = group_by_design(records, args.designs)
+        texts = {name: [render(group, step) for group in responses] for name, render in RENDERERS.items()}
+        tokens = {name: sum(count_tokens_batch(rendered, args.model)) for name, rendered in texts.items()}
+
+        decoded = [compact_format.loads(text, step) for text in texts["compact"]]
+        round_trip = sum(rows == group for rows, group in zip(decoded, responses))
+
+        saved = 1 - tokens["compact"] / tokens["json"]
+        price_saved = calculate_output_price(tokens["json"] - tokens["compact"]) / len(records) * 1000
+        json_s = decode_seconds(texts["json"], lenient_json.loads)
+        compact_s = decode_seconds(texts["compact"], lambda text: compact_format.loads(text, step))
+        print(f"{step:5s} {len(records):>6d} {tokens['json']:>9d} {tokens['json_lines']:>11d} "
+              f"{tokens['compact']:>9d} {saved:>7.1%} {price_saved:>16.4f} "
+              f"{round_trip:>5d}/{len(responses):<5d} {json_s:>11.3f}s {compact_s:>14.3f}s")
+
+
+if __name__ == "__main__":
+    main()
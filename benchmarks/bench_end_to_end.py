@@ -0,0 +1,145 @@
+"""End-to-end throughput of pipeline steps 0 to 2_1 against the local mock OpenAI server.
+
+No network access or API key is needed: `modules.mock_openai` answers every prompt from
+the stored results in data/results/json. Each step is fed with the parsed responses of
+the step before it, as in the notebooks. The chat mode runs `process_prompts_async`; the
+batch mode uploads sharded batch files, polls the jobs and parses the downloaded
+output. Latency, error rate and rate limits of the server are configurable, so runs are
+reproducible on a laptop CPU. With `--metrics-dir`, the per-step request metrics (see
+`modules.metrics`) are written there as metrics.json and metrics.prom.
+
+The completion parser counts tokens with tiktoken, whose encodings must be in the
+tiktoken cache (TIKTOKEN_CACHE_DIR) when running offline.
+
+    python benchmarks/bench_end_to_end.py [--designs 500] [--mode both] [--latency 0.05]
+"""
+import sys
+import time
+import logging
+import argparse
+
+import pandas as pd
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from openai import OpenAI
+
+from modules import prompts as prompt_templates
+from modules.scripts import (create_sharded_batch_jobs, retrieve_batch_job_status, download_batch_results,
+                             parse_and_clean_batch_responses)
+from modules.chat_executor import process_prompts_async
+from modules.metrics import PipelineMetrics
+from modules.mock_openai import MockOpenAIServer, ResponseSynthesizer
+
+JSON_DIR = ROOT / "data/results/json"
+STEPS = ("0", "0_1", "1", "1_1", "2", "2_1")
+
+
+def load_designs(n_designs: int):
+    designs = pd.read_json(JSON_DIR / "enhanced_objects.json")[["design_id", "design_en", "list_of_strings"]]
+    return designs.head(n_designs).reset_index(drop=True)
+
+
+def run_chat(prompts: list, client, step: str, args, metrics: PipelineMetrics):
+    records = process_prompts_async(prompts, client, 0, len(prompts), args.concurrency, step=step, metrics=metrics)
+    return pd.DataFrame(records)
+
+
+def run_batch(prompts: list, client, step: str, args, data: pd.DataFrame, tmp_dir: Path, metrics: PipelineMetrics):
+    design_ids = prompt_templates.batch_design_ids(data, step, args.batch_size)
+    jobs = create_sharded_batch_jobs(prompts, client, tmp_dir, step, design_ids, max_requests=args.shard_requests)
+    pending = [job.id for job in jobs]
+    while pending:
+        still_pending = []
+        for job_id in pending:
+            status_info = retrieve_batch_job_status(client, job_id)
+            if status_info["status"] == "completed":
+                metrics.record_batch_job(step, status_info)
+            else:
+                still_pending.append(job_id)
+        pending = still_pending
+        if pending:
+            time.sleep(args.poll_interval)
+    output_path = download_batch_results(client, [job.id for job in jobs], tmp_dir / f"batchoutput_{step}.jsonl")
+    return parse_and_clean_batch_responses(output_path, step=step, metrics=metrics)
+
+
+def step_input(step: str, designs: pd.DataFrame, outputs: dict):
+    """The data each step's prompts are built from, derived from the responses of the previous steps."""
+    if step == "0":
+        return designs.rename(columns={"design_id": "id"})
+    enhanced = designs.merge(outputs["0"][["design_id", "new_list_of_strings"]], on="design_id")
+    if step in ("0_1", "1"):
+        return enhanced
+    pairs = outputs["1"][outputs["1"]["s"] != "NULL"].merge(designs[["design_id", "design_en"]], on="design_id")
+    if step in ("1_1", "2"):
+        return pairs
+    return pairs.merge(outputs["2"][["design_id", "s_o_id", "predicate"]], on=["design_id", "s_o_id"])
+
+
+def run_pipeline(mode: str, client, designs: pd.DataFrame, args, tmp_dir: Path, metrics: PipelineMetrics):
+    outputs = {}
+    rows = []
+    for step in STEPS:
+        data = step_input(step, designs, outputs)
+        start = time.perf_counter()
+        prompts = prompt_templates.build_prompts(step, data, args.batch_size)
+        built = time.perf_counter()
+        if mode == "chat":
+            outputs[step] = run_chat(prompts, client, step, args, metrics)
+        else:
+            outputs[step] = run_batch(prompts, client, step, args, data, tmp_dir, metrics)
+        elapsed = time.perf_counter() - start
+        rows.append({"mode": mode, "step": step, "rows": len(data), "prompts": len(prompts),
+                     "records": len(outputs[step]), "build_s": built - start, "total_s": elapsed,
+                     "records_per_s": len(outputs[step]) / elapsed if elapsed else float("nan")})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--designs", type=int, default=500, help="designs fed into step 0")
+    parser.add_argument("--mode", choices=("chat", "batch", "both"), default="both")
+    parser.add_argument("--batch-size", type=int, default=10, help="designs or pairs per prompt")
+    parser.add_argument("--concurrency", type=int, default=16, help="chat requests in flight")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each response starts")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds of latency")
+    parser.add_argument("--chunk-chars", type=int, default=64, help="characters per streamed chunk")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of chat requests answered with a 500")
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute before 429s")
+    parser.add_argument("--shard-requests", type=int, default=50, help="tasks per batch file")
+    parser.add_argument("--batch-latency", type=float, default=0.0, help="seconds until a batch completes")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--tmp-dir", type=Path, default=ROOT / "data/results/tmp/bench_end_to_end")
+    parser.add_argument("--metrics-dir", type=Path, default=None, help="write the request metrics here")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    designs = load_designs(args.designs)
+    server = MockOpenAIServer(ResponseSynthesizer(JSON_DIR), latency=args.latency, jitter=args.jitter,
+                              chunk_chars=args.chunk_chars, error_rate=args.error_rate,
+                              requests_per_minute=args.rpm, batch_latency=args.batch_latency)
+    modes = ("chat", "batch") if args.mode == "both" else (args.mode,)
+    metrics = PipelineMetrics()
+    with server:
+        client = OpenAI(base_url=server.base_url, api_key="mock", max_retries=5)
+        results = []
+        for mode in modes:
+            start = time.perf_counter()
+            results.append(run_pipeline(mode, client, designs, args, args.tmp_dir, metrics))
+            print(f"{mode}: steps 0 to 2_1 on {len(designs)} designs in {time.perf_counter() - start:.2f}s")
+
+    pd.set_option("display.width", 200)
+    print(pd.concat(results, ignore_index=True).to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+    print(f"server: {server.stats}")
+    if args.metrics_dir is not None:
+        metrics.write_json(args.metrics_dir / "metrics.json")
+        metrics.write_prometheus(args.metrics_dir / "metrics.prom")
+        print(f"metrics written to {args.metrics_dir}")
+
+
+if __name__ == "__main__":
+    main()
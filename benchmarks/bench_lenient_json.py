@@ -0,0 +1,170 @@
+"""Throughput of `lenient_json.loads` vs the regex-chain `clean_json_response`.
+
+Completions are synthesized from the shipped results in data/results/json in the
+formats the model actually produces (plain JSON, code fences, Python tuples, unquoted
+keys, single quotes, trailing commas, comments, concatenated objects). The "bare_values"
+style leaves string values unquoted and adds values that look like comments, a URL with
+a fragment and a "Design #n" label, to check that only real comments are dropped.
+
+    python benchmarks/bench_lenient_json.py [--designs 10] [--repeat 3]
+"""
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from modules import lenient_json
+from modules.scripts import clean_json_response
+
+JSON_DIR = ROOT / "data/results/json"
+
+
+def load_records():
+    enhanced = json.loads((JSON_DIR / "enhanced_objects.json").read_text(encoding="utf-8"))
+    spo = json.loads((JSON_DIR / "RE_new_datachallenge.json").read_text(encoding="utf-8"))
+    enhanced = [{key: entry[key] for key in ("design_id", "new_list_of_strings", "completeness",
+                                             "relevance", "correctness", "comment_enh")}
+                for entry in enhanced]
+    spo = [{key: entry[key] for key in ("design_id", "s_o_id", "s", "subject_class", "p", "o",
+                                        "object_class", "validity_pred", "comment_pred", "implicit_pred")}
+           for entry in spo]
+    return enhanced, spo
+
+
+def _tuples(entry):
+    text = json.dumps(entry, ensure_ascii=False)
+    for pair in entry.get("new_list_of_strings", []):
+        text = text.replace(json.dumps(pair, ensure_ascii=False), "(" + json.dumps(pair, ensure_ascii=False)[1:-1] + ")", 1)
+    return text
+
+
+def _unquoted_keys(entry):
+    return "{" + ", ".join(f"{key}: {json.dumps(value, ensure_ascii=False)}" for key, value in entry.items()) + "}"
+
+
+def _single_quotes(entry):
+    return "{" + ", ".join(
+        f'"{key}": ' + (f"'{value}'" if isinstance(value, str) and "'" not in value else json.dumps(value, ensure_ascii=False))
+        for key, value in entry.items()) + "}"
+
+
+def _trailing_comma(entry):
+    return json.dumps(entry, ensure_ascii=False)[:-1] + ",}"
+
+
+def _comment(entry):
+    return json.dumps(entry, ensure_ascii=False, indent=2).replace("\n", "  // checked\n", 1)
+
+
+def _with_links(entry):
+    return dict(entry, source=f"https://example.org/designs/{entry['design_id']}#{entry.get('s_o_id', 'a')}",
+                label=f"Design #{entry['design_id']}")
+
+
+def _bare(value):
+    """`value` unquoted where the model might leave it so, else as JSON."""
+    if (isinstance(value, str) and value and value == value.strip() and value not in ("true", "false", "null")
+            and not re.search(r"""[,{}\[\]()"'\n]|^[-\d]|\s//|\#\s""", value)):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _bare_values(entry):
+    return "{" + ", ".join(f"{key}: {_bare(value)}" for key, value in entry.items()) + "}"
+
+
+STYLES = {
+    "plain": lambda entries: json.dumps(entries, ensure_ascii=False, indent=2),
+    "fenced": lambda entries: "```json\n" + json.dumps(entries, ensure_ascii=False, indent=2) + "\n```",
+    "tuples": lambda entries: "[" + ",\n".join(_tuples(entry) for entry in entries) + "]",
+    "unquoted_keys": lambda entries: "[" + ",\n".join(_unquoted_keys(entry) for entry in entries) + "]",
+    "single_quotes": lambda entries: "[" + ",\n".join(_single_quotes(entry) for entry in entries) + "]",
+    "trailing_commas": lambda entries: "[" + ",\n".join(_trailing_comma(entry) for entry in entries) + ",]",
+    "comments": lambda entries: "[" + ",\n".join(_comment(entry) for entry in entries) + "]",
+    "concatenated": lambda entries: "\n".join(json.dumps(entry, ensure_ascii=False) for entry in entries),
+    "bare_values": lambda entries: "[\n" + ",  // checked\n".join(_bare_values(entry) for entry in entries) + "  # done\n]",
+}
+
+# Fields added to the records of a style before rendering
+ENRICH = {"bare_values": _with_links}
+
+
+def synthesize(records: list, designs_per_completion: int):
+    """Group records by design and render each group in every style."""
+    by_design = {}
+    for entry in records:
+        by_design.setdefault(entry["design_id"], []).append(entry)
+    groups = list(by_design.values())
+    completions = []
+    for start in range(0, len(groups), designs_per_completion):
+        entries = [entry for group in groups[start:start + designs_per_completion] for entry in group]
+        for style, render in STYLES.items():
+            styled = [ENRICH[style](entry) for entry in entries] if style in ENRICH else entries
+            completions.append((style, styled, render(styled)))
+    return completions
+
+
+def decode_regex(text: str):
+    return json.loads(clean_json_response(text))
+
+
+def run(completions: list, decode, repeat: int):
+    """Best-of-`repeat` decode time and correctly decoded completions, per style."""
+    ok = {style: 0 for style in STYLES}
+    best = {style: None for style in STYLES}
+    for _ in range(repeat):
+        elapsed = {style: 0.0 for style in STYLES}
+        for style, expected, text in completions:
+            start = time.perf_counter()
+            try:
+                decoded = decode(text)
+            except ValueError:
+                decoded = None
+            elapsed[style] += time.perf_counter() - start
+            ok[style] += decoded == expected
+        for style, seconds in elapsed.items():
+            best[style] = seconds if best[style] is None else min(best[style], seconds)
+    return best, {style: count // repeat for style, count in ok.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--designs", type=int, default=10, help="designs per synthesized completion")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    enhanced, spo = load_records()
+    completions = synthesize(enhanced, args.designs) + synthesize(spo, args.designs)
+    random.Random(args.seed).shuffle(completions)
+    n_bytes = sum(len(text.encode("utf-8")) for _, _, text in completions)
+    per_style = len(completions) // len(STYLES)
+    print(f"{len(completions)} completions, {n_bytes / 1e6:.1f} MB, {per_style} per style")
+
+    results = {}
+    for name, decode in (("clean_json_response", decode_regex), ("lenient_json.loads", lenient_json.loads)):
+        seconds, ok = run(completions, decode, args.repeat)
+        results[name] = (seconds, ok)
+        elapsed = sum(seconds.values())
+        print(f"{name:22s} {elapsed:7.3f} s  {n_bytes / 1e6 / elapsed:6.2f} MB/s  "
+              f"{len(completions) / elapsed:8.0f} completions/s  "
+              f"correct: {sum(ok.values())}/{len(completions)}")
+
+    print("\nper style: seconds (correctly decoded)")
+    print(f"{'style':18s}" + "".join(f"{name:>24s}" for name in results))
+    for style in STYLES:
+        print(f"{style:18s}" + "".join(f"{seconds[style]:>15.3f} ({ok[style]:>4d}){'':1s}"
+                                       for seconds, ok in results.values()))
+
+
+if __name__ == "__main__":
+    main()
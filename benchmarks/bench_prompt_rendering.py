@@ -0,0 +1,85 @@
+"""Prompt building with column-wise row templates vs the row-by-row `iterrows` loop.
+
+Every step's prompts are built from the full shipped design set in data/results/json
+(enhanced designs for steps "0" to "1", SPO triples for the later steps), once with
+`modules.prompts` and once with the previous implementation, which rendered each
+`batch.iterrows()` row and grew the prompt with `+=`. Both outputs are compared
+byte for byte. The last column is the time until the first prompt of a lazy build.
+
+    python benchmarks/bench_prompt_rendering.py [--batch-size 32] [--scale 1] [--repeat 3]
+"""
+import sys
+import time
+import logging
+import argparse
+
+import pandas as pd
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from modules import prompts
+
+JSON_DIR = ROOT / "data/results/json"
+
+
+def load_step_data(scale: int):
+    enhanced = pd.read_json(JSON_DIR / "enhanced_objects.json")
+    spo = pd.read_json(JSON_DIR / "RE_new_datachallenge.json").rename(columns={"p": "predicate"})
+    enhanced = pd.concat([enhanced] * scale, ignore_index=True)
+    spo = pd.concat([spo] * scale, ignore_index=True)
+    designs = enhanced.rename(columns={"design_id": "id"})
+    return {"0": designs, "0_1": enhanced, "1": enhanced, "1_1": spo, "2": spo, "2_1": spo}
+
+
+def build_iterrows(step: str, data: pd.DataFrame, batch_size: int):
+    """The previous builders: one `iterrows` row at a time, appended with `+=`."""
+    segments = prompts.PROMPT_SEGMENTS[step]
+    template = prompts.ROW_RENDERERS[step].text
+    built = []
+    for batch in prompts.iter_batches(data, batch_size):
+        prompt = segments.preamble + segments.intro
+        for _, entry in batch.iterrows():
+            prompt += template.format(**entry)
+        prompt += segments.tail + prompts.response_instructions(step)
+        built.append(prompt)
+    return built
+
+
+def best_of(repeat: int, build):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = build()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--scale", type=int, default=1, help="repeat the design set this many times")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'step':5s} {'rows':>7s} {'prompts':>8s} {'iterrows':>10s} {'column-wise':>12s} {'speedup':>8s} "
+          f"{'identical':>10s} {'first lazy prompt':>18s}")
+    total_old = total_new = 0.0
+    for step, data in load_step_data(args.scale).items():
+        builder = prompts.STEP_BUILDERS[step]
+        old_s, old = best_of(args.repeat, lambda: build_iterrows(step, data, args.batch_size))
+        new_s, new = best_of(args.repeat, lambda: builder(data, args.batch_size))
+        first_s, _ = best_of(args.repeat, lambda: next(builder(data, args.batch_size, lazy=True)))
+        total_old += old_s
+        total_new += new_s
+        print(f"{step:5s} {len(data):>7d} {len(new):>8d} {old_s:>9.3f}s {new_s:>11.3f}s {old_s / new_s:>7.1f}x "
+              f"{str(old == new):>10s} {first_s * 1000:>15.2f} ms")
+    print(f"{'total':5s} {'':>7s} {'':>8s} {total_old:>9.3f}s {total_new:>11.3f}s {total_old / total_new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
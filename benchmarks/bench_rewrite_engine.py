@@ -0,0 +1,110 @@
+"""Design preprocessing with the compiled `RewriteEngine` vs the previous loader path.
+
+Alias rules come from the entity lists in data/source/lists/csv; the designs are the
+English design texts shipped in data/results/json. The previous path is reproduced
+here since the `cnt` submodule is not part of this repository: the Roman-numeral
+`iterrows` loop of `clean_design_names`, every alias rule applied one after the other
+as a whole-word `re.sub` (standing in for `Preprocess.preprocess_design`) in a
+row-wise `apply`, and a second `apply` deleting "?", "(" and ")".
+
+    python benchmarks/bench_rewrite_engine.py [--scale 1] [--jobs 4]
+"""
+import re
+import sys
+import time
+import logging
+import argparse
+
+import pandas as pd
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from modules.rewrite_engine import RewriteEngine, alias_rules
+
+CSV_DIR = ROOT / "data/source/lists/csv"
+JSON_DIR = ROOT / "data/results/json"
+EXTRA_RULES = {"horseman": "horse man", "horsemen": "horse men"}
+
+
+def load_entities():
+    frames = [pd.read_csv(CSV_DIR / f"nlp_list_{name}.csv") for name in ("obj", "animal", "plant")]
+    person = pd.read_csv(CSV_DIR / "nlp_list_person.csv").rename(
+        columns={"name": "name_en", "alternativenames": "alternativenames_en"})
+    df = pd.concat(frames + [person], ignore_index=True)[["id", "name_en", "alternativenames_en"]]
+    return df.astype(object).where(df.notna(), None)
+
+
+def load_designs(scale: int):
+    designs = pd.read_json(JSON_DIR / "enhanced_objects.json")[["design_id", "design_en"]]
+    designs = pd.concat([designs] * scale, ignore_index=True)
+    return designs.rename(columns={"design_id": "id"})
+
+
+def legacy_rules(df_entities: pd.DataFrame):
+    rules = dict(EXTRA_RULES)
+    for _, row in df_entities.iterrows():
+        if row["alternativenames_en"] is not None and row["alternativenames_en"] != "NULL":
+            for alt_name in row["alternativenames_en"].split(", "):
+                rules[alt_name] = row["name_en"]
+    for rule in list(rules):
+        if " I." in rule or " II." in rule or " III." in rule or " IV." in rule or " V." in rule:
+            del rules[rule]
+    return rules
+
+
+def legacy_path(designs: pd.DataFrame, rules: dict):
+    designs = designs.copy()
+    for index, row in designs.iterrows():
+        for numeral in ("I", "II", "III", "IV", "V"):
+            if f" {numeral}." in row["design_en"]:
+                designs.at[index, "design_en"] = row["design_en"].replace(f" {numeral}.", f" {numeral}")
+    compiled = [(re.compile(r"(?<!\w)" + re.escape(search) + r"(?!\w)"), replace.replace("\\", "\\\\"))
+                for search, replace in rules.items() if search]
+
+    def preprocess_design(design):
+        for pattern, replace in compiled:
+            design = pattern.sub(replace, design)
+        return design
+
+    changed = designs.apply(lambda row: preprocess_design(row.design_en), axis=1)
+    return changed.apply(lambda design: design.replace("?", "").replace("(", "").replace(")", ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=1, help="repeat the design set this many times")
+    parser.add_argument("--jobs", type=int, default=None, help="processes for the parallel run (default: all CPUs)")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    df_entities = load_entities()
+    designs = load_designs(args.scale)
+
+    start = time.perf_counter()
+    rules = legacy_rules(df_entities)
+    legacy_rules_s = time.perf_counter() - start
+    start = time.perf_counter()
+    engine = RewriteEngine(alias_rules(df_entities, extra_rules=EXTRA_RULES))
+    engine_rules_s = time.perf_counter() - start
+    print(f"{len(designs)} designs, {len(engine.rules)} alias rules (legacy: {len(rules)})")
+    print(f"{'rules: iterrows + Preprocess.add_rule':40s} {legacy_rules_s:8.3f}s")
+    print(f"{'rules: alias_rules + compile':40s} {engine_rules_s:8.3f}s")
+
+    start = time.perf_counter()
+    expected = legacy_path(designs, rules)
+    legacy_s = time.perf_counter() - start
+    print(f"{'rewrite: legacy path':40s} {legacy_s:8.3f}s")
+
+    for label, n_jobs in (("rewrite: engine, 1 process", 1), (f"rewrite: engine, {args.jobs or 'all'} processes", args.jobs)):
+        start = time.perf_counter()
+        changed = engine.rewrite_series(designs["design_en"], n_jobs)
+        elapsed = time.perf_counter() - start
+        same = (changed.values == expected.values).mean()
+        print(f"{label:40s} {elapsed:8.3f}s  {legacy_s / elapsed:6.1f}x  identical: {same:.2%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Micro-benchmarks of the pipeline's CPU hot paths at several corpus sizes.
+
+The corpus is built from the shipped results in data/results/json: the designs of
+`enhanced_objects.json` and the triples of `RE_new_datachallenge.json` and
+`RE_groundtruth.json`, repeated `scale` times under new design ids. Every case is timed
+`--repeat` times; the minimum and median are kept. Results are written as JSON to
+benchmarks/results/<label>.json; pass an earlier file to `--compare` to see the ratio
+per case and the regressions beyond `--threshold`.
+
+Token counting needs the tiktoken encodings (cached in TIKTOKEN_CACHE_DIR when
+offline); cases that cannot run are recorded as skipped.
+
+    python benchmarks/bench_suite.py [--scales 1 10 100] [--repeat 3] [--only filter]
+    python benchmarks/bench_suite.py --label after --compare benchmarks/results/before.json
+"""
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+import pandas as pd
+
+from pathlib import Path
+from functools import partial
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from modules import prompts as prompt_templates, result_store, evaluation, lenient_json
+from modules.scripts import (clean_json_response, parse_and_clean_batch_responses, filter_source_dataframe,
+                             filter_enhanced_designs, filter_sop_dataframe, update_json_with_merged_df,
+                             count_prompt_tokens, make_custom_id)
+
+JSON_DIR = ROOT / "data/results/json"
+RESULTS_DIR = ROOT / "benchmarks/results"
+DESIGN_ID_OFFSET = 10 ** 6
+BATCH_SIZE = 10
+
+
+class Corpus():
+    """The shipped data repeated `scale` times, each copy under its own design ids."""
+
+    def __init__(self, scale: int):
+        self.scale = scale
+        designs = pd.read_json(JSON_DIR / "enhanced_objects.json")
+        triples = pd.read_json(JSON_DIR / "RE_new_datachallenge.json").rename(columns={"p": "predicate"})
+        ground_truth = pd.read_json(JSON_DIR / "RE_groundtruth.json")
+        self.designs = self._repeat(designs)
+        self.triples = self._repeat(triples)
+        self.ground_truth = self._repeat(ground_truth)
+
+    def _repeat(self, df: pd.DataFrame):
+        copies = [df.assign(design_id=df["design_id"] + copy * DESIGN_ID_OFFSET) for copy in range(self.scale)]
+        return pd.concat(copies, ignore_index=True)
+
+    def step_data(self, step: str):
+        if step == "0":
+            return self.designs.rename(columns={"design_id": "id"})
+        if step in ("0_1", "1"):
+            return self.designs
+        return self.triples
+
+    def responses(self, step: str="2"):
+        """Pretty-printed JSON responses of `step`, one per prompt of `BATCH_SIZE` rows."""
+        columns = ["design_id", "s_o_id", "predicate"] if step == "2" else ["design_id", "new_list_of_strings"]
+        records = self.step_data(step)[columns].to_dict("records")
+        return [json.dumps(records[start:start + BATCH_SIZE], indent=4)
+                for start in range(0, len(records), BATCH_SIZE)]
+
+    def batch_output(self, step: str="2"):
+        lines = []
+        for index, response in enumerate(self.responses(step)):
+            lines.append(json.dumps({
+                "id": f"batch_req_{index}",
+                "custom_id": make_custom_id(index, step),
+                "response": {"status_code": 200, "body": {
+                    "choices": [{"message": {"role": "assistant", "content": response}}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0}}},
+                "error": None,
+            }))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _results_dir(tmp_dir: Path, name: str, df: pd.DataFrame):
+    """A results directory holding `df` as the stored results of `name`, written in one segment."""
+    json_dir = tmp_dir / uuid.uuid4().hex
+    update_json_with_merged_df(df, list(df.columns), json_dir, name)
+    return json_dir
+
+
+def case_build_prompts(corpus: Corpus, tmp_dir: Path, step: str):
+    data = corpus.step_data(step)
+    return len(data), lambda: prompt_templates.build_prompts(step, data, BATCH_SIZE)
+
+
+def case_clean_json_response(corpus: Corpus, tmp_dir: Path):
+    responses = corpus.responses()
+    return len(responses), lambda: [json.loads(clean_json_response(response)) for response in responses]
+
+
+def case_lenient_json(corpus: Corpus, tmp_dir: Path):
+    responses = corpus.responses()
+    return len(responses), lambda: [lenient_json.loads(response) for response in responses]
+
+
+def case_parse_batch(corpus: Corpus, tmp_dir: Path):
+    output = corpus.batch_output()
+    return output.count(b"\n"), lambda: parse_and_clean_batch_responses(output, step="2")
+
+
+def _filter_case(corpus: Corpus, tmp_dir: Path, filter_function, name: str, step: str, cold: bool):
+    source = corpus.step_data(step)
+    # Half of the source rows are already done
+    done = source.iloc[::2].rename(columns={"id": "design_id"})
+    json_dir = _results_dir(tmp_dir, name, done)
+
+    def run():
+        if cold:
+            result_store._COMPLETED_KEYS.clear()
+        return filter_function(source, json_dir, name)
+
+    if not cold:
+        run()
+    return len(source), run
+
+
+def case_filter(corpus: Corpus, tmp_dir: Path, function_name: str, cold: bool):
+    filter_function, name, step = {
+        "filter_source_dataframe": (filter_source_dataframe, "enhanced_designs.json", "0"),
+        "filter_enhanced_designs": (filter_enhanced_designs, "subject_object_pairs.json", "1"),
+        "filter_sop_dataframe": (filter_sop_dataframe, "subject_object_pairs_with_predicates.json", "2"),
+    }[function_name]
+    return _filter_case(corpus, tmp_dir, filter_function, name, step, cold)
+
+
+def case_update_json(corpus: Corpus, tmp_dir: Path):
+    merged = corpus.triples
+    return len(merged), lambda: update_json_with_merged_df(
+        merged, list(merged.columns), tmp_dir / uuid.uuid4().hex, "subject_object_pairs_with_predicates.json")
+
+
+def case_count_tokens(corpus: Corpus, tmp_dir: Path):
+    prompts = prompt_templates.build_prompts("0", corpus.step_data("0"), BATCH_SIZE)
+    count_prompt_tokens(prompts[:1], step="0")
+    return len(prompts), lambda: count_prompt_tokens(prompts, step="0")
+
+
+def case_evaluation(corpus: Corpus, tmp_dir: Path, part: str):
+    predictions = corpus.triples.rename(columns={"predicate": "p"})
+    predictions = predictions[predictions["p"] != "NULL"]
+    if part == "compare_designs":
+        return len(predictions), lambda: evaluation.compare_designs(predictions, corpus.ground_truth)
+    return len(predictions), lambda: evaluation.aggregate_triples(predictions, ["design_id", "design_en"])
+
+
+CASES = {
+    **{f"build_prompts[{step}]": partial(case_build_prompts, step=step) for step in prompt_templates.STEP_BUILDERS},
+    "clean_json_response": case_clean_json_response,
+    "lenient_json.loads": case_lenient_json,
+    "parse_and_clean_batch_responses": case_parse_batch,
+    **{f"{name}[{'cold' if cold else 'warm'}]": partial(case_filter, function_name=name, cold=cold)
+       for name in ("filter_source_dataframe", "filter_enhanced_designs", "filter_sop_dataframe")
+       for cold in (True, False)},
+    "update_json_with_merged_df": case_update_json,
+    "count_prompt_tokens": case_count_tokens,
+    "evaluation.compare_designs": partial(case_evaluation, part="compare_designs"),
+    "evaluation.aggregate_triples": partial(case_evaluation, part="aggregate_triples"),
+}
+
+
+def run_case(name: str, corpus: Corpus, tmp_dir: Path, repeat: int):
+    row = {"case": name, "scale": corpus.scale}
+    try:
+        items, function = CASES[name](corpus, tmp_dir)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+    except Exception as e:
+        return dict(row, skipped=f"{type(e).__name__}: {e}"[:200])
+    return dict(row, items=items, min_s=min(timings), median_s=statistics.median(timings),
+                items_per_s=items / min(timings) if min(timings) else None)
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "pandas": pd.__version__,
+            "platform": platform.platform(), "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(results: list, baseline_path: Path, threshold: float):
+    baseline = {(row["case"], row["scale"]): row for row in json.loads(Path(baseline_path).read_text())["results"]}
+    print(f"\nvs {baseline_path}:")
+    regressions = 0
+    for row in results:
+        before = baseline.get((row["case"], row["scale"]))
+        if before is None or "min_s" not in before or "min_s" not in row:
+            continue
+        ratio = row["min_s"] / before["min_s"] if before["min_s"] else float("inf")
+        flag = "  REGRESSION" if ratio > 1 + threshold else ""
+        regressions += bool(flag)
+        print(f"{row['case']:45s} {row['scale']:>5d}x {before['min_s']:9.4f}s -> {row['min_s']:9.4f}s {ratio:6.2f}x{flag}")
+    print(f"{regressions} regressions beyond {threshold:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10], help="corpus sizes as multiples of the shipped data")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--only", default=None, help="run only the cases whose name contains this text")
+    parser.add_argument("--label", default=None, help="name of the results file (default: the git commit)")
+    parser.add_argument("--output-dir", type=Path, default=RESULTS_DIR)
+    parser.add_argument("--compare", type=Path, default=None, help="earlier results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    names = [name for name in CASES if args.only is None or args.only in name]
+    results = []
+    tmp_dir = Path(tempfile.mkdtemp(prefix="bench_suite_"))
+    try:
+        for scale in args.scales:
+            corpus = Corpus(scale)
+            print(f"\n{scale}x: {len(corpus.designs)} designs, {len(corpus.triples)} triples")
+            for name in names:
+                row = run_case(name, corpus, tmp_dir, args.repeat)
+                results.append(row)
+                if "skipped" in row:
+                    print(f"{name:45s} skipped ({row['skipped']})")
+                else:
+                    print(f"{name:45s} {row['min_s']:9.4f}s  {row['items_per_s']:>12,.0f} items/s")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    meta = environment()
+    label = args.label or meta["commit"] or "results"
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = args.output_dir / f"{label}.json"
+    output_path.write_text(json.dumps({"environment": meta, "repeat": args.repeat, "results": results}, indent=4))
+    print(f"\nSaved {len(results)} results to {output_path}")
+    if args.compare is not None:
+        compare(results, args.compare, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
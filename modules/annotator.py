@@ -0,0 +1,165 @@
+import re
+import ast
+import logging
+import pandas as pd
+
+
+ENTITY_CLASSES = ("PERSON", "OBJECT", "ANIMAL", "PLANT")
+
+# Punctuation is a token of its own, so "laurel-branch" only matches a name spelled with the hyphen
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+_END = None
+
+
+def _entity_names(values):
+    """Entity names from a list of strings or the string cells of a DataFrame or Series."""
+    if isinstance(values, pd.DataFrame):
+        values = values.stack()
+    names = []
+    for value in values:
+        if isinstance(value, str) and value.strip() and value != "NULL":
+            names.append(value.strip())
+    return names
+
+
+def annotation_spans(annotations):
+    """Annotations as a list of (start, stop, class) tuples, whether stored as lists, tuples or their repr."""
+    if isinstance(annotations, str):
+        annotations = ast.literal_eval(annotations)
+    return [tuple(span) for span in annotations]
+
+
+def annotation_parity(reference, candidate, designs: pd.DataFrame, design_col: str="design_en"):
+    """Share of `designs` both annotators annotate identically, and the designs they disagree on.
+
+    `reference` and `candidate` are annotators with an `annotate_designs` method, e.g. a
+    `CntAnnotator` and an `EntityAnnotator`. The designs they disagree on are returned
+    with both annotations.
+    """
+    designs = designs.reset_index(drop=True)
+    expected = reference.annotate_designs(designs, design_col)["annotations"].map(annotation_spans)
+    actual = candidate.annotate_designs(designs, design_col)["annotations"].map(annotation_spans)
+    equal = (expected == actual).to_numpy()
+    parity = float(equal.mean()) if len(designs) else 1.0
+    mismatches = designs[~equal].assign(expected=expected[~equal], actual=actual[~equal])
+    logging.info(f"Annotations agree on {equal.sum()} of {len(designs)} designs ({parity:.1%}).")
+    return parity, mismatches
+
+
+class CntAnnotator():
+    """The `cnt` submodule's `annotate_designs` behind the interface of `EntityAnnotator`.
+
+    The default annotator of the preprocessing until `EntityAnnotator` is shown to match
+    it (see `annotation_parity`). `reannotate` runs it on the changed designs only.
+    """
+
+    def __init__(self, entities: dict, id_col: str="id", design_col: str="design_en"):
+        from NLP_on_multilingual_coin_datasets.cnt.annotate import annotate_designs
+        self._annotate_designs = annotate_designs
+        self.entities = entities
+        self.id_col = id_col
+        self.design_col = design_col
+
+    def annotate_designs(self, designs: pd.DataFrame, design_col: str="design_en"):
+        """Copy of `designs` with an `annotations` column, merged back on `id_col` like the previous loader."""
+        annotated = self._annotate_designs(self.entities, designs[[self.id_col, design_col]], self.id_col, design_col)
+        by_id = dict(zip(annotated[self.id_col], annotated["annotations"]))
+        designs = designs.copy()
+        designs["annotations"] = [annotation_spans(by_id.get(design_id, [])) for design_id in designs[self.id_col]]
+        return designs
+
+    def reannotate(self,
+                   old_designs: pd.Series,
+                   new_designs: pd.Series,
+                   old_annotations: pd.Series):
+        """Annotations for `new_designs`, re-annotating only the designs whose text changed."""
+        changed = (old_designs != new_designs).to_numpy()
+        changed_index = new_designs.index[changed]
+        frame = pd.DataFrame({self.id_col: range(len(changed_index)), self.design_col: new_designs[changed].tolist()})
+        annotated = self.annotate_designs(frame, self.design_col)
+        annotations = old_annotations.copy()
+        annotations.loc[changed_index] = pd.Series(annotated["annotations"].tolist(), index=changed_index, dtype=object)
+        logging.info(f"Re-annotated {int(changed.sum())} of {len(new_designs)} designs whose text changed.")
+        return annotations
+
+
+class EntityAnnotator():
+    """Token trie over the entity dictionaries, annotating designs with (start, stop, class) spans.
+
+    The dictionaries are compiled once. A design is tokenized once and, at every token,
+    the longest entity starting there is matched by walking the trie; matches do not
+    overlap. Punctuation must match as written, whitespace need not. Matching ignores
+    case unless `case_sensitive`. A name listed for several classes keeps the first
+    class in `entities` order.
+    """
+
+    def __init__(self, entities: dict, case_sensitive: bool=False):
+        self.case_sensitive = case_sensitive
+        self.trie = {}
+        self.n_entities = 0
+        for entity_class, values in entities.items():
+            for name in _entity_names(values):
+                self.add(name, entity_class)
+        logging.info(f"Compiled {self.n_entities} entity names into the annotation trie.")
+
+    def _key(self, token: str):
+        return token if self.case_sensitive else token.casefold()
+
+    def add(self, name: str, entity_class: str):
+        tokens = [self._key(token) for token in TOKEN_RE.findall(name)]
+        if not tokens:
+            return
+        node = self.trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        if _END not in node:
+            node[_END] = entity_class
+            self.n_entities += 1
+
+    def annotate(self, design: str):
+        """The entity spans of one design as [(start, stop, class), ...], in text order."""
+        if not isinstance(design, str):
+            return []
+        matches = [(match.start(), match.end(), self._key(match.group())) for match in TOKEN_RE.finditer(design)]
+        spans = []
+        idx = 0
+        while idx < len(matches):
+            node = self.trie
+            longest = None
+            for end_idx in range(idx, len(matches)):
+                node = node.get(matches[end_idx][2])
+                if node is None:
+                    break
+                if _END in node:
+                    longest = (end_idx, node[_END])
+            if longest is None:
+                idx += 1
+                continue
+            end_idx, entity_class = longest
+            spans.append((matches[idx][0], matches[end_idx][1], entity_class))
+            idx = end_idx + 1
+        return spans
+
+    def annotate_designs(self, designs: pd.DataFrame, design_col: str="design_en"):
+        """Copy of `designs` with an `annotations` column, like the submodule's `annotate_designs`."""
+        designs = designs.copy()
+        designs["annotations"] = [self.annotate(design) for design in designs[design_col].tolist()]
+        return designs
+
+    def reannotate(self,
+                   old_designs: pd.Series,
+                   new_designs: pd.Series,
+                   old_annotations: pd.Series):
+        """Annotations for `new_designs`, re-annotating only the designs whose text changed.
+
+        The three Series share one index. Unchanged designs keep their `old_annotations`, so
+        the work grows with the number of edited designs rather than with the corpus.
+        """
+        changed = (old_designs != new_designs).to_numpy()
+        annotations = old_annotations.copy()
+        changed_index = new_designs.index[changed]
+        annotations.loc[changed_index] = pd.Series(
+            [self.annotate(design) for design in new_designs[changed].tolist()], index=changed_index, dtype=object)
+        logging.info(f"Re-annotated {int(changed.sum())} of {len(new_designs)} designs whose text changed.")
+        return annotations
@@ -0,0 +1,313 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+import pandas as pd
+import concurrent.futures
+
+from pathlib import Path
+from contextlib import closing
+from datetime import datetime
+from openai import OpenAI
+
+from modules.scripts import CEST, retrieve_batch_job_status, save_batch_file
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    step TEXT NOT NULL,
+    shard TEXT,
+    input_file_id TEXT,
+    output_file_id TEXT,
+    error_file_id TEXT,
+    status TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    output_path TEXT,
+    error_path TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_step_created ON jobs (step, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS transitions (
+    job_id TEXT NOT NULL REFERENCES jobs(job_id),
+    status TEXT NOT NULL,
+    completed INTEGER,
+    failed INTEGER,
+    total INTEGER,
+    observed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_transitions_job ON transitions (job_id, observed_at);
+"""
+
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchJobRegistry():
+    """Indexed local store of submitted batch jobs and their status transitions."""
+
+    def __init__(self, db_path: Path=Path("./data/results/tmp/batch_jobs.sqlite")):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def add_job(self, job_id: str, step: str, shard: str=None, input_file_id: str=None, status: str="validating"):
+        """Register a submitted job; registering the same job twice is a no-op."""
+        now = datetime.now(CEST).isoformat()
+        with closing(self._connect()) as conn, conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, step, shard, input_file_id, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, step, shard, input_file_id, status, now, now)).rowcount
+            if inserted:
+                conn.execute("INSERT INTO transitions (job_id, status, observed_at) VALUES (?, ?, ?)",
+                             (job_id, status, now))
+        if inserted:
+            logging.info(f"Job ID {job_id} registered for step {step}.")
+        else:
+            logging.info(f"Job ID {job_id} is already registered.")
+
+    def import_json(self, file_path: Path):
+        """Import the jobs of a `batch_job_ids.json` file written by `scripts.add_job_to_file`."""
+        with Path(file_path).open('r', encoding='utf-8') as file:
+            data = json.load(file)
+        with closing(self._connect()) as conn, conn:
+            for entry in data:
+                conn.execute(
+                    "INSERT OR IGNORE INTO jobs (job_id, step, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (entry['job_id'], entry['step'], "unknown", entry['timestamp'], entry['timestamp']))
+        logging.info(f"Imported {len(data)} jobs from {file_path}.")
+
+    def update_status(self, status_info: dict):
+        """Store a status as returned by `scripts.retrieve_batch_job_status`.
+
+        Returns True if the status changed, in which case a transition is recorded.
+        """
+        job_id = status_info["batch_job_id"]
+        now = datetime.now(CEST).isoformat()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                raise ValueError(f"Job ID {job_id} is not registered.")
+            changed = row[0] != status_info["status"]
+            conn.execute(
+                "UPDATE jobs SET status = ?, output_file_id = ?, error_file_id = ?, completed = ?, failed = ?, "
+                "total = ?, updated_at = ? WHERE job_id = ?",
+                (status_info["status"], status_info.get("output_file_id"), status_info.get("error_file_id"),
+                 status_info["completed"], status_info["failed"], status_info["total"], now, job_id))
+            if changed:
+                conn.execute(
+                    "INSERT INTO transitions (job_id, status, completed, failed, total, observed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (job_id, status_info["status"], status_info["completed"], status_info["failed"],
+                     status_info["total"], now))
+        return changed
+
+    def set_downloads(self, job_id: str, output_path: Path=None, error_path: Path=None):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE jobs SET output_path = ?, error_path = ? WHERE job_id = ?",
+                         (str(output_path) if output_path else None, str(error_path) if error_path else None, job_id))
+
+    def newest_job_id(self, step: str):
+        """Id of the most recently submitted job of `step`."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT job_id, created_at FROM jobs WHERE step = ? ORDER BY created_at DESC LIMIT 1",
+                (step,)).fetchone()
+        if row is None:
+            raise ValueError(f"No job ID found for step {step}")
+        logging.info(f"The newest job ID for step {step} is: {row[0]} ({row[1]})")
+        return row[0]
+
+    def newest_job_ids(self, step: str):
+        """Ids of the jobs of the newest submission of `step`, in shard order.
+
+        A submission of `scripts.create_sharded_batch_jobs` starts with its first shard
+        ("..._000.jsonl"); a job without a shard, e.g. an imported one, is a submission of its own.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT job_id, shard FROM jobs WHERE step = ? ORDER BY created_at, rowid",
+                                (step,)).fetchall()
+        if not rows:
+            raise ValueError(f"No job ID found for step {step}")
+        starts = [idx for idx, (_, shard) in enumerate(rows) if shard is None or shard.endswith("_000.jsonl")]
+        job_ids = [job_id for job_id, _ in rows[starts[-1] if starts else 0:]]
+        logging.info(f"The newest submission of step {step} has {len(job_ids)} jobs.")
+        return job_ids
+
+    def output_paths(self, job_ids: list):
+        """Downloaded output files of `job_ids`, in that order; jobs without one are skipped with a warning."""
+        with closing(self._connect()) as conn:
+            rows = dict(conn.execute(
+                f"SELECT job_id, output_path FROM jobs WHERE job_id IN ({', '.join('?' * len(job_ids))})", job_ids))
+        paths = []
+        for job_id in job_ids:
+            if rows.get(job_id) is None:
+                logging.warning(f"Batch job {job_id} has no downloaded output file.")
+                continue
+            paths.append(Path(rows[job_id]))
+        return paths
+
+    def job_step(self, job_id: str):
+        """Step a registered job was submitted for."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT step FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Job ID {job_id} is not registered.")
+        return row[0]
+
+    def job_ids(self, step: str=None, statuses: tuple=None):
+        """Job ids, optionally filtered by step and status, oldest first."""
+        query = "SELECT job_id FROM jobs WHERE 1 = 1"
+        params = []
+        if step is not None:
+            query += " AND step = ?"
+            params.append(step)
+        if statuses is not None:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            params.extend(statuses)
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute(query + " ORDER BY created_at", params)]
+
+    def jobs(self, step: str=None):
+        """All registered jobs as a DataFrame."""
+        query = "SELECT * FROM jobs"
+        params = ()
+        if step is not None:
+            query += " WHERE step = ?"
+            params = (step,)
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(query + " ORDER BY created_at", conn, params=params)
+
+    def history(self, job_id: str):
+        """Status transitions of one job as a DataFrame."""
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query("SELECT * FROM transitions WHERE job_id = ? ORDER BY observed_at",
+                                     conn, params=(job_id,))
+
+
+class BatchJobPoller():
+    """Polls many batch jobs with per-job exponential backoff and downloads their result files.
+
+    The interval of a job is reset to `min_interval` whenever its status or counts change and
+    grows by `backoff` up to `max_interval` otherwise. Output and error files of finished jobs
+    are written to `download_dir`; a job is stored as finished only once they are saved, so a
+    failed download is retried on a later poll. With a `PipelineMetrics`, the queue and total time of every
+    finished job are recorded for its step.
+    """
+
+    def __init__(self,
+                 client: OpenAI,
+                 registry: BatchJobRegistry,
+                 download_dir: Path=Path("./data/results/tmp/batch_results"),
+                 min_interval: float=30,
+                 max_interval: float=600,
+                 backoff: float=2.0,
+                 max_workers: int=8,
+                 metrics=None):
+        self.client = client
+        self.registry = registry
+        self.download_dir = Path(download_dir)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self._schedule = {}
+        self._last_seen = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _download(self, file_id: str, path: Path):
+        return save_batch_file(self.client, file_id, path)
+
+    def _finish(self, status_info: dict):
+        job_id = status_info["batch_job_id"]
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        output_path = error_path = None
+        if status_info.get("output_file_id"):
+            output_path = self._download(status_info["output_file_id"], self.download_dir / f"{job_id}_output.jsonl")
+        if status_info.get("error_file_id"):
+            error_path = self._download(status_info["error_file_id"], self.download_dir / f"{job_id}_errors.jsonl")
+        self.registry.set_downloads(job_id, output_path, error_path)
+        if self.metrics is not None:
+            self.metrics.record_batch_job(self.registry.job_step(job_id), status_info)
+        logging.info(f"Batch job {job_id} finished with status {status_info['status']}; "
+                     f"output: {output_path}, errors: {error_path}")
+
+    def poll_once(self):
+        """Poll every active job that is due; returns the number of jobs still active."""
+        active = self.registry.job_ids(statuses=ACTIVE_STATUSES + ("unknown",))
+        now = time.time()
+        due = [job_id for job_id in active if self._schedule.get(job_id, (0, 0))[0] <= now]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(retrieve_batch_job_status, self.client, job_id): job_id for job_id in due}
+            for future in concurrent.futures.as_completed(futures):
+                job_id = futures[future]
+                _, interval = self._schedule.get(job_id, (0, self.min_interval))
+                try:
+                    status_info = future.result()
+                except Exception as e:
+                    logging.error(f"Error polling batch job {job_id}: {e}")
+                    interval = min(interval * self.backoff, self.max_interval)
+                    self._schedule[job_id] = (time.time() + interval, interval)
+                    continue
+
+                if status_info["status"] in TERMINAL_STATUSES:
+                    try:
+                        self._finish(status_info)
+                    except Exception as e:
+                        # The terminal status is not stored yet, so the job stays active and is retried
+                        logging.error(f"Error downloading the results of batch job {job_id}: {e}")
+                        interval = min(interval * self.backoff, self.max_interval)
+                        self._schedule[job_id] = (time.time() + interval, interval)
+                        continue
+                    self.registry.update_status(status_info)
+                    self._schedule.pop(job_id, None)
+                    self._last_seen.pop(job_id, None)
+                    active.remove(job_id)
+                    continue
+
+                self.registry.update_status(status_info)
+                progress = (status_info["status"], status_info["completed"], status_info["failed"])
+                if progress != self._last_seen.get(job_id):
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * self.backoff, self.max_interval)
+                self._last_seen[job_id] = progress
+                self._schedule[job_id] = (time.time() + interval, interval)
+
+        return len(active)
+
+    def run(self):
+        """Poll until all registered jobs are finished or `stop` is called."""
+        while not self._stop.is_set():
+            if self.poll_once() == 0:
+                logging.info("All batch jobs are finished.")
+                return
+            next_due = min((due for due, _ in self._schedule.values()), default=time.time())
+            self._stop.wait(max(1.0, min(next_due - time.time(), self.max_interval)))
+
+    def start(self):
+        """Run the poller in a background thread, unless it is running already."""
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="batch-job-poller", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,157 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from dataclasses import dataclass, field
+from openai import OpenAI
+
+from modules.prompts import PromptBatches
+from modules.packing import pack_batches
+from modules.scripts import (BatchParseReport, iter_batch_output_lines, parse_custom_id, create_sharded_batch_jobs,
+                             BATCH_MAX_REQUESTS)
+
+
+FAILURE_COLUMNS = ["custom_id", "prompt_idx", "design_ids", "stage", "error"]
+
+
+def read_batch_errors(source):
+    """The tasks of a batch error file, as failures like those of `BatchParseReport`.
+
+    `source` is anything `scripts.iter_batch_output_lines` reads, e.g. the result of
+    `scripts.download_batch_errors` or an `_errors.jsonl` file of the `BatchJobPoller`.
+    """
+    failures = []
+    for line_no, line in enumerate(iter_batch_output_lines(source), start=1):
+        if not line.strip():
+            continue
+        try:
+            res = json.loads(line)
+        except json.JSONDecodeError as e:
+            logging.error(f"Error decoding line {line_no} of the error file: {e}")
+            continue
+        response = res.get("response") or {}
+        error = res.get("error") or ((response.get("body") or {}).get("error")) or {}
+        message = error.get("message") if isinstance(error, dict) else str(error)
+        status = response.get("status_code")
+        failures.append({"custom_id": res.get("custom_id"), "line_no": line_no, "stage": "error_file",
+                         "error": f"{status}: {message}" if status is not None else message})
+    return failures
+
+
+@dataclass
+class BatchFailures:
+    """The failed tasks of a step's batch jobs and the source rows behind them.
+
+    `failures` holds one row per failed task with its `custom_id`, prompt index, design ids,
+    the stage it failed in ("error_file", or "response" / "content" from the parse) and the
+    error; `rows` the rows of the `PromptBatches` those prompts were built from.
+    `unmapped` counts output lines too broken to tell which task they belong to.
+    """
+    step: str
+    failures: pd.DataFrame = field(default_factory=lambda: pd.DataFrame(columns=FAILURE_COLUMNS))
+    rows: pd.DataFrame = None
+    unmapped: int = 0
+
+    def __len__(self):
+        return len(self.failures)
+
+    @property
+    def design_ids(self):
+        return sorted({int(design_id) for design_ids in self.failures["design_ids"] for design_id in design_ids})
+
+
+def task_positions(source: PromptBatches, custom_id: str):
+    """Row positions in `source.data` of the prompt behind `custom_id`, and its design ids.
+
+    The prompt index selects the rows; if the design ids encoded in the task id (see
+    `scripts.make_custom_id`) disagree with them, the rows of those designs are used instead.
+    """
+    task = parse_custom_id(custom_id)
+    if task["step"] is not None and task["step"] != source.step:
+        raise ValueError(f"Task {custom_id} is not of step {source.step}.")
+    positions = np.arange(0)
+    if task["prompt_idx"] < len(source.batches):
+        start, stop = source.batches[task["prompt_idx"]]
+        positions = np.arange(start, min(stop, len(source.data)))
+    design_ids = source.design_ids(source.data.iloc[positions])
+    if task["design_ids"] and set(task["design_ids"]) != set(design_ids):
+        logging.warning(f"Task {custom_id} does not match prompt {task['prompt_idx']} of the source; "
+                        f"using the rows of its design ids.")
+        positions = np.flatnonzero(source.data[source.id_col].isin(task["design_ids"]).to_numpy())
+        design_ids = task["design_ids"]
+    return positions, design_ids
+
+
+def collect_batch_failures(source: PromptBatches, report: BatchParseReport=None, errors=None):
+    """Map the failed tasks of a step's batch jobs back to the rows of `source`.
+
+    `report` is the `BatchParseReport` of `scripts.parse_and_clean_batch_responses` over the
+    jobs' output; `errors` is the error file content (see `read_batch_errors`). A task in both
+    is counted once.
+    """
+    failures = read_batch_errors(errors) if errors is not None else []
+    if report is not None:
+        failures += report.failures
+
+    rows = []
+    positions = []
+    unmapped = 0
+    seen = set()
+    for failure in failures:
+        custom_id = failure["custom_id"]
+        if custom_id is None:
+            unmapped += 1
+            continue
+        if custom_id in seen:
+            continue
+        seen.add(custom_id)
+        task_rows, design_ids = task_positions(source, custom_id)
+        positions.extend(task_rows.tolist())
+        rows.append({"custom_id": custom_id, "prompt_idx": parse_custom_id(custom_id)["prompt_idx"],
+                     "design_ids": design_ids, "stage": failure["stage"], "error": failure["error"]})
+
+    if unmapped:
+        logging.warning(f"{unmapped} output lines of step {source.step} could not be decoded at all; "
+                        f"their tasks are unknown and not resubmitted.")
+    df_failures = pd.DataFrame(rows, columns=FAILURE_COLUMNS).sort_values("prompt_idx", ignore_index=True)
+    batch_failures = BatchFailures(source.step, df_failures, source.data.iloc[sorted(set(positions))], unmapped)
+    logging.info(f"{len(df_failures)} failed tasks of step {source.step} cover {len(batch_failures.rows)} rows "
+                 f"of {len(batch_failures.design_ids)} designs.")
+    return batch_failures
+
+
+def resubmit_batch_failures(failures: BatchFailures,
+                            source: PromptBatches,
+                            client: OpenAI,
+                            tmp_dir: Path,
+                            batch_size: int=None,
+                            packing_kwargs: dict=None,
+                            max_requests: int=BATCH_MAX_REQUESTS,
+                            **job_kwargs):
+    """Submit a follow-up batch with only the rows of the failed tasks.
+
+    The rows are rebuilt into prompts like `source`, with `batch_size` rows each (by default
+    the original size), or re-packed by token budget with `packing.pack_batches(**packing_kwargs)`.
+    Further arguments go to `scripts.create_sharded_batch_jobs`; the input files are written
+    to `tmp_dir/retries`. Returns the submitted jobs and the `PromptBatches` of the follow-up,
+    to parse its output and, if tasks fail again, to collect them for another round.
+    """
+    if failures.rows is None or failures.rows.empty:
+        logging.info(f"No failed tasks of step {failures.step} to resubmit.")
+        return [], None
+
+    rows = failures.rows.reset_index(drop=True)
+    batch_size = batch_size or source.batch_size
+    batches = None
+    if packing_kwargs is not None:
+        batches, _ = pack_batches(rows, source.step, **dict(packing_kwargs, response_format=source.response_format))
+    retry_source = PromptBatches(source.step, rows, batch_size, batches, source.response_format, source.split_prefix)
+
+    design_ids = [retry_source.design_ids(retry_source.rows(idx)) for idx in range(len(retry_source.batches))]
+    jobs = create_sharded_batch_jobs(retry_source.prompts(), client, Path(tmp_dir) / "retries", source.step, design_ids,
+                                     max_requests=max_requests, **job_kwargs)
+    logging.info(f"Resubmitted {len(rows)} rows of step {source.step} as {len(retry_source.batches)} prompts "
+                 f"in {len(jobs)} batch jobs.")
+    return jobs, retry_source
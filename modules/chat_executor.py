@@ -0,0 +1,302 @@
+import time
+import asyncio
+import itertools
+import logging
+import concurrent.futures
+
+from openai import AsyncOpenAI
+
+from modules.scripts import build_messages, cached_tokens, log_completion_usage, parse_completion
+from modules.prompts import PromptBatches
+from modules.failure_isolation import (RetryPolicy, PromptTask, DECODE_ERRORS, run_with_retry_async, can_split,
+                                       isolate_failure)
+
+
+def to_async_client(client):
+    """Return an AsyncOpenAI client sharing the configuration of `client`."""
+    if isinstance(client, AsyncOpenAI):
+        return client
+    return AsyncOpenAI(
+        api_key=client.api_key,
+        organization=client.organization,
+        base_url=client.base_url,
+        timeout=client.timeout,
+        max_retries=client.max_retries,
+    )
+
+
+async def run_blocking(func, *args):
+    """`func(*args)` in the loop's default thread pool, e.g. the `ResponseCache`'s SQLite calls.
+
+    Keeps blocking I/O from stalling the other prompts; stands in for `asyncio.to_thread`,
+    which needs Python 3.9.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def stream_chat_completion(prompt, client: AsyncOpenAI, model="gpt-4o", temperature=0, stats: dict=None):
+    """Stream one chat completion; returns the response text and the reported token usage.
+
+    A `stats` dict is filled with the request timings, as in `scripts.get_chat_completion`.
+    """
+    sent_at = time.time()
+    raw_response = await client.chat.completions.with_raw_response.create(
+        model=model,
+        messages=build_messages(prompt),
+        stream=True,
+        stream_options={"include_usage": True},
+        temperature=temperature
+    )
+    stream = raw_response.parse()
+
+    response = ""
+    first_token_at = None
+    usage = None
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content is not None:
+            if first_token_at is None:
+                first_token_at = time.time()
+            response += chunk.choices[0].delta.content
+        # With include_usage the final chunk has no choices and carries the usage
+        if chunk.usage is not None:
+            usage = {
+                "input_tokens": chunk.usage.prompt_tokens,
+                "output_tokens": chunk.usage.completion_tokens,
+                "cached_tokens": cached_tokens(chunk.usage),
+            }
+
+    if stats is not None:
+        stats.update(sent_at=sent_at, first_token_at=first_token_at, finished_at=time.time(),
+                     client_retries=getattr(raw_response, "retries_taken", 0), usage=usage)
+    log_completion_usage(usage)
+    return response, usage
+
+
+async def get_chat_completion_async(prompt, client: AsyncOpenAI, model="gpt-4o", temperature=0):
+    """Async counterpart of `scripts.get_chat_completion`."""
+    response, _ = await stream_chat_completion(prompt, client, model, temperature)
+    return response
+
+
+async def complete_prompt(prompt,
+                          client: AsyncOpenAI,
+                          idx: int=None,
+                          model: str="gpt-4o",
+                          temperature=0,
+                          usages: list=None,
+                          cache=None,
+                          metrics=None,
+                          step: str=None,
+                          enqueued_at: float=None):
+    """One completion of `prompt`, answered from the `ResponseCache` if possible; see `gather_chat_completions`."""
+    if cache is not None:
+        key = cache.make_key(model, temperature, build_messages(prompt))
+        cached_response = await run_blocking(cache.get, key)
+        if cached_response is not None:
+            logging.debug(f"Prompt {idx} answered from cache")
+            if metrics is not None:
+                metrics.increment(step, "chat", "cache_hits")
+            return cached_response
+
+    stats = {"enqueued_at": enqueued_at}
+    completion, usage = await stream_chat_completion(prompt, client, model, temperature, stats)
+    logging.debug(f"Prompt {idx}: {len(completion)} characters in {stats['finished_at'] - stats['sent_at']:.2f}s")
+    if metrics is not None:
+        metrics.record_request(step, stats)
+    if cache is not None and completion.strip():
+        await run_blocking(cache.put, key, completion)
+    if usages is not None and usage is not None:
+        usages.append(dict(usage, prompt_idx=idx, started_at=stats["sent_at"], finished_at=stats["finished_at"]))
+    return completion
+
+
+async def run_workers(worker, max_concurrency: int):
+    """Run `max_concurrency` copies of `worker`; if one raises, cancel the others and wait for them before re-raising."""
+    workers = [asyncio.ensure_future(worker()) for _ in range(max_concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for future in workers:
+            future.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+
+async def gather_chat_completions(prompts,
+                                  client,
+                                  max_concurrency: int=16,
+                                  model: str="gpt-4o",
+                                  temperature=0,
+                                  usages: list=None,
+                                  prompt_offset: int=0,
+                                  cache=None,
+                                  metrics=None,
+                                  step: str=None):
+    """Run the chat completions for `prompts` with at most `max_concurrency` requests in flight.
+
+    `prompts` may be any iterable, including a generator; it is consumed lazily by the
+    workers. The completions are returned in prompt order. If a `usages` list is given, the
+    token usage and timing of every request is appended to it. Prompts with a response in
+    the `ResponseCache` are answered from it without a request. With a `PipelineMetrics`,
+    the timings of every request are recorded for `step`; the queue time of a prompt runs
+    from the start of this call until its request is sent.
+    """
+    async_client = to_async_client(client)
+    owns_client = async_client is not client
+    prompt_iter = enumerate(prompts, start=prompt_offset)
+    completions = {}
+    enqueued_at = time.time()
+
+    async def worker():
+        # The shared iterator is only advanced between awaits, so workers never race on it
+        for idx, prompt in prompt_iter:
+            try:
+                completions[idx] = await complete_prompt(prompt, async_client, idx, model, temperature, usages,
+                                                         cache, metrics, step, enqueued_at)
+            except Exception:
+                if metrics is not None:
+                    metrics.increment(step, "chat", "errors")
+                raise
+
+    try:
+        await run_workers(worker, max_concurrency)
+    finally:
+        if owns_client:
+            await async_client.close()
+
+    return [completions[idx] for idx in sorted(completions)]
+
+
+async def gather_prompt_tasks(tasks,
+                              client: AsyncOpenAI,
+                              max_concurrency: int=16,
+                              model: str="gpt-4o",
+                              temperature=0,
+                              step: str=None,
+                              response_format: str="json",
+                              retry: RetryPolicy=None,
+                              source: PromptBatches=None,
+                              usages: list=None,
+                              cache=None,
+                              metrics=None,
+                              enqueued_at: float=None):
+    """Complete and decode `PromptTask`s concurrently, retrying each on its own.
+
+    Returns one (task, entries, error, attempts, last completion) tuple per task; a task
+    that failed for good has `error` set instead of raising, so the others are kept. An error
+    that is not a failure of the prompt itself (see `failure_isolation.is_prompt_failure`)
+    cancels the other tasks and is raised.
+    """
+    retry = retry or RetryPolicy()
+    task_iter = iter(tasks)
+    outcomes = []
+
+    async def worker():
+        for task in task_iter:
+            last = {}
+
+            async def attempt():
+                last["completion"] = completion = await complete_prompt(
+                    task.prompt, client, task.prompt_idx, model, temperature, usages, cache, metrics, step, enqueued_at)
+                parse_start = time.perf_counter()
+                try:
+                    return parse_completion(completion, step, response_format)
+                except DECODE_ERRORS:
+                    if cache is not None:
+                        await run_blocking(cache.discard, cache.make_key(model, temperature, build_messages(task.prompt)))
+                    raise
+                finally:
+                    if metrics is not None:
+                        metrics.observe(step, "chat", "parse_time", time.perf_counter() - parse_start)
+
+            entries, error, attempts = await run_with_retry_async(attempt, retry, can_split(task, source), task.label)
+            if metrics is not None and attempts > 1:
+                metrics.increment(step, "chat", "task_retries", attempts - 1)
+            if metrics is not None and error is not None:
+                metrics.increment(step, "chat", "errors")
+            outcomes.append((task, entries, error, attempts, last.get("completion")))
+
+    await run_workers(worker, max_concurrency)
+    return outcomes
+
+
+def run_coroutine(coro):
+    """Run `coro` to completion, also from inside a running event loop (e.g. Jupyter)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+
+def process_prompts_async(prompts,
+                          client,
+                          batch_start,
+                          batch_stop,
+                          max_concurrency: int=16,
+                          model: str="gpt-4o",
+                          ledger=None,
+                          step: str=None,
+                          cache=None,
+                          response_format: str="json",
+                          metrics=None,
+                          retry: RetryPolicy=None,
+                          source: PromptBatches=None,
+                          dead_letters=None,
+                          failures: list=None):
+    """Concurrent drop-in for `scripts.process_prompts`.
+
+    Accepts the same `OpenAI` client as the sequential version (an `AsyncOpenAI` client is
+    derived from its configuration) and returns the same `responses_list`, ordered by prompt index.
+    With a `TokenLedger`, the actual usage of every prompt is recorded for `step`; with a
+    `ResponseCache`, already answered prompts are not sent again; with a `PipelineMetrics`,
+    request timings and parse times are recorded. `response_format` must match the format
+    the prompts were built with (see `scripts.decode_response`).
+
+    Failures are isolated per prompt as in `scripts.process_prompts`: transient errors are
+    retried with backoff, undecodable responses are split in two given the `source`, and
+    prompts that still fail go to `failures` and the `DeadLetterStore`. The entries of all
+    other prompts are returned; their responses are kept in the `cache` as they arrive.
+    Other errors stop the run, and the client's own retries are turned off, as there.
+    """
+    selected = itertools.islice(prompts, batch_start, batch_stop)
+    usages = []
+    results = {}
+    n_failed = 0
+
+    async def run():
+        nonlocal n_failed
+        async_client = to_async_client(client)
+        owns_client = async_client is not client
+        async_client = async_client.with_options(max_retries=0)
+        enqueued_at = time.time()
+        tasks = (PromptTask(idx, prompt) for idx, prompt in enumerate(selected, start=batch_start))
+        try:
+            # Split prompts are sent in a further round, until none is left
+            while tasks:
+                outcomes = await gather_prompt_tasks(tasks, async_client, max_concurrency, model, 0, step,
+                                                     response_format, retry, source, usages, cache, metrics,
+                                                     enqueued_at)
+                tasks = []
+                for task, entries, error, attempts, completion in outcomes:
+                    if error is None:
+                        results[task.key] = entries
+                        continue
+                    halves = isolate_failure(task, error, attempts, step, source, dead_letters, failures, completion)
+                    n_failed += not halves
+                    tasks.extend(halves)
+        finally:
+            if owns_client:
+                await async_client.close()
+
+    run_coroutine(run())
+    logging.info(f"Received {len(results)} completions with concurrency {max_concurrency}.")
+    if n_failed:
+        logging.warning(f"{n_failed} prompts of step {step} failed; returning the results of the others.")
+
+    if ledger is not None:
+        ledger.record_actuals(step, usages, api_mode="chat")
+
+    return [entry for key in sorted(results) for entry in results[key]]
@@ -0,0 +1,184 @@
+import logging
+import pandas as pd
+
+from dataclasses import dataclass, field
+
+
+DELIMITER = "|"
+PAIR_SEPARATOR = ";"
+CLASS_SEPARATOR = ":"
+
+
+class CompactFormatError(ValueError):
+    """Raised when a compact response has no rows that match the step's columns, or a row without a valid key."""
+
+
+@dataclass
+class CompactFormat():
+    """Columns of one step's compact response: a header line plus one delimited line per row.
+
+    `int_columns` are decoded as integers. The `pairs_column` holds a list of (entity, class)
+    pairs written as `entity:CLASS;entity:CLASS`. The first column is the key of the rows.
+    """
+    step: str
+    columns: list
+    int_columns: tuple = ()
+    pairs_column: str = None
+    row_label: str = "row"
+    examples: list = field(default_factory=list)
+
+    @property
+    def key_column(self):
+        return self.columns[0]
+
+    @property
+    def header(self):
+        return DELIMITER.join(self.columns)
+
+    @property
+    def header_record(self):
+        """The header line as `loads` decodes it, so it can be recognised and skipped."""
+        return {column: None if column in self.int_columns else [] if column == self.pairs_column else column
+                for column in self.columns}
+
+
+# Same columns as the JSON responses the prompts in `modules.prompts` ask for
+COMPACT_FORMATS = {
+    "0": CompactFormat(
+        "0", ["design_id", "new_list_of_strings"], ("design_id",), pairs_column="new_list_of_strings",
+        row_label="design",
+        examples=[{"design_id": 36, "new_list_of_strings": [["Aphrodite", "PERSON"], ["breast", "OBJECT"],
+                                                            ["pudenda", "OBJECT"], ["Eros", "PERSON"],
+                                                            ["dolphin", "ANIMAL"]]}]),
+    "0_1": CompactFormat(
+        "0_1", ["design_id", "relevance", "correctness", "comment_enh"], ("design_id", "relevance", "correctness"),
+        row_label="design",
+        examples=[{"design_id": 36, "relevance": 1, "correctness": 1,
+                   "comment_enh": "All significant objects, redundant head and hand removed."}]),
+    "1": CompactFormat(
+        "1", ["design_id", "s_o_id", "s", "subject_class", "o", "object_class"], ("design_id",),
+        row_label="pair",
+        examples=[{"design_id": 114, "s_o_id": "a", "s": "Artemis", "subject_class": "PERSON",
+                   "o": "torch", "object_class": "OBJECT"},
+                  {"design_id": 90, "s_o_id": "a", "s": "NULL", "subject_class": "NULL",
+                   "o": "NULL", "object_class": "NULL"}]),
+    "1_1": CompactFormat(
+        "1_1", ["design_id", "s_o_id", "validity_sop", "comment_sop"], ("design_id", "validity_sop"),
+        row_label="pair",
+        examples=[{"design_id": 478, "s_o_id": "a", "validity_sop": 1, "comment_sop": "Correct and meaningful pair."},
+                  {"design_id": 478, "s_o_id": "c", "validity_sop": -1, "comment_sop": "Hands are not significant."}]),
+    "2": CompactFormat(
+        "2", ["design_id", "s_o_id", "predicate"], ("design_id",),
+        row_label="subject-object pair",
+        examples=[{"design_id": 114, "s_o_id": "a", "predicate": "containing"},
+                  {"design_id": 50, "s_o_id": "a", "predicate": "NULL"}]),
+    "2_1": CompactFormat(
+        "2_1", ["design_id", "s_o_id", "validity_pred", "comment_pred", "implicit_pred"], ("design_id", "validity_pred"),
+        row_label="SPO triple",
+        examples=[{"design_id": 478, "s_o_id": "a", "validity_pred": 1,
+                   "comment_pred": "Correct and meaningful SPO triple.", "implicit_pred": "NULL"},
+                  {"design_id": 53, "s_o_id": "a", "validity_pred": -1,
+                   "comment_pred": "NULL is not a valid predicate.", "implicit_pred": "wearing"}]),
+}
+
+
+def get_format(step: str):
+    if step not in COMPACT_FORMATS:
+        raise ValueError(f"No compact response format for step {step!r}.")
+    return COMPACT_FORMATS[step]
+
+
+def _encode_value(value, column: str, fmt: CompactFormat):
+    if column == fmt.pairs_column:
+        return PAIR_SEPARATOR.join(f"{entity}{CLASS_SEPARATOR}{cls}" for entity, cls in value)
+    if value is None:
+        return "NULL"
+    return str(value).replace(DELIMITER, "/").replace("\n", " ")
+
+
+def dumps(records: list, step: str):
+    """Render response records of `step` in its compact format."""
+    fmt = get_format(step)
+    lines = [fmt.header]
+    for record in records:
+        lines.append(DELIMITER.join(_encode_value(record.get(column), column, fmt) for column in fmt.columns))
+    return "\n".join(lines)
+
+
+def instructions(step: str):
+    """Response instructions for the compact format, in the layout of the prompts in `modules.prompts`."""
+    fmt = get_format(step)
+    notes = ""
+    if fmt.pairs_column is not None:
+        notes += (f"\n        - Write {fmt.pairs_column} as entity{CLASS_SEPARATOR}CLASS pairs "
+                  f"separated by \"{PAIR_SEPARATOR}\".")
+    if any(column.startswith("comment") for column in fmt.columns):
+        notes += "\n        - Keep comments short (at most 12 words)."
+    example = dumps(fmt.examples, step).replace("\n", "\n        ")
+    return f"""        Respond in the following compact format instead of JSON: first the header line, then one line per {fmt.row_label}
+        with the values in the order of the header, separated by "{DELIMITER}".
+        - Do not quote values and never use "{DELIMITER}" inside a value.{notes}
+        - Do not add any other text.
+
+        {example}
+        """
+
+
+def _is_rule(line: str):
+    return line.startswith("```") or not line.strip("-:| ")
+
+
+def _decode_pairs(value: str):
+    if not value.strip() or value.strip() == "NULL":
+        return []
+    pairs = []
+    for item in value.split(PAIR_SEPARATOR):
+        entity, _, cls = item.strip().rpartition(CLASS_SEPARATOR)
+        if entity:
+            pairs.append([entity.strip(), cls.strip()])
+    return pairs
+
+
+def _decode_int(value: str):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def loads(text: str, step: str):
+    """Decode a compact response of `step` into records with the step's JSON keys.
+
+    Code fences, Markdown table rules, repeated header lines and lines with the wrong
+    number of fields are skipped; a row whose key is not an integer raises `CompactFormatError`.
+    """
+    fmt = get_format(step)
+    columns = fmt.columns
+    n_fields = len(columns)
+    decoders = [_decode_int if column in fmt.int_columns else _decode_pairs if column == fmt.pairs_column else str.strip
+                for column in columns]
+    header_record = fmt.header_record
+    key_column = fmt.key_column
+    records = []
+    for line in text.splitlines():
+        line = line.strip().strip(DELIMITER)
+        if not line or _is_rule(line):
+            continue
+        fields = line.split(DELIMITER)
+        if len(fields) != n_fields:
+            logging.debug(f"Skipping line with {len(fields)} instead of {n_fields} fields: {line[:200]}")
+            continue
+        record = {column: decode(value) for column, decode, value in zip(columns, decoders, fields)}
+        if record == header_record:
+            continue
+        if record[key_column] is None:
+            raise CompactFormatError(f"Row of step {step} without a valid {key_column}: {line[:200]}")
+        records.append(record)
+    if not records and text.strip():
+        raise CompactFormatError(f"No rows of step {step} found in the response.")
+    return records
+
+
+def loads_frame(text: str, step: str):
+    """Decode a compact response into a DataFrame with the step's JSON columns."""
+    return pd.DataFrame(loads(text, step), columns=get_format(step).columns)
@@ -0,0 +1,95 @@
+import json
+import sqlite3
+import logging
+import pandas as pd
+
+from pathlib import Path
+from contextlib import closing
+from datetime import datetime
+
+from modules.scripts import CEST, prompt_text
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    step TEXT,
+    prompt_idx INTEGER,
+    part TEXT NOT NULL DEFAULT '',
+    design_ids TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    error_type TEXT NOT NULL,
+    error TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    response TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_dead_letters_step ON dead_letters (step);
+"""
+
+
+class DeadLetterStore():
+    """Prompts that kept failing in chat mode, with their design ids, last error and last response.
+
+    Written by `scripts.process_prompts` and `chat_executor.process_prompts_async` once a
+    prompt is out of retries and cannot be split any further. `design_ids` lists what to
+    rerun; `remove` clears the entries of designs that have since been processed.
+    """
+
+    def __init__(self, db_path: Path=Path("./data/results/tmp/dead_letters.sqlite")):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def __len__(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+
+    def add(self,
+            step: str,
+            prompt_idx: int,
+            design_ids: list,
+            attempts: int,
+            error: Exception,
+            prompt,
+            response: str=None,
+            part: str=""):
+        """Record a prompt that failed for good; `part` identifies a prompt split from `prompt_idx`."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO dead_letters (step, prompt_idx, part, design_ids, attempts, error_type, error, prompt, "
+                "response, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (step, prompt_idx, part, json.dumps([int(design_id) for design_id in design_ids]), attempts,
+                 type(error).__name__, str(error), prompt_text(prompt), response, datetime.now(CEST).isoformat()))
+        logging.info(f"Prompt {prompt_idx}{'.' + part if part else ''} of step {step} added to the dead letters.")
+
+    def read(self, step: str=None):
+        """The dead letters as a DataFrame, optionally of one step, oldest first."""
+        query = "SELECT * FROM dead_letters"
+        params = ()
+        if step is not None:
+            query += " WHERE step = ?"
+            params = (step,)
+        with closing(self._connect()) as conn:
+            df = pd.read_sql_query(query + " ORDER BY id", conn, params=params)
+        df["design_ids"] = df["design_ids"].map(json.loads)
+        return df
+
+    def design_ids(self, step: str):
+        """Sorted ids of the designs with a dead letter in `step`."""
+        return sorted({design_id for design_ids in self.read(step)["design_ids"] for design_id in design_ids})
+
+    def remove(self, step: str, design_ids: list=None):
+        """Remove the dead letters of `step`, or only those involving any of `design_ids`."""
+        df = self.read(step)
+        if design_ids is not None:
+            wanted = set(int(design_id) for design_id in design_ids)
+            df = df[df["design_ids"].map(lambda ids: bool(wanted.intersection(ids)))]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM dead_letters WHERE id = ?", [(int(row_id),) for row_id in df["id"]])
+        logging.info(f"Removed {len(df)} dead letters of step {step}.")
+        return len(df)
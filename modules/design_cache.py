@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import pandas as pd
+
+from pathlib import Path
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+# Bump when the cached layout changes, so old caches are rebuilt
+CACHE_VERSION = 1
+
+# Columns holding lists of (start, stop, class) spans
+SPAN_COLUMNS = ("annotations", "annotations_orig")
+SPAN_FIELDS = ("start", "stop", "label")
+
+
+def _update_hash(digest, part):
+    if isinstance(part, pd.DataFrame):
+        digest.update(json.dumps(list(map(str, part.columns))).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(part.astype(str), index=False).to_numpy().tobytes())
+    elif isinstance(part, pd.Series):
+        _update_hash(digest, part.to_frame())
+    elif isinstance(part, dict):
+        for key in sorted(part, key=str):
+            digest.update(str(key).encode("utf-8"))
+            _update_hash(digest, part[key])
+    elif isinstance(part, (list, tuple)):
+        digest.update(json.dumps(part, default=str, ensure_ascii=False).encode("utf-8"))
+    else:
+        digest.update(repr(part).encode("utf-8"))
+
+
+def fingerprint(*parts):
+    """Content hash over DataFrames, dicts, lists and scalars, e.g. the sources and rules of a cache."""
+    digest = hashlib.sha256(str(CACHE_VERSION).encode("utf-8"))
+    for part in parts:
+        _update_hash(digest, part)
+    return digest.hexdigest()
+
+
+class DesignCache():
+    """Binary cache of the preprocessed designs, valid only for the fingerprint it was built with.
+
+    The frame is stored as Parquet when pyarrow is installed, with the span columns as
+    native lists of structs, and as a pandas pickle otherwise. A JSON sidecar records the
+    fingerprint; `load` returns None when it is missing or differs, so the caller rebuilds.
+    """
+
+    def __init__(self, path: Path, file_format: str=None):
+        self.file_format = file_format or ("parquet" if HAS_PYARROW else "pickle")
+        if self.file_format == "parquet" and not HAS_PYARROW:
+            raise ImportError("Storing the design cache as Parquet requires pyarrow.")
+        path = Path(path)
+        self.path = path.with_name(f"{path.stem}.{'parquet' if self.file_format == 'parquet' else 'pkl'}")
+        self.meta_path = path.with_name(f"{path.stem}.cache.json")
+
+    def meta(self):
+        if not self.meta_path.exists() or not self.path.exists():
+            return None
+        return json.loads(self.meta_path.read_text(encoding="utf-8"))
+
+    def load(self, fingerprint: str):
+        """The cached frame if it was built from the sources with `fingerprint`, else None.
+
+        A `fingerprint` of None loads the cache whatever it was built from.
+        """
+        meta = self.meta()
+        if meta is None:
+            logging.info(f"No design cache at {self.path}.")
+            return None
+        if meta.get("format") != self.file_format or (fingerprint is not None and meta.get("fingerprint") != fingerprint):
+            logging.info(f"Design cache {self.path} is stale; sources, entity lists or rules changed.")
+            return None
+        if self.file_format == "parquet":
+            df = pd.read_parquet(self.path)
+            for column in SPAN_COLUMNS:
+                if column in df:
+                    df[column] = [[tuple(span[field] for field in SPAN_FIELDS) for span in spans]
+                                  for spans in df[column].tolist()]
+        else:
+            df = pd.read_pickle(self.path)
+        logging.info(f"Loaded {len(df)} preprocessed designs from {self.path}.")
+        return df
+
+    def save(self, df: pd.DataFrame, fingerprint: str):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Invalidate first, so a crash while writing never leaves a fingerprint next to other data
+        self.meta_path.unlink(missing_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        if self.file_format == "parquet":
+            stored = df.copy()
+            for column in SPAN_COLUMNS:
+                if column in stored:
+                    stored[column] = [[dict(zip(SPAN_FIELDS, span)) for span in spans]
+                                      for spans in stored[column].tolist()]
+            stored.to_parquet(tmp_path, index=False)
+        else:
+            df.to_pickle(tmp_path)
+        os.replace(tmp_path, self.path)
+
+        meta = {"fingerprint": fingerprint, "format": self.file_format, "rows": len(df), "created_at": time.time()}
+        tmp_meta = self.meta_path.with_name(self.meta_path.name + ".tmp")
+        tmp_meta.write_text(json.dumps(meta, indent=4), encoding="utf-8")
+        os.replace(tmp_meta, self.meta_path)
+        logging.info(f"Cached {len(df)} preprocessed designs in {self.path}.")
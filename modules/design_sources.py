@@ -0,0 +1,177 @@
+import logging
+import pandas as pd
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+try:
+    from sqlalchemy.exc import InterfaceError, OperationalError
+except ImportError:
+    InterfaceError = OperationalError = None
+
+
+# Entity list shipped for every class in data/source/lists/csv
+ENTITY_FILES = {
+    "PERSON": "nlp_list_person.csv",
+    "OBJECT": "nlp_list_obj.csv",
+    "ANIMAL": "nlp_list_animal.csv",
+    "PLANT": "nlp_list_plant.csv",
+}
+
+# The person list names its columns without the language suffix of the other lists
+PERSON_COLUMNS = {"name": "name_en", "alternativenames": "alternativenames_en", "name_german": "name_ger"}
+
+CLASS_COL = "class"
+
+# Raised by `DesignSource.version` when the sources cannot be reached, as opposed to a bug or a bad query
+UNAVAILABLE_ERRORS = (ConnectionError, FileNotFoundError) + tuple(
+    error for error in (InterfaceError, OperationalError) if error is not None)
+
+DESIGNS_TABLE = "nlp_training_designs"
+ENTITIES_TABLE = "nlp_list_entities"
+
+
+def file_version(path: Path):
+    """Size and modification time of a file, or None if it does not exist."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def entity_names(df_entities: pd.DataFrame, language: str="_en", class_col: str=CLASS_COL):
+    """Names per class, {class: [name, ...]}: the standard names, split at ",".
+
+    Like the `cnt` loader, which was handed the name column only: alternative names are
+    rewritten to their standard name by the alias rules before annotation. "NULL" and
+    empty names are dropped.
+    """
+    names = (df_entities[[class_col, "name" + language]].set_axis([class_col, "value"], axis=1)
+             .assign(value=lambda df: df["value"].str.split(",")).explode("value").dropna())
+    names["value"] = names["value"].astype(str).str.strip()
+    names = names[(names["value"].str.len() > 0) & (names["value"] != "NULL")]
+    grouped = names.groupby(class_col, sort=False)["value"].agg(list)
+    return {entity_class: grouped.get(entity_class, []) for entity_class in ENTITY_FILES}
+
+
+class DesignSource(ABC):
+    """Where `LoadingPreprocessedDesigns` gets its source designs and entity lists from.
+
+    Subclasses implement the abstract `load_designs`, `load_entity_table` and `version`.
+    The table holds the `add_columns` of every entity plus its class, and the per-class
+    name lists for the annotator are derived from it, so both come from a single load.
+    `version` describes the current state of the sources without loading them, for the
+    design cache fingerprint.
+    """
+
+    def __init__(self, language: str="_en", add_columns: list=None):
+        self.language = language
+        self.add_columns = add_columns or ["id", "name" + language, "alternativenames" + language]
+
+    @abstractmethod
+    def load_designs(self, id_col: str, design_col: str):
+        """The `id_col` and `design_col` columns of the source designs."""
+
+    @abstractmethod
+    def load_entity_table(self):
+        """The `add_columns` and the class column of every entity, one row per entity."""
+
+    @abstractmethod
+    def version(self, id_col: str="id"):
+        """A JSON-serializable description of the current state of the sources."""
+
+    def load_sources(self, id_col: str, design_col: str):
+        """The designs, the names per class and the entity table, as used by `preprocess_designs`."""
+        entity_table = self.load_entity_table()
+        return {
+            "designs": self.load_designs(id_col, design_col),
+            "entities": entity_names(entity_table, self.language),
+            "df_entities": entity_table[self.add_columns],
+        }
+
+
+class FileSource(DesignSource):
+    """Entity lists from the CSV files in `csv_path`, designs from `designs_file` (CSV or JSON).
+
+    Needs no database connection. The entity lists ship with the repository; the raw
+    designs do not, so `designs_file` has to be given to preprocess from files only.
+    """
+
+    def __init__(self, csv_path: Path, designs_file: Path=None, **kwargs):
+        super().__init__(**kwargs)
+        self.csv_path = Path(csv_path)
+        self.designs_file = Path(designs_file) if designs_file is not None else None
+
+    def load_designs(self, id_col: str, design_col: str):
+        if self.designs_file is None:
+            raise ValueError("The file source needs `designs_file` to load designs without a database.")
+        if self.designs_file.suffix == ".json":
+            designs = pd.read_json(self.designs_file)
+        else:
+            designs = pd.read_csv(self.designs_file)
+        logging.info(f"Loaded {len(designs)} designs from {self.designs_file}.")
+        return designs[[id_col, design_col]]
+
+    def version(self, id_col: str="id"):
+        """Size and modification time of the designs file and of every entity list."""
+        if self.designs_file is None:
+            raise ValueError("The file source needs `designs_file` to load designs without a database.")
+        files = [self.designs_file] + [self.csv_path / filename for filename in ENTITY_FILES.values()]
+        return {path.name: file_version(path) for path in files}
+
+    def load_entity_table(self):
+        frames = []
+        for entity_class, filename in ENTITY_FILES.items():
+            df = pd.read_csv(self.csv_path / filename, dtype=str, keep_default_na=False, na_values=["NULL", ""])
+            if entity_class == "PERSON":
+                df = df.rename(columns=PERSON_COLUMNS)
+            frames.append(df.reindex(columns=self.add_columns).assign(**{CLASS_COL: entity_class}))
+        table = pd.concat(frames, ignore_index=True)
+        table = table.astype(object).where(table.notna(), None)
+        logging.info(f"Loaded {len(table)} entities from {self.csv_path}.")
+        return table
+
+
+class DatabaseSource(DesignSource):
+    """Designs and the entity lists of all classes from the database, one query each.
+
+    Replaces the per-class `load_entities_from_db_v2` calls: the entity table is read
+    once with its class column and split into classes in pandas.
+    """
+
+    def __init__(self, dc, class_col: str=CLASS_COL, **kwargs):
+        super().__init__(**kwargs)
+        self.dc = dc
+        self.class_col = class_col
+
+    def load_designs(self, id_col: str, design_col: str):
+        return self.dc.load_designs_from_db(DESIGNS_TABLE, [id_col, design_col])
+
+    def version(self, id_col: str="id"):
+        """Row counts and largest ids of the designs and entity tables and their last update time, in one query.
+
+        The update time is the `UPDATE_TIME` of information_schema. It is NULL for tables
+        without a recorded change and, with InnoDB, is reset when the server restarts, so an
+        in-place edit (same row count and ids) before a restart can go unnoticed. Pass
+        `refresh=True` to `load_designs_csv_or_process_database` after such edits.
+        """
+        query = f"""
+        SELECT (SELECT COUNT(*) FROM {DESIGNS_TABLE}) AS designs,
+               (SELECT MAX({id_col}) FROM {DESIGNS_TABLE}) AS max_design_id,
+               (SELECT COUNT(*) FROM {ENTITIES_TABLE}) AS entities,
+               (SELECT MAX(id) FROM {ENTITIES_TABLE}) AS max_entity_id,
+               (SELECT MAX(UPDATE_TIME) FROM information_schema.tables
+                WHERE table_schema = DATABASE() AND table_name IN ('{DESIGNS_TABLE}', '{ENTITIES_TABLE}')) AS updated_at
+        """
+        row = self.dc.create_own_query(query).iloc[0]
+        return {key: str(value) for key, value in row.items()}
+
+    def load_entity_table(self):
+        table = self.dc.load_from_db(ENTITIES_TABLE, self.add_columns + [self.class_col])
+        if table is None:
+            raise ValueError("Loading nlp_list_entities returned None")
+        table = table.rename(columns={self.class_col: CLASS_COL})
+        table[CLASS_COL] = table[CLASS_COL].str.upper()
+        logging.info(f"Loaded {len(table)} entities from the database in one query.")
+        return table
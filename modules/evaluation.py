@@ -0,0 +1,186 @@
+import logging
+import numpy as np
+import pandas as pd
+
+
+# A triple is compared on all five fields, as in the evaluation notebook
+TRIPLE_COLUMNS = ("s", "subject_class", "p", "o", "object_class")
+
+# Per-design results of the notebook's `compare_lists`
+EXACT = 0
+PREDICATE_MISMATCH = 0.1
+PREDICATE_MISMATCH_EXTRA = 1.1
+SUPERSET = 1
+DIFFERENT = -1
+
+CATEGORY_NAMES = {
+    EXACT: "exact match",
+    PREDICATE_MISMATCH: "predicate mismatch",
+    PREDICATE_MISMATCH_EXTRA: "predicate mismatch, extra triples",
+    SUPERSET: "superset",
+    DIFFERENT: "different",
+}
+
+
+def encode_triples(predictions: pd.DataFrame,
+                   ground_truth: pd.DataFrame,
+                   design_col: str="design_id",
+                   columns: tuple=TRIPLE_COLUMNS):
+    """Both frames reduced to integer ids: design, `triple` over `columns` and `pair` over (s, o).
+
+    The ids are shared between the two frames, so triples compare as integers. Row order
+    is kept, since the (s, o) -> p lookups of `compare_lists` take the last triple of a pair.
+    """
+    columns = list(columns)
+    both = pd.concat([predictions[[design_col] + columns], ground_truth[[design_col] + columns]], ignore_index=True)
+    encoded = pd.DataFrame({
+        "design": both[design_col].to_numpy(),
+        "triple": both.groupby(columns, sort=False, dropna=False).ngroup().to_numpy(),
+        "pair": both.groupby([columns[0], columns[3]], sort=False, dropna=False).ngroup().to_numpy(),
+        "predicate": pd.factorize(both[columns[2]])[0],
+    })
+    n_predictions = len(predictions)
+    return encoded.iloc[:n_predictions].reset_index(drop=True), encoded.iloc[n_predictions:].reset_index(drop=True)
+
+
+def design_hashes(triples: pd.DataFrame,
+                  design_col: str="design_id",
+                  columns: tuple=TRIPLE_COLUMNS):
+    """A hash of every design's triples, as a hex string per design.
+
+    Each triple is hashed together with its position within the design, and the hashes
+    of a design are summed, so adding, removing, editing or reordering a triple changes it.
+    """
+    columns = list(columns)
+    triples = triples[[design_col] + columns].astype({column: str for column in columns})
+    triples = triples.assign(position=triples.groupby(design_col, sort=False).cumcount())
+    row_hashes = pd.util.hash_pandas_object(triples[columns + ["position"]], index=False).to_numpy()
+    designs = triples[design_col].to_numpy()
+    order = np.argsort(designs, kind="stable")
+    unique_designs, starts = np.unique(designs[order], return_index=True)
+    sums = np.add.reduceat(row_hashes[order], starts) if len(order) else row_hashes
+    return pd.Series([f"{value:016x}" for value in sums.tolist()], index=pd.Index(unique_designs, name=design_col))
+
+
+def safe_ratio(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+
+def f1_score(precision, recall):
+    return safe_ratio(2 * precision * recall, precision + recall)
+
+
+def compare_designs(predictions: pd.DataFrame,
+                    ground_truth: pd.DataFrame,
+                    design_col: str="design_id",
+                    columns: tuple=TRIPLE_COLUMNS):
+    """Per-design counts, precision/recall/F1 and the `compare_lists` category.
+
+    Only designs present in both frames are compared, like the inner merge of the
+    notebook. `tp` counts distinct triples found in both; `n_pred` / `n_gt` count all
+    triples of a design, duplicates included, as the list lengths of `compare_lists` do.
+    """
+    pred, gt = encode_triples(predictions, ground_truth, design_col, columns)
+    designs = np.intersect1d(pred["design"].unique(), gt["design"].unique())
+    pred = pred[pred["design"].isin(designs)]
+    gt = gt[gt["design"].isin(designs)]
+
+    result = pd.DataFrame({
+        "n_pred": pred.groupby("design").size(),
+        "n_gt": gt.groupby("design").size(),
+    })
+    pred_unique = pred.drop_duplicates(["design", "triple"])
+    gt_unique = gt.drop_duplicates(["design", "triple"])
+    matched = pred_unique.merge(gt_unique[["design", "triple"]], on=["design", "triple"])
+    result["n_pred_unique"] = pred_unique.groupby("design").size()
+    result["n_gt_unique"] = gt_unique.groupby("design").size()
+    result["tp"] = matched.groupby("design").size().reindex(result.index, fill_value=0)
+
+    # Every ground-truth pair is predicted, and always with another predicate
+    last_pred = pred.drop_duplicates(["design", "pair"], keep="last")[["design", "pair", "predicate"]]
+    last_gt = gt.drop_duplicates(["design", "pair"], keep="last")[["design", "pair", "predicate"]]
+    pairs = last_gt.merge(last_pred, on=["design", "pair"], how="left", suffixes=("_gt", "_pred"))
+    other_predicate = pairs["predicate_pred"].notna() & (pairs["predicate_pred"] != pairs["predicate_gt"])
+    all_other = other_predicate.groupby(pairs["design"]).all().reindex(result.index, fill_value=True)
+
+    exact = (result["tp"] == result["n_pred_unique"]) & (result["tp"] == result["n_gt_unique"])
+    result["comparison_result"] = np.select(
+        [exact,
+         all_other & (result["n_pred"] == result["n_gt"]),
+         all_other & (result["n_pred"] > result["n_gt"]),
+         result["tp"] == result["n_gt_unique"]],
+        [EXACT, PREDICATE_MISMATCH, PREDICATE_MISMATCH_EXTRA, SUPERSET],
+        default=DIFFERENT)
+
+    result["precision"] = safe_ratio(result["tp"], result["n_pred_unique"])
+    result["recall"] = safe_ratio(result["tp"], result["n_gt_unique"])
+    result["f1"] = f1_score(result["precision"], result["recall"])
+    result.index.name = design_col
+    logging.info(f"Compared the triples of {len(result)} designs.")
+    return result.reset_index()
+
+
+def category_counts(per_design: pd.DataFrame):
+    """Number and share of designs per `compare_lists` category."""
+    counts = per_design["comparison_result"].value_counts().reindex(list(CATEGORY_NAMES), fill_value=0)
+    return pd.DataFrame({
+        "category": [CATEGORY_NAMES[category] for category in counts.index],
+        "designs": counts.to_numpy(),
+        "share": safe_ratio(counts.to_numpy(), len(per_design)),
+    }, index=counts.index.rename("comparison_result"))
+
+
+def scores(per_design: pd.DataFrame):
+    """Micro scores over all distinct triples and macro scores averaged over designs."""
+    tp = per_design["tp"].sum()
+    micro_precision = float(safe_ratio(tp, per_design["n_pred_unique"].sum()))
+    micro_recall = float(safe_ratio(tp, per_design["n_gt_unique"].sum()))
+    return {
+        "designs": len(per_design),
+        "micro": {"precision": micro_precision, "recall": micro_recall, "f1": float(f1_score(micro_precision, micro_recall))},
+        "macro": {metric: float(per_design[metric].mean()) if len(per_design) else 0.0
+                  for metric in ("precision", "recall", "f1")},
+    }
+
+
+def class_scores(predictions: pd.DataFrame,
+                 ground_truth: pd.DataFrame,
+                 class_col: str="p",
+                 design_col: str="design_id",
+                 columns: tuple=TRIPLE_COLUMNS):
+    """Precision, recall and F1 per value of `class_col`, e.g. per predicate or subject class.
+
+    Counted over distinct triples of the designs present in both frames, so the `tp`,
+    `n_pred` and `n_gt` columns add up to the micro counts of `scores`.
+    """
+    columns = list(columns)
+    keys = [design_col] + columns
+    designs = np.intersect1d(predictions[design_col].unique(), ground_truth[design_col].unique())
+    pred = predictions[predictions[design_col].isin(designs)].drop_duplicates(keys)
+    gt = ground_truth[ground_truth[design_col].isin(designs)].drop_duplicates(keys)
+    pred_ids, gt_ids = encode_triples(pred, gt, design_col, columns)
+    is_tp = pd.MultiIndex.from_arrays([pred_ids["design"], pred_ids["triple"]]).isin(
+        pd.MultiIndex.from_arrays([gt_ids["design"], gt_ids["triple"]]))
+
+    result = pd.DataFrame({
+        "tp": pd.Series(is_tp, index=pred.index).groupby(pred[class_col].to_numpy()).sum(),
+        "n_pred": pred.groupby(class_col).size(),
+        "n_gt": gt.groupby(class_col).size(),
+    }).fillna(0).astype(int)
+    result["precision"] = safe_ratio(result["tp"], result["n_pred"])
+    result["recall"] = safe_ratio(result["tp"], result["n_gt"])
+    result["f1"] = f1_score(result["precision"], result["recall"])
+    result.index.name = class_col
+    return result.sort_values("n_gt", ascending=False)
+
+
+def aggregate_triples(triples: pd.DataFrame,
+                      group_cols: list=("design_id", "design_en"),
+                      columns: tuple=TRIPLE_COLUMNS,
+                      name: str="l_spo_short"):
+    """The triples of each group as a list of tuples, the `l_spo_*` columns of the notebook."""
+    group_cols = list(group_cols)
+    tuples = pd.Series(list(zip(*(triples[column] for column in columns))), index=triples.index, name=name)
+    return tuples.groupby([triples[column] for column in group_cols], sort=True).agg(list).reset_index()
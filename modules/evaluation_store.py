@@ -0,0 +1,167 @@
+import sqlite3
+import logging
+import pandas as pd
+
+from pathlib import Path
+from contextlib import closing
+
+from modules import evaluation
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS design_scores (
+    design_id INTEGER PRIMARY KEY,
+    pred_hash TEXT NOT NULL,
+    gt_hash TEXT NOT NULL,
+    n_pred INTEGER NOT NULL,
+    n_gt INTEGER NOT NULL,
+    n_pred_unique INTEGER NOT NULL,
+    n_gt_unique INTEGER NOT NULL,
+    tp INTEGER NOT NULL,
+    comparison_result REAL NOT NULL,
+    precision REAL NOT NULL,
+    recall REAL NOT NULL,
+    f1 REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+SCORE_COLUMNS = ("n_pred", "n_gt", "n_pred_unique", "n_gt_unique", "tp", "comparison_result", "precision", "recall", "f1")
+
+# Sums kept in `totals`, from which the global metrics are derived
+SUM_COLUMNS = ("tp", "n_pred_unique", "n_gt_unique", "precision", "recall", "f1")
+
+
+def _category_key(category):
+    return f"category:{float(category)}"
+
+
+def _totals_delta(rows: pd.DataFrame, sign: int):
+    delta = {"designs": sign * len(rows)}
+    for column in SUM_COLUMNS:
+        delta[column] = sign * float(rows[column].sum())
+    for category, count in rows["comparison_result"].value_counts().items():
+        delta[_category_key(category)] = sign * int(count)
+    return delta
+
+
+class EvaluationStore():
+    """Per-design evaluation results, re-scored only for designs whose triples changed.
+
+    Every design is stored with a hash of its predicted and of its ground-truth triples
+    (see `evaluation.design_hashes`). `update` hashes the current triples, re-scores
+    only the designs whose hashes differ from the stored ones, and applies the difference
+    to running totals, so the global metrics never need a pass over all designs.
+    """
+
+    def __init__(self, db_path: Path=Path("./data/results/tmp/evaluation.sqlite")):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def __len__(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM design_scores").fetchone()[0]
+
+    def update(self,
+               predictions: pd.DataFrame,
+               ground_truth: pd.DataFrame,
+               design_col: str="design_id",
+               columns: tuple=evaluation.TRIPLE_COLUMNS):
+        """Bring the stored results up to date with the given triples; returns the re-scored designs.
+
+        Designs present in both frames are scored, as in `evaluation.compare_designs`;
+        stored designs missing from either frame are removed.
+        """
+        hashes = pd.concat([evaluation.design_hashes(predictions, design_col, columns).rename("pred_hash"),
+                            evaluation.design_hashes(ground_truth, design_col, columns).rename("gt_hash")],
+                           axis=1, join="inner")
+        with closing(self._connect()) as conn:
+            stored = pd.read_sql_query("SELECT design_id, pred_hash, gt_hash FROM design_scores", conn,
+                                       index_col="design_id")
+
+        known = hashes.join(stored, rsuffix="_stored", how="left")
+        changed = known.index[(known["pred_hash"] != known["pred_hash_stored"])
+                              | (known["gt_hash"] != known["gt_hash_stored"])]
+        removed = stored.index.difference(hashes.index)
+        if len(changed) == 0 and len(removed) == 0:
+            logging.info(f"Evaluation of {len(hashes)} designs is up to date.")
+            return pd.DataFrame(columns=[design_col] + list(SCORE_COLUMNS))
+
+        rescored = evaluation.compare_designs(predictions[predictions[design_col].isin(changed)],
+                                              ground_truth[ground_truth[design_col].isin(changed)],
+                                              design_col, columns)
+        rescored = rescored.join(hashes, on=design_col)
+        outdated = [int(design_id) for design_id in stored.index.intersection(changed).append(removed)]
+
+        with closing(self._connect()) as conn, conn:
+            old_rows = self._rows(conn, outdated)
+            deltas = [_totals_delta(old_rows, -1), _totals_delta(rescored, 1)]
+            conn.executemany("DELETE FROM design_scores WHERE design_id = ?", [(design_id,) for design_id in outdated])
+            names = ["design_id", "pred_hash", "gt_hash"] + list(SCORE_COLUMNS)
+            conn.executemany(
+                f"INSERT INTO design_scores ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                rescored[[design_col] + names[1:]].astype(object).itertuples(index=False, name=None))
+            for delta in deltas:
+                conn.executemany(
+                    "INSERT INTO totals (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    delta.items())
+        logging.info(f"Re-scored {len(rescored)} of {len(hashes)} designs; removed {len(removed)}.")
+        return rescored
+
+    def _rows(self, conn, design_ids: list):
+        rows = []
+        for start in range(0, len(design_ids), 500):
+            chunk = design_ids[start:start + 500]
+            rows.append(pd.read_sql_query(
+                f"SELECT * FROM design_scores WHERE design_id IN ({', '.join('?' * len(chunk))})", conn, params=chunk))
+        return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=["design_id"] + list(SCORE_COLUMNS))
+
+    def totals(self):
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT name, value FROM totals"))
+
+    def scores(self):
+        """Micro and macro scores like `evaluation.scores`, from the running totals."""
+        totals = self.totals()
+        designs = int(round(totals.get("designs", 0)))
+        micro_precision = float(evaluation.safe_ratio(totals.get("tp", 0), totals.get("n_pred_unique", 0)))
+        micro_recall = float(evaluation.safe_ratio(totals.get("tp", 0), totals.get("n_gt_unique", 0)))
+        return {
+            "designs": designs,
+            "micro": {"precision": micro_precision, "recall": micro_recall,
+                      "f1": float(evaluation.f1_score(micro_precision, micro_recall))},
+            "macro": {metric: totals.get(metric, 0.0) / designs if designs else 0.0
+                      for metric in ("precision", "recall", "f1")},
+        }
+
+    def category_counts(self):
+        """Number and share of designs per category, like `evaluation.category_counts`."""
+        totals = self.totals()
+        counts = [int(round(totals.get(_category_key(category), 0))) for category in evaluation.CATEGORY_NAMES]
+        designs = int(round(totals.get("designs", 0)))
+        return pd.DataFrame({
+            "category": list(evaluation.CATEGORY_NAMES.values()),
+            "designs": counts,
+            "share": evaluation.safe_ratio(counts, designs),
+        }, index=pd.Index(list(evaluation.CATEGORY_NAMES), name="comparison_result"))
+
+    def read(self):
+        """All stored per-design results, as returned by `evaluation.compare_designs`."""
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query("SELECT * FROM design_scores ORDER BY design_id", conn)
+
+    def rebuild_totals(self):
+        """Recompute the running totals from the stored rows, e.g. to clear float drift."""
+        with closing(self._connect()) as conn, conn:
+            rows = pd.read_sql_query("SELECT * FROM design_scores", conn)
+            conn.execute("DELETE FROM totals")
+            conn.executemany("INSERT INTO totals (name, value) VALUES (?, ?)", _totals_delta(rows, 1).items())
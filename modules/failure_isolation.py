@@ -0,0 +1,188 @@
+import time
+import httpx
+import random
+import openai
+import asyncio
+import logging
+import pandas as pd
+
+from dataclasses import dataclass
+
+from modules.prompts import PromptBatches
+from modules.lenient_json import LenientJSONError
+from modules.compact_format import CompactFormatError
+
+
+# Status codes worth retrying besides the 5xx range
+TRANSIENT_STATUS_CODES = (408, 409, 429)
+# Responses that could not be decoded
+DECODE_ERRORS = (LenientJSONError, CompactFormatError)
+# API errors that no retry or smaller prompt can fix, like a wrong API key
+FATAL_API_ERRORS = (openai.AuthenticationError, openai.PermissionDeniedError)
+
+
+def is_prompt_failure(error: Exception):
+    """True for failures of a single prompt: API errors, connection problems and undecodable responses.
+
+    These are retried, split or recorded as dead letters; anything else is a bug or a
+    misconfiguration that would fail every prompt alike, and stops the run.
+    """
+    if isinstance(error, FATAL_API_ERRORS):
+        return False
+    return isinstance(error, (openai.APIError, httpx.TransportError) + DECODE_ERRORS)
+
+
+def is_transient(error: Exception):
+    """True for connection problems, timeouts, rate limits and server errors."""
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in TRANSIENT_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def is_splittable(error: Exception):
+    """True for failures a smaller prompt may avoid: undecodable responses and rejected requests."""
+    return isinstance(error, DECODE_ERRORS + (openai.BadRequestError,))
+
+
+@dataclass
+class RetryPolicy:
+    """When to retry a prompt of the chat executors.
+
+    Transient API errors (see `is_transient`) are retried up to `max_attempts` times with
+    exponential backoff from `base_delay` to `max_delay` seconds, randomised by `jitter`;
+    a longer `retry-after` of a rate limit response is respected. An undecodable response
+    of a prompt that cannot be split is requested again up to `parse_attempts` times.
+    The executors turn off the retries of the OpenAI client, so `max_attempts` bounds the
+    requests of one prompt.
+    """
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    backoff: float = 2.0
+    jitter: float = 0.25
+    parse_attempts: int = 2
+
+    def next_delay(self, error: Exception, attempt: int, splittable: bool=False):
+        """Seconds to wait before retrying after failed attempt number `attempt`, or None to give up."""
+        if is_transient(error):
+            if attempt >= self.max_attempts:
+                return None
+            delay = min(self.base_delay * self.backoff ** (attempt - 1), self.max_delay)
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+            response = getattr(error, "response", None)
+            try:
+                retry_after = float(response.headers.get("retry-after")) if response is not None else None
+            except (TypeError, ValueError):
+                retry_after = None
+            return max(delay, retry_after or 0)
+        if isinstance(error, DECODE_ERRORS) and not splittable and attempt < self.parse_attempts:
+            return 0.0
+        return None
+
+
+@dataclass
+class PromptTask:
+    """A prompt to send: one of a step's prompts, or a part of one split after a failure.
+
+    `part` is the path of halves from the original prompt, e.g. (1, 0) for the first half
+    of its second half; results are ordered by (`prompt_idx`, `part`).
+    """
+    prompt_idx: int
+    prompt: object
+    rows: pd.DataFrame = None
+    part: tuple = ()
+
+    @property
+    def key(self):
+        return (self.prompt_idx,) + self.part
+
+    @property
+    def label(self):
+        return ".".join(str(index) for index in self.key)
+
+
+def run_with_retry(attempt, retry: RetryPolicy, splittable: bool=False, label: str=""):
+    """Call `attempt()` until it succeeds or `retry` gives up; returns (result, error, attempts).
+
+    Only failures of the prompt itself (see `is_prompt_failure`) are caught; others propagate.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return attempt(), None, attempts
+        except Exception as e:
+            if not is_prompt_failure(e):
+                raise
+            delay = retry.next_delay(e, attempts, splittable)
+            if delay is None:
+                return None, e, attempts
+            logging.warning(f"Prompt {label} attempt {attempts} failed ({type(e).__name__}: {e}); "
+                            f"retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+async def run_with_retry_async(attempt, retry: RetryPolicy, splittable: bool=False, label: str=""):
+    """`run_with_retry` for a coroutine function `attempt`."""
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return await attempt(), None, attempts
+        except Exception as e:
+            if not is_prompt_failure(e):
+                raise
+            delay = retry.next_delay(e, attempts, splittable)
+            if delay is None:
+                return None, e, attempts
+            logging.warning(f"Prompt {label} attempt {attempts} failed ({type(e).__name__}: {e}); "
+                            f"retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+def task_rows(task: PromptTask, source: PromptBatches=None):
+    if task.rows is not None or source is None:
+        return task.rows
+    return source.rows(task.prompt_idx)
+
+
+def can_split(task: PromptTask, source: PromptBatches=None):
+    rows = task_rows(task, source)
+    return rows is not None and len(rows) > 1
+
+
+def isolate_failure(task: PromptTask,
+                    error: Exception,
+                    attempts: int,
+                    step: str=None,
+                    source: PromptBatches=None,
+                    dead_letters=None,
+                    failures: list=None,
+                    response: str=None):
+    """Split a failed task into two smaller ones, or record it as failed for good.
+
+    Splitting needs the `source` the prompts were built from and an error a smaller
+    prompt may avoid (see `is_splittable`). Otherwise the task is appended to `failures`
+    and added to the `DeadLetterStore`. Returns the new tasks to run.
+    """
+    rows = task_rows(task, source)
+    if is_splittable(error) and source is not None and rows is not None:
+        halves = source.split(rows)
+        if halves is not None:
+            logging.warning(f"Prompt {task.label} failed ({type(error).__name__}: {error}); "
+                            f"splitting its {len(rows)} rows in two")
+            return [PromptTask(task.prompt_idx, source.prompt(half), half, task.part + (index,))
+                    for index, half in enumerate(halves)]
+
+    design_ids = source.design_ids(rows) if source is not None and rows is not None else []
+    part = ".".join(str(index) for index in task.part)
+    logging.error(f"Prompt {task.label} of step {step} failed after {attempts} attempts: "
+                  f"{type(error).__name__}: {error}")
+    if failures is not None:
+        failures.append({"step": step, "prompt_idx": task.prompt_idx, "part": part, "design_ids": design_ids,
+                         "attempts": attempts, "error_type": type(error).__name__, "error": str(error)})
+    if dead_letters is not None:
+        dead_letters.add(step, task.prompt_idx, design_ids, attempts, error, task.prompt, response, part)
+    return []
@@ -0,0 +1,290 @@
+import re
+import json
+import logging
+
+from json.decoder import scanstring
+
+
+class LenientJSONError(ValueError):
+    """Raised when a completion cannot be decoded even leniently."""
+
+
+class _Truncated(LenientJSONError):
+    def __init__(self):
+        super().__init__("The text ends inside an object or array.")
+
+
+# Whitespace, comments and code fences between tokens. Comments are only recognised here,
+# between tokens; "#" followed by a digit starts a value like "#1".
+SKIP_RE = re.compile(r"(?:\s+|//[^\n]*|\#(?!\d)[^\n]*|```[A-Za-z]*)+")
+# Scalar tokens; punctuation and double-quoted strings are handled before this is tried
+TOKEN_RE = re.compile(r"""
+    (?P<dstring>"[^"\\]*(?:\\.[^"\\]*)*")
+  | (?P<sstring>'[^'\\\n]*(?:\\.[^'\\\n]*)*')
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?(?![^\s,:{}\[\]()"']))
+  | (?P<bare>[^\s,:{}\[\]()"']+(?:[ \t]+[^\s,:{}\[\]()"'/\#]+)*)
+  | (?P<error>.)
+""", re.VERBOSE | re.DOTALL)
+
+SKIP_START = frozenset(" \t\r\n/#`")
+PUNCT = frozenset("{}[](),:")
+
+# Fast paths of `_Parser.object`: a quoted or identifier key with its colon, and the comma
+# after a value, with whitespace and comments around them as in SKIP_RE
+GAP = r"(?:\s+|//[^\n]*|\#(?!\d)[^\n]*)*"
+# and, as "value", the start of a value the C scanner may read; a number ("number") must be
+# followed by one of VALUE_ENDS
+KEY_RE = re.compile(GAP + r"""(?:"([^"\\\n]*)"|([A-Za-z_]\w*))[ \t]*:""" + GAP
+                    + r"""(?P<value>(?=["\[{])|(?P<number>(?=-?\d)))?""")
+COMMA_RE = re.compile(GAP + ",")
+VALUE_ENDS = (" ", "\t", "\r", "\n", ",", "}", "]")
+# A bare word in value position, which may contain ":", "//" and "#" as in URLs or "#1"; "//"
+# after whitespace and "#" before whitespace start a comment and end the value
+VALUE_WORD = r"""(?:[^\s,{}\[\]()"'/\#]|/(?!/)|(?<!\s)//|\#(?!\s))+"""
+VALUE_BARE_RE = re.compile(VALUE_WORD + r"(?:[ \t]+" + VALUE_WORD + r")*")
+
+BARE_LITERALS = {
+    "true": True,
+    "false": False,
+    "null": None,
+    "True": True,
+    "False": False,
+    "None": None,
+}
+
+CLOSERS = {"[": "]", "(": ")"}
+
+
+def _decode_dstring(token: str):
+    try:
+        return json.loads(token)
+    except json.JSONDecodeError:
+        # Raw newlines or invalid escape sequences; keep the raw text
+        return token[1:-1]
+
+
+def _decode_sstring(token: str):
+    inner = token[1:-1]
+    if "\\" not in inner:
+        return inner
+    inner = inner.replace("\\'", "'")
+    try:
+        return json.loads('"' + re.sub(r'(?<!\\)"', r'\\"', inner) + '"')
+    except json.JSONDecodeError:
+        return inner
+
+
+def _decode_number(token: str):
+    if "." in token or "e" in token or "E" in token:
+        return float(token)
+    return int(token)
+
+
+# Decoders per scalar token kind; "string" tokens are decoded while scanning
+SCALARS = {
+    "string": lambda value: value,
+    "dstring": _decode_dstring,
+    "sstring": _decode_sstring,
+    "number": _decode_number,
+    "bare": lambda token: BARE_LITERALS.get(token, token),
+}
+
+
+class _Parser():
+    """Recursive-descent parser over a token stream read directly from the text.
+
+    Every object or array is first handed to the C decoder of the `json` module; one that
+    is not valid JSON is walked token by token, its nested containers again trying the C
+    decoder first. Comments are only recognised between tokens, never inside a string or a
+    bare value, so the text is read once from left to right.
+    """
+
+    def __init__(self, text: str, int_keys: tuple, allow_truncated: bool):
+        self.text = text
+        self.end = len(text)
+        self.pos = 0
+        self.int_keys = int_keys
+        self.allow_truncated = allow_truncated
+        self.truncated = False
+        self.decoder = json.JSONDecoder(object_hook=self.coerce if int_keys else None)
+        self.scan_once = self.decoder.scan_once
+        self._token = None
+
+    def coerce(self, obj: dict):
+        for key in self.int_keys:
+            value = obj.get(key)
+            if isinstance(value, str) and value.strip().isdigit():
+                obj[key] = int(value)
+        return obj
+
+    def peek(self):
+        """The next (kind, token, start, end), without consuming it; kind is None at the end."""
+        if self._token is not None and self._token[2] == self.pos:
+            return self._token
+        text = self.text
+        pos = self.pos
+        if pos < self.end and text[pos] in SKIP_START:
+            match = SKIP_RE.match(text, pos)
+            if match is not None:
+                pos = match.end()
+        self.pos = pos
+        if pos >= self.end:
+            self._token = (None, "", pos, pos)
+            return self._token
+
+        char = text[pos]
+        if char in PUNCT:
+            self._token = (char, char, pos, pos + 1)
+            return self._token
+        if char == '"':
+            try:
+                value, end = scanstring(text, pos + 1, False)
+                self._token = ("string", value, pos, end)
+                return self._token
+            except json.JSONDecodeError:
+                pass
+        match = TOKEN_RE.match(text, pos)
+        self._token = (match.lastgroup, match.group(), pos, match.end())
+        return self._token
+
+    def advance(self):
+        self.pos = self._token[3]
+
+    def value(self):
+        kind, token, start, _ = self.peek()
+        if kind == "{" or kind == "[":
+            try:
+                value, self.pos = self.decoder.raw_decode(self.text, start)
+                return value
+            except json.JSONDecodeError:
+                pass
+            self.advance()
+            return self.object() if kind == "{" else self.array(kind)
+        if kind == "(":
+            self.advance()
+            return self.array(kind)
+        if kind == "bare" or (kind == "number" and self.text.startswith(":", self._token[3])):
+            # Re-read in value position, where ":", "//" and "#" may be part of the word, as in "12:30"
+            match = VALUE_BARE_RE.match(self.text, start)
+            self.pos = max(match.end(), self._token[3]) if match is not None else self._token[3]
+            token = self.text[start:self.pos]
+            return BARE_LITERALS.get(token, token)
+        if kind in SCALARS:
+            self.advance()
+            return SCALARS[kind](token)
+        if kind is None:
+            raise _Truncated()
+        raise LenientJSONError(f"Unexpected token {token!r} at position {start}")
+
+    def array(self, opener: str):
+        closer = CLOSERS[opener]
+        items = []
+        while True:
+            kind = self.peek()[0]
+            if kind is None:
+                if self.allow_truncated:
+                    self.truncated = True
+                    return items
+                raise _Truncated()
+            if kind == closer:
+                self.advance()
+                return items
+            if kind in (",", ":", "error", "}", "]", ")"):
+                # Stray separators and mismatched closers are skipped
+                self.advance()
+                continue
+            try:
+                items.append(self.value())
+            except _Truncated:
+                if not self.allow_truncated:
+                    raise
+                # Keep the complete items and drop the one cut off by the end of the text
+                self.truncated = True
+                return items
+
+    def object(self):
+        obj = {}
+        text = self.text
+        while True:
+            match = KEY_RE.match(text, self.pos)
+            if match is not None:
+                # Fast path for a plain key and colon
+                key = match.group(1) if match.group(1) is not None else match.group(2)
+                self.pos = match.end()
+                scannable = match.group("value") is not None
+                number = scannable and match.group("number") is not None
+            else:
+                kind, token, start, _ = self.peek()
+                if kind is None:
+                    raise _Truncated()
+                if kind == "}":
+                    self.advance()
+                    return self.coerce(obj)
+                if kind in (",", "error"):
+                    self.advance()
+                    continue
+                if kind not in SCALARS:
+                    raise LenientJSONError(f"Unexpected token {token!r} as object key at position {start}")
+                self.advance()
+                key = token if kind == "bare" else str(SCALARS[kind](token))
+                if self.peek()[0] == ":":
+                    self.advance()
+                scannable = number = False
+            if scannable:
+                # Fast path for a valid JSON string, array, object or number, read by the C scanner
+                try:
+                    value, end = self.scan_once(text, self.pos)
+                except (json.JSONDecodeError, StopIteration):
+                    value, end = None, None
+                if end is not None and (not number or text.startswith(VALUE_ENDS, end) or end == self.end):
+                    obj[key] = value
+                    self.pos = end
+                else:
+                    obj[key] = self.value()
+            else:
+                kind = self.peek()[0]
+                if kind is None:
+                    raise _Truncated()
+                if kind in (",", "}"):
+                    obj[key] = None
+                    continue
+                obj[key] = self.value()
+            match = COMMA_RE.match(text, self.pos)
+            if match is not None:
+                self.pos = match.end()
+
+    def document(self):
+        """Parse every top-level object, array or tuple; arrays are flattened, anything else is skipped."""
+        result = []
+        while True:
+            kind = self.peek()[0]
+            if kind is None:
+                return result
+            if kind not in ("{", "[", "("):
+                self.advance()
+                continue
+            value = self.value()
+            if isinstance(value, list):
+                result.extend(value)
+            else:
+                result.append(value)
+
+
+def loads(text: str, int_keys: tuple=("design_id",), allow_truncated: bool=False):
+    """Decode an LLM completion into a list of Python objects in a single pass.
+
+    Tolerates code fences, `//` and `#` comments between tokens, unquoted keys and
+    bare-word values (which keep URLs and labels like "#1"), single-quoted strings, trailing or missing commas, tuples, prose around the JSON and
+    several concatenated objects or arrays, which are merged into one list. Digit strings
+    under `int_keys` are converted to int. With `allow_truncated`, an object cut off by
+    the end of the text is dropped instead of raising.
+    """
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    parser = _Parser(text, tuple(int_keys or ()), allow_truncated)
+    result = parser.document()
+    if parser.truncated:
+        logging.warning(f"Truncated completion; kept {len(result)} complete items.")
+    if not result and text.strip():
+        raise LenientJSONError("No JSON object or array found in the text.")
+    return result
@@ -1,9 +1,6 @@
 import sys
 import pandas as pd
-import swifter
-import ast
 import logging
-import tqdm
 from pathlib import Path
 from dataclasses import dataclass
 import warnings
@@ -18,14 +15,31 @@ repo_dir = Path().resolve()  # Use current directory for relative pathing
 # Append the appropriate directory for modules
 sys.path.append(str(repo_dir / 'libs' / 'NLP_on_multilingual_coin_datasets'))
 
-# Import necessary modules from `cnt`
-from NLP_on_multilingual_coin_datasets.cnt.io import Database_Connection
-from NLP_on_multilingual_coin_datasets.cnt.annotate import annotate_designs
-from NLP_on_multilingual_coin_datasets.cnt.preprocess import Preprocess
+# Import necessary modules from `cnt`; the file source works without them
+try:
+    from NLP_on_multilingual_coin_datasets.cnt.io import Database_Connection
+    from NLP_on_multilingual_coin_datasets.cnt.preprocess import Preprocess
+    from NLP_on_multilingual_coin_datasets.cnt.annotate import annotate_designs
+except ImportError:
+    Database_Connection = None
+    Preprocess = None
+    annotate_designs = None
+
+from modules import rewrite_engine, annotator
+from modules.rewrite_engine import RewriteEngine, alias_rules
+from modules.annotator import EntityAnnotator, CntAnnotator
+from modules.design_cache import DesignCache, fingerprint
+from modules.design_sources import FileSource, DatabaseSource, UNAVAILABLE_ERRORS, entity_names
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Rules added before the alias rules of the entity list
+EXTRA_RULES = {"horseman": "horse man", "horsemen": "horse men"}
+
+# Bump when the preprocessing changes in a way the fingerprint of its rules cannot see
+PREPROCESSING_VERSION = 3
+
 @dataclass
 class PreprocessingConfig:
     id_col: str = "id"
@@ -34,10 +48,15 @@ class PreprocessingConfig:
     language: str = "_en"
     add_columns: list = None
     csv_path: Path = Path("./data/source/lists/csv")
-    csv_designs_filename: str = "annotated_designs.csv"
+    csv_designs_filename: str = "annotated_designs.csv"  # its stem names the binary design cache
     json_path: Path = Path("./data/results/json")
     tmp_path: Path = Path("./data/results/tmp")
     database: str = "nlp_challenge"
+    n_jobs: int = None  # processes for rewriting designs; None uses all CPUs
+    source: str = "database"  # "database", or "files" for the entity lists in csv_path
+    designs_file: Path = None  # raw designs (CSV or JSON) for the "files" source
+    entity_class_col: str = "class"  # class column of nlp_list_entities
+    annotator: str = "cnt"  # "cnt" for the submodule's annotate_designs, or "trie" for `EntityAnnotator`
 
     def __post_init__(self):
         if self.add_columns is None:
@@ -50,66 +69,97 @@ class LoadingPreprocessedDesigns():
 
         self.id_col = self.prep_cfg.id_col
         self.design_col = self.prep_cfg.design_col
-
-    def load_designs_csv_or_process_database(self):
-        csv_filepath = f"{self.prep_cfg.csv_path}/{self.prep_cfg.csv_designs_filename}"
-        logging.info(f"Checking if file {csv_filepath} exists.")
-        if Path(csv_filepath).is_file():
-            df_designs = pd.read_csv(csv_filepath)
-            if type(df_designs.annotations.iloc[0]) == str:
-                logging.info("Converting annotations to list.")
-                df_designs['annotations'] = df_designs['annotations'].apply(ast.literal_eval)
-            logging.info("File exists and was loaded.")
-        else:
-            logging.info("File does not exist. Loading from database and running preprocessing.")
+        self.source = self.build_source()
+        self._warned_fallback = False
+
+    def build_source(self):
+        """The `DesignSource` selected by `prep_cfg.source`; "files" needs no database connection."""
+        cfg = self.prep_cfg
+        if cfg.source == "files":
+            return FileSource(cfg.csv_path, cfg.designs_file, language=cfg.language, add_columns=cfg.add_columns)
+        if cfg.source == "database":
+            if self.dc is None:
+                raise ValueError("The database source needs a database connection; use source='files' without one.")
+            return DatabaseSource(self.dc, cfg.entity_class_col, language=cfg.language, add_columns=cfg.add_columns)
+        raise ValueError(f"Unknown design source: {cfg.source}")
+
+    def load_designs_csv_or_process_database(self, refresh: bool=False):
+        """Load the preprocessed designs from the design cache, rebuilding it when its sources changed.
+
+        The cache is valid for a fingerprint over the state of the source designs and entity
+        lists (see `DesignSource.version`) and the preprocessing rules, so a valid cache
+        loads without reading the sources. If the sources cannot be reached (see
+        `design_sources.UNAVAILABLE_ERRORS`), the cached designs are used with a warning.
+        `refresh` rebuilds the cache regardless, e.g. after in-place edits the source state
+        does not reveal: the database tables' update time is NULL until they change and does
+        not survive an InnoDB restart (see `DatabaseSource.version`).
+        """
+        cache = DesignCache(Path(self.prep_cfg.csv_path) / self.prep_cfg.csv_designs_filename)
+        try:
+            sources_fingerprint = self.sources_fingerprint()
+        except UNAVAILABLE_ERRORS as e:
+            df_designs = cache.load(None)
+            if df_designs is None:
+                raise
+            logging.warning(f"Design sources unavailable ({e}); using the cached designs without checking them.")
+            return df_designs
+
+        df_designs = None if refresh else cache.load(sources_fingerprint)
+        if df_designs is None:
+            logging.info("Running preprocessing.")
             df_designs = self.preprocess_designs()
-
-            Path(self.prep_cfg.csv_path).mkdir(parents=True, exist_ok=True)
-            df_designs.to_csv(csv_filepath, index=False)
-            logging.info(f"Preprocessed designs saved to {csv_filepath}.")
+            cache.save(df_designs, sources_fingerprint)
 
         return df_designs
 
-    def preprocess_designs(self):
+    def load_sources(self):
+        """Source designs and entity lists from the configured source, as used by `preprocess_designs`."""
+        return self.source.load_sources(self.id_col, self.design_col)
+
+    def sources_fingerprint(self):
+        rules = {
+            "version": PREPROCESSING_VERSION,
+            "extra_rules": EXTRA_RULES,
+            "language": self.prep_cfg.language,
+            "add_columns": self.prep_cfg.add_columns,
+            "roman_numerals": rewrite_engine.ROMAN_NUMERALS,
+            "strip_chars": rewrite_engine.STRIP_CHARS,
+            "annotator": self.annotator_name(),
+            "token_pattern": annotator.TOKEN_RE.pattern,
+        }
+        return fingerprint(self.prep_cfg.source, self.source.version(self.id_col), rules)
+
+    def preprocess_designs(self, sources: dict=None):
         logging.info("Starting preprocessing of designs.")
         try:
-            df_designs_raw = self.dc.load_designs_from_db("nlp_training_designs", 
-                                                          [self.id_col, 
-                                                           self.design_col])
-
-            entities = self.load_entities()
+            if sources is None:
+                sources = self.load_sources()
+            df_designs_raw = sources["designs"]
+            entities = sources["entities"]
+            entity_annotator = self.build_annotator(entities)
 
-            annotated_designs = annotate_designs(entities, df_designs_raw, self.id_col, self.design_col)
+            annotated_designs = entity_annotator.annotate_designs(df_designs_raw, self.design_col)
             annotated_designs = annotated_designs[annotated_designs.annotations.map(len) > 0]
+            raw_designs = annotated_designs["design_en"].copy()
 
             annotated_designs["design_en_changed"] = ""
-            df_entities = self.dc.load_from_db("nlp_list_entities", self.prep_cfg.add_columns)
+            df_entities = sources["df_entities"]
 
-            preprocess = self.initialize_preprocess(df_entities)
-            annotated_designs = self.clean_design_names(annotated_designs)
+            engine = self.build_rewrite_engine(df_entities)
 
-            logging.info("Applying defined preprocessing rules to design names.")
-            annotated_designs["design_en_changed"] = annotated_designs.swifter.apply(
-                lambda row: preprocess.preprocess_design(row.design_en, row.id)[0], axis=1)
+            logging.info("Applying preprocessing rules, numerals and stripping in one pass.")
+            annotated_designs["design_en_changed"] = engine.rewrite_series(annotated_designs["design_en"], self.prep_cfg.n_jobs)
             logging.info("Completed applying preprocessing rules to design names.")
-            
-            logging.info("Deleting brackets and question marks from design names.")
-            annotated_designs["design_en_changed"] = annotated_designs.swifter.apply(
-                lambda row: row["design_en_changed"].replace("?", "").replace("(", "").replace(")", ""), axis=1)
-            logging.info("Completed deleting brackets and question marks from design names.")
 
             # Renaming columns
             annotated_designs.rename(
                 columns={"design_en": "design_en_orig", "design_en_changed": "design_en", "annotations": "annotations_orig"},
                 inplace=True)
             
-            # Re-annotate the cleaned designs
-            _designs = annotate_designs(entities, annotated_designs[["id", "design_en"]], self.id_col, self.design_col)
-            _designs = _designs[_designs.annotations.map(len) > 0]
-
-            # Merging the annotations back
-            # _designs['annotations'] = _designs['annotations'].apply(ast.literal_eval)
-            annotated_designs = annotated_designs.merge(_designs[["id", "annotations"]], on="id")
+            # Re-annotate only the designs changed by cleaning
+            annotated_designs["annotations"] = entity_annotator.reannotate(
+                raw_designs, annotated_designs["design_en"], annotated_designs["annotations_orig"])
+            annotated_designs = annotated_designs[annotated_designs.annotations.map(len) > 0].reset_index(drop=True)
 
             logging.info("Preprocessing completed successfully.")
             return annotated_designs
@@ -119,63 +169,59 @@ class LoadingPreprocessedDesigns():
             raise
 
     def load_entities(self):
-        database = self.prep_cfg.database
-        add_columns = self.prep_cfg.add_columns
-        entities = {}
+        """Names per class, {"PERSON": [...], "OBJECT": [...], ...}, from a single load of the entity table."""
         try:
-            for entity_type in ["PERSON", "OBJECT", "ANIMAL", "PLANT"]:
-                result = self.dc.load_entities_from_db_v2(
-                    f"{database}.nlp_list_entities", entity_type, add_columns, [add_columns[1]], ",", True)
-                
-                if result is None:
-                    logging.error(f"Failed to load {entity_type} entities: Received None")
-                    raise ValueError(f"Loading entities for {entity_type} returned None")
-                
-                entities[entity_type] = result
-                logging.info(f"Loaded {entity_type} entities successfully.")
-                
+            entities = entity_names(self.source.load_entity_table(), self.prep_cfg.language)
+            for entity_type, names in entities.items():
+                logging.info(f"Loaded {len(names)} {entity_type} entity names.")
             return entities
-        
+
         except Exception as e:
             logging.error(f"Error loading entities: {e}")
             raise
 
-
+    def build_annotator(self, entities: dict):
+        """The annotator selected by `prep_cfg.annotator` over the PERSON/OBJECT/ANIMAL/PLANT dictionaries of `load_entities`.
+
+        "cnt" stays the default until the token trie of `EntityAnnotator` is shown to match
+        it on the data at hand (see `annotator.annotation_parity` and benchmarks/bench_annotator.py).
+        """
+        name = self.annotator_name()
+        if name == "cnt":
+            return CntAnnotator(entities, self.id_col, self.design_col)
+        if name == "trie":
+            return EntityAnnotator(entities)
+        raise ValueError(f"Unknown annotator: {name}")
+
+    def annotator_name(self):
+        """`prep_cfg.annotator`, or "trie" when "cnt" is asked for but the submodule is missing.
+
+        The fallback changes the cache fingerprint, so it is logged once per loader.
+        """
+        if self.prep_cfg.annotator == "cnt" and annotate_designs is None:
+            if not self._warned_fallback:
+                logging.warning("The `cnt` submodule is not available; annotating with the token trie instead.")
+                self._warned_fallback = True
+            return "trie"
+        return self.prep_cfg.annotator
+
+    def alias_rules(self, df_entities: pd.DataFrame):
+        """Standard name of every alternative name in `df_entities`, plus `EXTRA_RULES`."""
+        return alias_rules(df_entities, self.prep_cfg.language, EXTRA_RULES)
+
+    def build_rewrite_engine(self, df_entities: pd.DataFrame):
+        logging.info("Compiling rewrite rules from entities.")
+        engine = RewriteEngine(self.alias_rules(df_entities))
+        logging.info(f"Compiled {len(engine.rules)} rewrite rules.")
+        return engine
 
     def initialize_preprocess(self, df_entities: pd.DataFrame):
+        """A `cnt` `Preprocess` holding the same rules as `build_rewrite_engine`."""
+        if Preprocess is None:
+            raise ImportError("initialize_preprocess requires the `cnt` submodule in libs/NLP_on_multilingual_coin_datasets.")
         preprocess = Preprocess()
-        preprocess.add_rule("horseman", "horse man")
-        preprocess.add_rule("horsemen", "horse men")
-
         logging.info("Adding rules from entities.")
-        for _, row in tqdm.tqdm(df_entities.iterrows(), total=df_entities.shape[0], desc="Initializing Preprocess"):
-            if row["alternativenames_en"] is not None:
-                standard_name = row["name_en"]
-                alt_names = row["alternativenames_en"].split(", ")
-                for alt_name in alt_names:
-                    preprocess.add_rule(alt_name, standard_name)
-
-        for rule in list(preprocess.rules):
-            if " I." in rule or " II." in rule or " III." in rule or " IV." in rule or " V." in rule:
-                del preprocess.rules[rule]
-        
+        for search, replace in self.alias_rules(df_entities).items():
+            preprocess.add_rule(search, replace)
         logging.info("Completed adding rules from entities.")
         return preprocess
-
-
-    def clean_design_names(self, annotated_designs):
-            logging.info("Cleaning design names.")
-            for index, row in annotated_designs.iterrows():
-                if " I." in row["design_en"]:
-                    annotated_designs.at[index, "design_en"] = row["design_en"].replace(" I.", " I")
-                if " II." in row["design_en"]:
-                    annotated_designs.at[index, "design_en"] = row["design_en"].replace(" II.", " II")
-                if " III." in row["design_en"]:
-                    annotated_designs.at[index, "design_en"] = row["design_en"].replace(" III.", " III")
-                if " IV." in row["design_en"]:
-                    annotated_designs.at[index, "design_en"] = row["design_en"].replace(" IV.", " IV")
-                if " V." in row["design_en"]:
-                    annotated_designs.at[index, "design_en"] = row["design_en"].replace(" V.", " V")
-
-            logging.info("Completed cleaning design names.")
-            return annotated_designs
\ No newline at end of file
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import logging
+import threading
+import numpy as np
+
+from pathlib import Path
+from contextlib import contextmanager
+
+
+# Values observed once per request or batch task: name -> (Prometheus name, help text)
+OBSERVATIONS = {
+    "queue_time": ("queue_time_seconds", "Time from submitting a prompt until its request was sent."),
+    "time_to_first_token": ("time_to_first_token_seconds", "Time from sending a request until the first content arrived."),
+    "latency": ("latency_seconds", "Time from sending a request until its response was complete."),
+    "tokens_per_second": ("completion_tokens_per_second", "Completion tokens per second of generation."),
+    "parse_time": ("parse_time_seconds", "Time spent decoding a response into records."),
+}
+
+COUNTERS = {
+    "requests": ("requests_total", "Completed requests or batch tasks."),
+    "errors": ("errors_total", "Requests or batch tasks that failed or could not be decoded."),
+    "client_retries": ("client_retries_total", "Retries of requests by the API client."),
+    "task_retries": ("task_retries_total", "Attempts of a prompt beyond its first, made by the executors' retry policy."),
+    "cache_hits": ("cache_hits_total", "Prompts answered from the response cache."),
+    "prompt_tokens": ("prompt_tokens_total", "Prompt tokens reported by the API."),
+    "completion_tokens": ("completion_tokens_total", "Completion tokens reported by the API."),
+    "cached_tokens": ("cached_prompt_tokens_total", "Prompt tokens served from the provider's prompt cache."),
+}
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _describe(values: list):
+    values = np.asarray(values, dtype=float)
+    description = {"count": int(len(values)), "sum": float(values.sum()), "mean": float(values.mean()),
+                   "max": float(values.max())}
+    for quantile in QUANTILES:
+        description[f"p{int(quantile * 100)}"] = float(np.quantile(values, quantile))
+    return description
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _write_atomic(path: Path, text: str):
+    # Written next to the target and renamed, so scrapers never read a partial file
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+    return path
+
+
+class PipelineMetrics():
+    """Per-request timings and token usage of the chat and batch paths, per step and API mode.
+
+    The chat functions record, for every request, the queue time, time to first token,
+    total latency, generation speed, token usage and client retries; the executors count
+    the further attempts of a prompt as task retries, and parsing records the time spent
+    decoding every response. Batch jobs add their queue and total time per job
+    (see `record_batch_job`). Safe to share between threads.
+
+    `summary` returns the aggregates as a dict (`write_json`), `to_prometheus` renders them
+    in the Prometheus text format for the node exporter's textfile collector (`write_prometheus`).
+    """
+
+    def __init__(self, namespace: str="re_pipeline"):
+        self.namespace = namespace
+        self.started_at = time.time()
+        self._observations = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, step: str, api_mode: str, name: str, value: float):
+        if value is None:
+            return
+        with self._lock:
+            self._observations.setdefault((str(step), api_mode, name), []).append(float(value))
+
+    def increment(self, step: str, api_mode: str, name: str, value: float=1):
+        with self._lock:
+            key = (str(step), api_mode, name)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, step: str, api_mode: str, name: str="parse_time"):
+        """Observe the wall time of the enclosed block as `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(step, api_mode, name, time.perf_counter() - start)
+
+    def record_usage(self, step: str, api_mode: str, usage: dict):
+        """Add the token counts of a usage dict as returned by `chat_executor.stream_chat_completion`."""
+        if not usage:
+            return
+        self.increment(step, api_mode, "prompt_tokens", usage.get("input_tokens", 0))
+        self.increment(step, api_mode, "completion_tokens", usage.get("output_tokens", 0))
+        self.increment(step, api_mode, "cached_tokens", usage.get("cached_tokens", 0))
+
+    def record_request(self, step: str, stats: dict, api_mode: str="chat"):
+        """Record one completed chat request from the `stats` filled in by `scripts.get_chat_completion`.
+
+        `stats` holds the `enqueued_at`, `sent_at`, `first_token_at` and `finished_at` times,
+        the `client_retries` and the reported `usage`.
+        """
+        sent_at = stats["sent_at"]
+        finished_at = stats["finished_at"]
+        first_token_at = stats.get("first_token_at")
+        if stats.get("enqueued_at") is not None:
+            self.observe(step, api_mode, "queue_time", sent_at - stats["enqueued_at"])
+        if first_token_at is not None:
+            self.observe(step, api_mode, "time_to_first_token", first_token_at - sent_at)
+        self.observe(step, api_mode, "latency", finished_at - sent_at)
+
+        usage = stats.get("usage")
+        if usage:
+            generation_time = finished_at - (first_token_at if first_token_at is not None else sent_at)
+            if generation_time > 0:
+                self.observe(step, api_mode, "tokens_per_second", usage.get("output_tokens", 0) / generation_time)
+            self.record_usage(step, api_mode, usage)
+        self.increment(step, api_mode, "requests")
+        self.increment(step, api_mode, "client_retries", stats.get("client_retries") or 0)
+
+    def record_batch_job(self, step: str, status_info: dict):
+        """Record the queue time and total time of a finished batch job.
+
+        `status_info` is the dict returned by `scripts.retrieve_batch_job_status`; the queue
+        time runs until the job went in progress, the latency until it completed.
+        """
+        created_at = status_info.get("created_at")
+        if created_at is None:
+            return
+        if status_info.get("in_progress_at"):
+            self.observe(step, "batch", "queue_time", status_info["in_progress_at"] - created_at)
+        finished_at = status_info.get("completed_at") or status_info.get("failed_at") or status_info.get("expired_at")
+        if finished_at:
+            self.observe(step, "batch", "latency", finished_at - created_at)
+
+    def summary(self):
+        """Counters and per-value statistics (count, sum, mean, max, quantiles) per step and API mode."""
+        with self._lock:
+            observations = {key: list(values) for key, values in self._observations.items()}
+            counters = dict(self._counters)
+
+        groups = {}
+        for (step, api_mode, name), value in counters.items():
+            groups.setdefault((step, api_mode), {})[name] = value
+        for (step, api_mode, name), values in observations.items():
+            groups.setdefault((step, api_mode), {})[name] = _describe(values)
+
+        return {
+            "started_at": self.started_at,
+            "exported_at": time.time(),
+            "steps": [dict(step=step, api_mode=api_mode, **values) for (step, api_mode), values in sorted(groups.items())],
+        }
+
+    def write_json(self, path: Path):
+        path = _write_atomic(path, json.dumps(self.summary(), indent=4) + "\n")
+        logging.info(f"Metrics summary written to {path}.")
+        return path
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format: counters and summaries per step and API mode."""
+        summary = self.summary()
+        lines = []
+        for name, (metric, help_text) in COUNTERS.items():
+            full_name = f"{self.namespace}_{metric}"
+            samples = [(group, group[name]) for group in summary["steps"] if name in group]
+            if not samples:
+                continue
+            lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} counter"]
+            for group, value in samples:
+                labels = f'step="{_label_value(group["step"])}",api_mode="{_label_value(group["api_mode"])}"'
+                lines.append(f"{full_name}{{{labels}}} {value}")
+
+        for name, (metric, help_text) in OBSERVATIONS.items():
+            full_name = f"{self.namespace}_{metric}"
+            samples = [group for group in summary["steps"] if name in group]
+            if not samples:
+                continue
+            lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} summary"]
+            for group in samples:
+                labels = f'step="{_label_value(group["step"])}",api_mode="{_label_value(group["api_mode"])}"'
+                description = group[name]
+                for quantile in QUANTILES:
+                    lines.append(f'{full_name}{{{labels},quantile="{quantile}"}} {description[f"p{int(quantile * 100)}"]}')
+                lines.append(f"{full_name}_sum{{{labels}}} {description['sum']}")
+                lines.append(f"{full_name}_count{{{labels}}} {description['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path):
+        path = _write_atomic(path, self.to_prometheus())
+        logging.info(f"Prometheus metrics written to {path}.")
+        return path
@@ -0,0 +1,416 @@
+import re
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import pandas as pd
+
+from pathlib import Path
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from modules import compact_format
+from modules.prompts import match_template
+
+
+DESIGN_RE = re.compile(r"design_id: (\d+),")
+# Design id and s_o_id of a row of steps 1_1 (`s_o_id: "a"`), 2 and 2_1 (`SOP Id: a`)
+PAIR_RE = re.compile(r"design_id: (\d+),.*?(?:s_o_id: \"|SOP Id: )([^\",\s]+)", re.DOTALL)
+
+# Steps answered per design; the others are answered per subject-object pair
+DESIGN_STEPS = ("0", "0_1", "1")
+
+DEFAULT_VALUES = {
+    "new_list_of_strings": [],
+    "relevance": 1,
+    "correctness": 1,
+    "comment_enh": "The enhanced list includes all significant objects.",
+    "s_o_id": "a",
+    "validity_sop": 1,
+    "comment_sop": "Correct and meaningful pair.",
+    "predicate": "NULL",
+    "validity_pred": 1,
+    "comment_pred": "Correct and meaningful SPO triple.",
+    "implicit_pred": "NULL",
+}
+
+
+def approx_tokens(text: str):
+    """Rough token count (4 characters per token), so the server needs no tokenizer download."""
+    return max(1, len(text) // 4)
+
+
+class ResponseSynthesizer():
+    """Answers prompts built by `modules.prompts` with the stored results in `json_dir`.
+
+    The step and response format of a prompt are recognised from its template; the
+    design ids and subject-object pairs are read from its rows and looked up in
+    `enhanced_objects.json` (steps 0 and 0_1) and `RE_new_datachallenge.json` (steps 1 to
+    2_1). Keys without a stored result get `DEFAULT_VALUES`, so every prompt is answered.
+    """
+
+    def __init__(self, json_dir: Path=Path("./data/results/json")):
+        json_dir = Path(json_dir)
+        designs = pd.read_json(json_dir / "enhanced_objects.json")
+        self.designs = {record["design_id"]: record for record in designs.to_dict("records")}
+        triples = pd.read_json(json_dir / "RE_new_datachallenge.json").rename(columns={"p": "predicate"})
+        self.pairs = {(record["design_id"], record["s_o_id"]): record for record in triples.to_dict("records")}
+        self.pairs_by_design = {}
+        for design_id, s_o_id in self.pairs:
+            self.pairs_by_design.setdefault(design_id, []).append(s_o_id)
+
+    def _record(self, step: str, design_id: int, s_o_id: str=None):
+        stored = self.designs.get(design_id, {}) if step in ("0", "0_1") else self.pairs.get((design_id, s_o_id), {})
+        record = {}
+        for column in compact_format.get_format(step).columns:
+            if column == "design_id":
+                record[column] = design_id
+            elif column == "s_o_id" and s_o_id is not None:
+                record[column] = s_o_id
+            else:
+                value = stored.get(column)
+                missing = value is None or (isinstance(value, float) and value != value)
+                record[column] = DEFAULT_VALUES.get(column, "NULL") if missing else value
+        return record
+
+    def records(self, step: str, rows_text: str):
+        if step in DESIGN_STEPS:
+            design_ids = list(dict.fromkeys(int(design_id) for design_id in DESIGN_RE.findall(rows_text)))
+            if step != "1":
+                return [self._record(step, design_id) for design_id in design_ids]
+            return [self._record(step, design_id, s_o_id)
+                    for design_id in design_ids for s_o_id in self.pairs_by_design.get(design_id, [None])]
+        return [self._record(step, int(design_id), s_o_id) for design_id, s_o_id in PAIR_RE.findall(rows_text)]
+
+    def respond(self, prompt):
+        """The response text for a prompt string or (prefix, suffix) pair; "[]" if it is not a pipeline prompt."""
+        template = match_template(prompt)
+        if template is None:
+            return "[]"
+        records = self.records(template.step, template.rows_text(prompt))
+        if template.response_format == "compact":
+            return compact_format.dumps(records, template.step)
+        return json.dumps(records, indent=4, ensure_ascii=False)
+
+
+def prompt_from_messages(messages: list):
+    """Invert `scripts.build_messages`: a system + user message pair becomes a (prefix, suffix) prompt."""
+    if len(messages) == 2 and messages[0].get("role") == "system":
+        return (messages[0]["content"], messages[1]["content"])
+    return messages[-1]["content"] if messages else ""
+
+
+class RateLimiter():
+    """Requests and tokens per minute over a fixed one-minute window, as reported in the rate-limit headers."""
+
+    def __init__(self, requests_per_minute: int=None, tokens_per_minute: int=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._requests = 0
+        self._tokens = 0
+
+    def acquire(self, tokens: int):
+        """Count a request; returns (allowed, headers)."""
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= 60:
+                self._window_start, self._requests, self._tokens = now, 0, 0
+            reset = 60 - (now - self._window_start)
+            allowed = ((self.requests_per_minute is None or self._requests < self.requests_per_minute)
+                       and (self.tokens_per_minute is None or self._tokens + tokens <= self.tokens_per_minute))
+            if allowed:
+                self._requests += 1
+                self._tokens += tokens
+            headers = {}
+            for name, limit, used in (("requests", self.requests_per_minute, self._requests),
+                                      ("tokens", self.tokens_per_minute, self._tokens)):
+                if limit is not None:
+                    headers[f"x-ratelimit-limit-{name}"] = str(limit)
+                    headers[f"x-ratelimit-remaining-{name}"] = str(max(limit - used, 0))
+                    headers[f"x-ratelimit-reset-{name}"] = f"{reset:.3f}s"
+            if not allowed:
+                headers["retry-after"] = f"{reset:.3f}"
+            return allowed, headers
+
+
+class MockOpenAIServer():
+    """Local OpenAI-compatible server for offline end-to-end runs and throughput benchmarks.
+
+    Serves `/v1/chat/completions` (plain and streamed), `/v1/files` and `/v1/batches` with
+    responses from a `ResponseSynthesizer`. `latency` (plus up to `jitter`) seconds pass
+    before a response starts and `chunk_latency` between streamed chunks; a share
+    `error_rate` of chat requests and batch tasks fails with a server error. With
+    `requests_per_minute` / `tokens_per_minute`, rate-limit headers are sent and requests
+    over the limit get a 429 with `retry-after`. A batch completes `batch_latency` seconds
+    after it was created. Point a client at it with `OpenAI(base_url=server.base_url, api_key="mock")`.
+    """
+
+    def __init__(self,
+                 synthesizer: ResponseSynthesizer=None,
+                 latency: float=0.0,
+                 jitter: float=0.0,
+                 chunk_latency: float=0.0,
+                 chunk_chars: int=64,
+                 error_rate: float=0.0,
+                 requests_per_minute: int=None,
+                 tokens_per_minute: int=None,
+                 batch_latency: float=0.0,
+                 host: str="127.0.0.1",
+                 port: int=0,
+                 seed: int=0):
+        self.synthesizer = synthesizer or ResponseSynthesizer()
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_latency = chunk_latency
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.batch_latency = batch_latency
+        self.files = {}
+        self.batches = {}
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        logging.info(f"Mock OpenAI server listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _fails(self):
+        with self._lock:
+            return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def _delay(self):
+        with self._lock:
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def completion(self, body: dict):
+        """The response text and token usage for a chat completion request body."""
+        messages = body.get("messages", [])
+        text = self.synthesizer.respond(prompt_from_messages(messages))
+        prompt_tokens = sum(approx_tokens(message.get("content") or "") for message in messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": approx_tokens(text),
+            "total_tokens": prompt_tokens + approx_tokens(text),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        return text, usage
+
+    def add_file(self, content: bytes, filename: str, purpose: str):
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = {"content": content, "filename": filename, "purpose": purpose, "created_at": int(time.time())}
+        return self.file_object(file_id)
+
+    def file_object(self, file_id: str):
+        entry = self.files[file_id]
+        return {"id": file_id, "object": "file", "bytes": len(entry["content"]), "created_at": entry["created_at"],
+                "filename": entry["filename"], "purpose": entry["purpose"], "status": "processed"}
+
+    def create_batch(self, body: dict):
+        """Run every task of the input file now; the batch reports completion after `batch_latency`."""
+        input_file_id = body["input_file_id"]
+        outputs, errors = [], []
+        for line in self.files[input_file_id]["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            task = json.loads(line)
+            request_id = f"req_{uuid.uuid4().hex[:24]}"
+            if self._fails():
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": task["custom_id"],
+                               "response": {"status_code": 500, "request_id": request_id,
+                                            "body": {"error": {"message": "The server had an error processing your request.",
+                                                               "type": "server_error"}}},
+                               "error": None})
+                continue
+            text, usage = self.completion(task["body"])
+            outputs.append({"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": task["custom_id"],
+                            "response": {"status_code": 200, "request_id": request_id,
+                                         "body": _completion_body(task["body"].get("model"), text, usage)},
+                            "error": None})
+
+        now = int(time.time())
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        to_jsonl = lambda lines: "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body.get("endpoint"), "errors": None,
+            "input_file_id": input_file_id, "completion_window": body.get("completion_window", "24h"),
+            "status": "validating", "created_at": now, "in_progress_at": now,
+            "completed_at": None, "metadata": body.get("metadata"),
+            "output_file_id": self.add_file(to_jsonl(outputs), f"{batch_id}_output.jsonl", "batch_output")["id"] if outputs else None,
+            "error_file_id": self.add_file(to_jsonl(errors), f"{batch_id}_errors.jsonl", "batch_output")["id"] if errors else None,
+            "request_counts": {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)},
+            "_done_at": time.time() + self.batch_latency,
+        }
+        return self.batch_object(batch_id)
+
+    def batch_object(self, batch_id: str):
+        batch = dict(self.batches[batch_id])
+        done_at = batch.pop("_done_at")
+        output_file_id, error_file_id = batch["output_file_id"], batch["error_file_id"]
+        if time.time() < done_at:
+            counts = batch["request_counts"]
+            batch.update(status="in_progress", output_file_id=None, error_file_id=None,
+                         request_counts={"total": counts["total"], "completed": 0, "failed": 0})
+        else:
+            batch.update(status="completed", completed_at=int(done_at),
+                         output_file_id=output_file_id, error_file_id=error_file_id)
+        return batch
+
+
+def _completion_body(model: str, text: str, usage: dict):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": usage,
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Streamed chunks are small writes; without this they wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def log_message(self, format, *args):
+        logging.debug("mock openai: " + format, *args)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status: int, payload: dict, headers: dict=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str, error_type: str, headers: dict=None):
+        self._send_json(status, {"error": {"message": message, "type": error_type, "param": None, "code": None}}, headers)
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            return self._chat_completion(json.loads(self._body()))
+        if path.endswith("/files"):
+            return self._upload_file()
+        if path.endswith("/batches"):
+            return self._send_json(200, self.mock.create_batch(json.loads(self._body())))
+        self._send_error(404, f"Unknown path {path}", "invalid_request_error")
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in self.mock.batches:
+            return self._send_json(200, self.mock.batch_object(parts[-1]))
+        if len(parts) >= 2 and parts[-2] == "files" and parts[-1] in self.mock.files:
+            return self._send_json(200, self.mock.file_object(parts[-1]))
+        if len(parts) >= 3 and parts[-1] == "content" and parts[-3] == "files" and parts[-2] in self.mock.files:
+            content = self.mock.files[parts[-2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        self._send_error(404, f"No such object: {self.path}", "invalid_request_error")
+
+    def _upload_file(self):
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+        message = BytesParser(policy=HTTP).parsebytes(header + self._body())
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        filename, content = fields.get("file", ("upload.jsonl", b""))
+        purpose = (fields.get("purpose", (None, b"batch"))[1] or b"batch").decode("utf-8")
+        self._send_json(200, self.mock.add_file(content, filename or "upload.jsonl", purpose))
+
+    def _chat_completion(self, body: dict):
+        mock = self.mock
+        text, usage = mock.completion(body)
+        with mock._lock:
+            mock.stats["requests"] += 1
+        allowed, headers = mock.rate_limiter.acquire(usage["total_tokens"])
+        if not allowed:
+            with mock._lock:
+                mock.stats["rate_limited"] += 1
+            return self._send_error(429, "Rate limit reached.", "requests", headers)
+        mock._delay()
+        if mock._fails():
+            with mock._lock:
+                mock.stats["errors"] += 1
+            return self._send_error(500, "The server had an error processing your request.", "server_error", headers)
+
+        model = body.get("model")
+        if not body.get("stream"):
+            return self._send_json(200, _completion_body(model, text, usage), headers)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+
+        def chunk(choices, chunk_usage=None):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                       "choices": choices, "usage": chunk_usage}
+            self._write_chunk(f"data: {json.dumps(payload)}\n\n")
+
+        pieces = [text[start:start + mock.chunk_chars] for start in range(0, len(text), mock.chunk_chars)] or [""]
+        for idx, piece in enumerate(pieces):
+            delta = {"role": "assistant", "content": piece} if idx == 0 else {"content": piece}
+            chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+            if mock.chunk_latency:
+                time.sleep(mock.chunk_latency)
+        chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk([], usage)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
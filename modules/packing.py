@@ -0,0 +1,134 @@
+import math
+import logging
+import pandas as pd
+
+from dataclasses import dataclass
+
+from modules.prompts import STEP_BUILDERS, ROW_RENDERERS, get_template, get_encoding
+
+# Rough completion size per input row for each step, approximated from the results
+# stored in data/results/json. Override with `output_tokens_per_row` when a step's
+# responses change shape.
+OUTPUT_TOKENS_PER_ROW = {
+    "0": 75,
+    "0_1": 55,
+    "1": 105,
+    "1_1": 40,
+    "2": 20,
+    "2_1": 40,
+}
+
+# The same for the compact response format of `modules.compact_format`, scaled by the
+# token ratios measured with benchmarks/bench_compact_format.py
+COMPACT_OUTPUT_TOKENS_PER_ROW = {
+    "0": 20,
+    "0_1": 25,
+    "1": 26,
+    "1_1": 13,
+    "2": 5,
+    "2_1": 12,
+}
+
+
+@dataclass
+class PackingReport:
+    step: str
+    n_rows: int
+    n_prompts: int
+    n_prompts_fixed: int
+    batch_size: int
+    max_input_tokens: int
+    max_output_tokens: int
+    preamble_tokens: int
+    largest_prompt_tokens: int
+
+    @property
+    def prompts_saved(self):
+        return self.n_prompts_fixed - self.n_prompts
+
+    def __str__(self):
+        return (f"Step {self.step}: packed {self.n_rows} rows into {self.n_prompts} prompts "
+                f"(fixed batch_size={self.batch_size}: {self.n_prompts_fixed}, saved {self.prompts_saved}); "
+                f"preamble {self.preamble_tokens} tokens, largest prompt {self.largest_prompt_tokens} tokens")
+
+
+def row_token_counts(data: pd.DataFrame, step: str, model: str="gpt-4o"):
+    """Token count of every rendered design row of `data` for the given step."""
+    encoding = get_encoding(model)
+    rows = ROW_RENDERERS[step].render(data)
+    return [len(tokens) for tokens in encoding.encode_batch(rows)]
+
+
+def preamble_token_count(step: str, model: str="gpt-4o", response_format: str="json"):
+    """Tokens of the fixed instructions and examples wrapped around the design rows of a step."""
+    return get_template(step, response_format).static_token_count(model)
+
+
+def pack_batches(data: pd.DataFrame,
+                 step: str,
+                 max_input_tokens: int=8000,
+                 max_output_tokens: int=3000,
+                 batch_size: int=32,
+                 max_rows: int=None,
+                 output_tokens_per_row: int=None,
+                 model: str="gpt-4o",
+                 response_format: str="json"):
+    """Greedily pack consecutive rows of `data` into prompts within the given token budgets.
+
+    Returns the (start, stop) row bounds of each prompt, to be passed as `batches` to the
+    step's prompt builder, and a `PackingReport` comparing the packing with fixed
+    `batch_size` slicing. A single row exceeding a budget still gets its own prompt.
+    `response_format` is the format the prompts will ask for ("json" or "compact").
+    """
+    if data.empty:
+        raise ValueError("The data is empty. Please provide rows to pack.")
+
+    if output_tokens_per_row is None:
+        per_row = COMPACT_OUTPUT_TOKENS_PER_ROW if response_format == "compact" else OUTPUT_TOKENS_PER_ROW
+        output_tokens_per_row = per_row[step]
+
+    preamble_tokens = preamble_token_count(step, model, response_format)
+    row_tokens = row_token_counts(data, step, model)
+
+    bounds = []
+    largest_prompt = 0
+    start = 0
+    input_tokens = preamble_tokens
+    output_tokens = 0
+    for idx, tokens in enumerate(row_tokens):
+        n_rows = idx - start
+        over_budget = (input_tokens + tokens > max_input_tokens
+                       or output_tokens + output_tokens_per_row > max_output_tokens
+                       or (max_rows is not None and n_rows >= max_rows))
+        if n_rows > 0 and over_budget:
+            bounds.append((start, idx))
+            largest_prompt = max(largest_prompt, input_tokens)
+            start = idx
+            input_tokens = preamble_tokens
+            output_tokens = 0
+        input_tokens += tokens
+        output_tokens += output_tokens_per_row
+    bounds.append((start, len(row_tokens)))
+    largest_prompt = max(largest_prompt, input_tokens)
+
+    report = PackingReport(
+        step=step,
+        n_rows=len(data),
+        n_prompts=len(bounds),
+        n_prompts_fixed=math.ceil(len(data) / batch_size),
+        batch_size=batch_size,
+        max_input_tokens=max_input_tokens,
+        max_output_tokens=max_output_tokens,
+        preamble_tokens=preamble_tokens,
+        largest_prompt_tokens=largest_prompt,
+    )
+    logging.info(str(report))
+    return bounds, report
+
+
+def build_packed_prompts(data: pd.DataFrame, step: str, **packing_kwargs):
+    """Pack `data` for `step` and build its prompts; returns (prompts, bounds, report)."""
+    bounds, report = pack_batches(data, step, **packing_kwargs)
+    prompts = STEP_BUILDERS[step](data, report.batch_size, batches=bounds,
+                                  response_format=packing_kwargs.get("response_format", "json"))
+    return prompts, bounds, report
@@ -1,10 +1,242 @@
+import hashlib
+import tiktoken
 import pandas as pd
 
-def enhance_objects_in_designs(data: pd.DataFrame, batch_size: int):
-    prompts = []
-    for i in range(0, len(data), batch_size):
-        batch = data.iloc[i:i + batch_size]
-        prompt = """
+from string import Formatter
+from functools import lru_cache
+from dataclasses import dataclass, field
+
+from modules import compact_format
+
+
+def iter_batches(data: pd.DataFrame, batch_size: int, batches: list=None):
+    """Yield the row batches of `data`, either fixed `batch_size` slices or the given (start, stop) bounds."""
+    if batches is None:
+        batches = [(i, i + batch_size) for i in range(0, len(data), batch_size)]
+    for start, stop in batches:
+        yield data.iloc[start:stop]
+
+
+def batch_design_ids(data: pd.DataFrame, step: str, batch_size: int, batches: list=None):
+    """Unique design ids of every prompt the step's builder creates from `data`, in prompt order."""
+    id_col = "id" if step == "0" else "design_id"
+    return [batch[id_col].drop_duplicates().tolist() for batch in iter_batches(data, batch_size, batches)]
+
+
+@dataclass
+class PromptSegments:
+    """Fixed text of a step's prompt around its design rows.
+
+    A prompt is `preamble + intro + rows + tail` followed by the response instructions.
+    With `split_prefix`, the builders return (prefix, suffix) pairs instead: the prefix
+    holds every fixed part and is byte-identical for all prompts of a step, so it can be
+    sent as a system message and cached by the provider; the suffix is `intro + rows`.
+    """
+    preamble: str
+    intro: str
+    tail: str
+
+
+@dataclass
+class RowTemplate:
+    """Text of one design row with `{column}` fields filled from the columns of the data.
+
+    Rows are rendered column-wise: every column is converted to a list once and the values
+    are zipped into a positional template, instead of indexing one row Series at a time.
+    """
+    text: str
+    columns: list = field(init=False)
+
+    def __post_init__(self):
+        parts = list(Formatter().parse(self.text))
+        self.columns = [name for _, name, _, _ in parts if name is not None]
+        self._positional = "".join(literal.replace("{", "{{").replace("}", "}}") + ("{}" if name is not None else "")
+                                   for literal, name, _, _ in parts)
+
+    def render(self, data: pd.DataFrame):
+        """The rendered rows of `data`, as a list of strings."""
+        fill = self._positional.format
+        return [fill(*values) for values in zip(*(data[column].tolist() for column in self.columns))]
+
+
+@dataclass
+class PromptTemplate:
+    """The fixed text and row template of a step's prompts for one response format.
+
+    Templates are loaded once per (step, response format) by `get_template`. `version` is a
+    hash of all their text, so it changes whenever the prompt wording does; it can be stored
+    with cache keys and results. The token counts of the fixed text are computed once per
+    model, so estimating the cost of a prompt only tokenizes its design rows.
+    """
+    step: str
+    response_format: str
+    segments: PromptSegments
+    row: RowTemplate
+    closing: str = field(init=False)
+    version: str = field(init=False)
+
+    def __post_init__(self):
+        self.closing = self.segments.tail + response_instructions(self.step, self.response_format)
+        content = "\0".join((self.step, self.response_format, self.segments.preamble, self.segments.intro,
+                              self.closing, self.row.text))
+        self.version = f"{self.step}-{hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]}"
+        self._static_tokens = {}
+
+    @property
+    def prefix(self):
+        """Every fixed part except the intro, sent as the system message with `split_prefix`."""
+        return self.segments.preamble + self.closing
+
+    def static_token_count(self, model: str="gpt-4o", split_prefix: bool=False):
+        """Tokens of the fixed text of one prompt, counted once per model and layout."""
+        key = (model, split_prefix)
+        if key not in self._static_tokens:
+            encoding = get_encoding(model)
+            if split_prefix:
+                parts = [self.prefix, self.segments.intro]
+            else:
+                parts = [self.segments.preamble + self.segments.intro, self.closing]
+            self._static_tokens[key] = sum(len(tokens) for tokens in encoding.encode_batch(parts))
+        return self._static_tokens[key]
+
+    def rows_text(self, prompt):
+        """The design rows of a prompt built from this template, or None if it was not."""
+        intro = self.segments.intro
+        if isinstance(prompt, tuple):
+            prefix, suffix = prompt
+            if prefix == self.prefix and suffix.startswith(intro):
+                return suffix[len(intro):]
+            return None
+        head = self.segments.preamble + intro
+        if prompt.startswith(head) and prompt.endswith(self.closing) and len(prompt) >= len(head) + len(self.closing):
+            return prompt[len(head):len(prompt) - len(self.closing)]
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str="gpt-4o"):
+    """Return the tiktoken encoding for `model`, loaded once per process."""
+    return tiktoken.encoding_for_model(model)
+
+
+@lru_cache(maxsize=None)
+def get_template(step: str, response_format: str="json"):
+    """The `PromptTemplate` of `step`, built on first use and shared afterwards."""
+    if step not in PROMPT_SEGMENTS:
+        raise ValueError(f"Unknown step: {step}")
+    return PromptTemplate(step, response_format, PROMPT_SEGMENTS[step], ROW_RENDERERS[step])
+
+
+def template_version(step: str, response_format: str="json"):
+    """Content hash of the prompt template of `step`, e.g. for cache keys and result provenance."""
+    return get_template(step, response_format).version
+
+
+def match_template(prompt, response_formats: tuple=("json", "compact")):
+    """The `PromptTemplate` a built prompt comes from, or None."""
+    for step in PROMPT_SEGMENTS:
+        for response_format in response_formats:
+            template = get_template(step, response_format)
+            if template.rows_text(prompt) is not None:
+                return template
+    return None
+
+
+def iter_prompts(step: str,
+                 data: pd.DataFrame,
+                 batch_size: int,
+                 batches: list=None,
+                 response_format: str="json",
+                 split_prefix: bool=False):
+    """Yield the prompts of `step` one by one; each batch is rendered only when its prompt is requested."""
+    template = get_template(step, response_format)
+    segments = template.segments
+    closing = template.closing
+    prefix = template.prefix
+    for batch in iter_batches(data, batch_size, batches):
+        rows = "".join(template.row.render(batch))
+        if split_prefix:
+            yield (prefix, segments.intro + rows)
+        else:
+            yield "".join((segments.preamble, segments.intro, rows, closing))
+
+
+def build_prompts(step: str,
+                  data: pd.DataFrame,
+                  batch_size: int,
+                  batches: list=None,
+                  response_format: str="json",
+                  split_prefix: bool=False,
+                  lazy: bool=False):
+    """Build the prompts of `step` from `data`; see `PromptSegments` for `split_prefix`.
+
+    With `lazy`, a generator is returned instead of a list, so a streaming executor such as
+    `chat_executor.process_prompts_async` can send the first prompts while the rest are built.
+    """
+    prompts = iter_prompts(step, data, batch_size, batches, response_format, split_prefix)
+    return prompts if lazy else list(prompts)
+
+
+@dataclass
+class PromptBatches:
+    """The rows behind every prompt of a step, so a prompt can be rebuilt from part of its rows.
+
+    Holds the arguments `build_prompts` was called with; `batches` may be the bounds of
+    `packing.build_packed_prompts`. The chat executors use it to split a failing prompt
+    into two smaller ones (see `failure_isolation.isolate_failure`).
+    """
+    step: str
+    data: pd.DataFrame
+    batch_size: int
+    batches: list = None
+    response_format: str = "json"
+    split_prefix: bool = False
+
+    def __post_init__(self):
+        if self.batches is None:
+            self.batches = [(i, i + self.batch_size) for i in range(0, len(self.data), self.batch_size)]
+
+    @property
+    def id_col(self):
+        return "id" if self.step == "0" else "design_id"
+
+    def prompts(self, lazy: bool=False):
+        return build_prompts(self.step, self.data, self.batch_size, self.batches, self.response_format,
+                             self.split_prefix, lazy)
+
+    def rows(self, prompt_idx: int):
+        start, stop = self.batches[prompt_idx]
+        return self.data.iloc[start:stop]
+
+    def prompt(self, rows: pd.DataFrame):
+        """The prompt of `step` for exactly `rows`."""
+        return next(iter_prompts(self.step, rows, len(rows), None, self.response_format, self.split_prefix))
+
+    def design_ids(self, rows: pd.DataFrame):
+        return rows[self.id_col].drop_duplicates().tolist()
+
+    def split(self, rows: pd.DataFrame):
+        """Two halves of `rows`, split between designs if there are several; None for a single row."""
+        design_ids = self.design_ids(rows)
+        if len(design_ids) > 1:
+            first = rows[self.id_col].isin(design_ids[:len(design_ids) // 2])
+            return rows[first], rows[~first]
+        if len(rows) > 1:
+            return rows.iloc[:len(rows) // 2], rows.iloc[len(rows) // 2:]
+        return None
+
+
+ENHANCE_ROW = RowTemplate("""
+            {{
+                design_id: {id}, // Unique identifier of the design
+                Original Design: "{design_en}",
+                Original List of Strings: {list_of_strings}
+            }},
+            """)
+
+
+ENHANCE_SEGMENTS = PromptSegments(
+    preamble="""
         You are an expert extraction algorithm for numismatic design descriptions.
         Your goal is to enhance the list of identified objects in the following designs.
         You will be provided with a design description and a list of objects, and you will output JSON objects containing the following information:
@@ -59,38 +291,34 @@ def enhance_objects_in_designs(data: pd.DataFrame, batch_size: int):
             new_list_of_strings: [(string, string)] // Enhanced list of objects in the form of tuples: (entity, class)
         }
 
-        Now, enhance the following designs:
-        """
-        for _, entry in batch.iterrows():
-            prompt += f"""
-            {{
-                design_id: {entry['id']}, // Unique identifier of the design
-                Original Design: "{entry['design_en']}",
-                Original List of Strings: {entry['list_of_strings']}
-            }},
-            """
-        prompt += """
+        """,
+    intro="""Now, enhance the following designs:
+        """,
+    tail="""
         Notes: 
         - Objects should be atomic and not compound terms. For example, horn of ammon should be represented as the key "horn" with the class "OBJECT".
         - Persons should be named as they are, like Alexander the Great or Antoninus Pius, and not as "Alexander", "Great" or "Antoninus", "Pius".
         
-        Respond with the design_id and the enhanced list of strings in valid JSON format for each design, like this:
-        {
-            "design_id": 36,
-            "new_list_of_strings": [("Aphrodite", "PERSON"), ("breast", "OBJECT"), ("pudenda", "OBJECT"), ("Eros", "PERSON"), ("dolphin", "ANIMAL")]
-        }
-        """
-        prompts.append(prompt)
+""",
+)
+
 
-    return prompts
+def enhance_objects_in_designs(data: pd.DataFrame, batch_size: int, batches: list=None, response_format: str="json", split_prefix: bool=False, lazy: bool=False):
+    return build_prompts("0", data, batch_size, batches, response_format, split_prefix, lazy)
 
 
+VALIDATE_ENHANCED_ROW = RowTemplate("""
+            {{
+                design_id: {design_id}, // Unique identifier of the design
+                Original List of Strings: {list_of_strings},
+                Enhanced List of Strings: {new_list_of_strings},
+                Design: "{design_en}"
+            }},
+            """)
+
 
-def validate_overall_objects_in_designs(data: pd.DataFrame, batch_size: int):
-    prompts = []
-    for i in range(0, len(data), batch_size):
-        batch = data.iloc[i:i + batch_size]
-        prompt = """
+VALIDATE_ENHANCED_SEGMENTS = PromptSegments(
+    preamble="""
         You are an expert validator algorithm for numismatic design descriptions.
         Your task is to classify the overall likelihood of the identified objects list in the following designs.
         You will be provided with a design description and a list of objects, and you will output JSON objects containing the following information:
@@ -155,42 +383,34 @@ def validate_overall_objects_in_designs(data: pd.DataFrame, batch_size: int):
             comment_enh: string // Comment on the enhanced list
         }
 
-        Now, validate the following designs:
-        """
-        for _, entry in batch.iterrows():
-            prompt += f"""
-            {{
-                design_id: {entry['design_id']}, // Unique identifier of the design
-                Original List of Strings: {entry['list_of_strings']},
-                Enhanced List of Strings: {entry['new_list_of_strings']},
-                Design: "{entry['design_en']}"
-            }},
-            """
-        prompt += """
+        """,
+    intro="""Now, validate the following designs:
+        """,
+    tail="""
         Notes: 
         - Objects should be atomic and not compound terms. For example, horn of ammon should be represented as the key "horn" with the class "OBJECT".
         - Persons should be named as they are, like Alexander the Great or Antoninus Pius, and not as "Alexander", "Great" or "Antoninus", "Pius".
         
 
-        Respond with the design_id, relevance, correctness, and comment_enh in valid JSON format for each design, like this:
-        {
-            "design_id": 36,
-            "relevance": 1,
-            "correctness": 1,
-            "comment_enh": "The enhanced list includes all significant objects mentioned in the design description and has improved relevance by including 'pudenda' and excluding redundant 'head' and 'hand'."
-        }
-        """
-        prompts.append(prompt)
+""",
+)
 
-    return prompts
 
+def validate_overall_objects_in_designs(data: pd.DataFrame, batch_size: int, batches: list=None, response_format: str="json", split_prefix: bool=False, lazy: bool=False):
+    return build_prompts("0_1", data, batch_size, batches, response_format, split_prefix, lazy)
+
+
+SOP_ROW = RowTemplate("""
+            {{
+                design_id: {design_id}, // Unique identifier of the design
+                Design: "{design_en}",
+                List of Strings: {new_list_of_strings}
+            }},
+            """)
 
 
-def find_subject_object_pairs_prompts(data: pd.DataFrame, batch_size: int):
-    prompts = []
-    for i in range(0, len(data), batch_size):
-        batch = data.iloc[i:i + batch_size]
-        prompt = """
+SOP_SEGMENTS = PromptSegments(
+    preamble="""
         You are an expert extraction algorithm for numismatic design descriptions.
         Extract all semantically meaningful pairs of entities from the following designs.
         Each "List of Strings" entry contains tuples in the form of [(entity, class), ...]
@@ -232,17 +452,10 @@ def find_subject_object_pairs_prompts(data: pd.DataFrame, batch_size: int):
             {"design_id": 67, "s_o_id": "h", "s": "Artemis", "subject_class": "PERSON", "o": "boot", "object_class": "OBJECT"}
         ]
 
-        Now, process the following designs:
-        """
-        for _, entry in batch.iterrows():
-            prompt += f"""
-            {{
-                design_id: {entry['design_id']}, // Unique identifier of the design
-                Design: "{entry['design_en']}",
-                List of Strings: {entry['new_list_of_strings']}
-            }},
-            """
-        prompt += """
+        """,
+    intro="""Now, process the following designs:
+        """,
+    tail="""
         Respond only with the following fields for each possible pair of entities:
         {
             "design_id": int, // Unique identifier of the design
@@ -262,37 +475,27 @@ def find_subject_object_pairs_prompts(data: pd.DataFrame, batch_size: int):
         - If no meaningful pairs are found for a Design ID, use "NULL" for the subject, subject_class, object, and object_class fields.
         - If the same pair is mentioned multiple times, provide a new row with a different s_o_id \in {a, b, c, d, ...}.
 
-        Respond only with the dictionary entries excluding 'design_en' and in valid JSON format, like this:
-        [
-            {
-                "design_id": 114, 
-                "s_o_id": "a", 
-                "s": "Artemis", 
-                "subject_class": "PERSON", 
-                "o": "torch", 
-                "object_class": "OBJECT"
-            },
-            {
-                "design_id": 90, 
-                "s_o_id": "a", 
-                "s": "NULL", 
-                "subject_class": "NULL", 
-                "o": "NULL", 
-                "object_class": "NULL"
-            }
-        ]
-        """
-        prompts.append(prompt)
+""",
+)
+
 
-    return prompts
+def find_subject_object_pairs_prompts(data: pd.DataFrame, batch_size: int, batches: list=None, response_format: str="json", split_prefix: bool=False, lazy: bool=False):
+    return build_prompts("1", data, batch_size, batches, response_format, split_prefix, lazy)
 
 
+VALIDATE_SOP_ROW = RowTemplate("""
+            {{
+                design_id: {design_id}, // Unique identifier of the design
+                s_o_id: "{s_o_id}",
+                Design: "{design_en}"
+                Subject: "{s}" ({subject_class}),
+                Object: "{o}" ({object_class}),
+            }},
+            """)
 
-def validate_subject_object_pairs(data: pd.DataFrame, batch_size: int):
-    prompts = []
-    for i in range(0, len(data), batch_size):
-        batch = data.iloc[i:i + batch_size]
-        prompt = """
+
+VALIDATE_SOP_SEGMENTS = PromptSegments(
+    preamble="""
         You are an expert validator algorithm for numismatic design descriptions. 
         Your task is to classify the validity of the identified subject-object, or entity pairs, in the following designs.
         Rate each pair of objects based on the following criteria:
@@ -330,40 +533,34 @@ def validate_subject_object_pairs(data: pd.DataFrame, batch_size: int):
             comment_sop: string // Short comment on the validity of the pair
         }
 
-        Now, validate the following designs:
-        """
-        for _, entry in batch.iterrows():
-            prompt += f"""
-            {{
-                design_id: {entry['design_id']}, // Unique identifier of the design
-                s_o_id: "{entry['s_o_id']}",
-                Design: "{entry['design_en']}"
-                Subject: "{entry['s']}" ({entry['subject_class']}),
-                Object: "{entry['o']}" ({entry['object_class']}),
-            }},
-            """
-        prompt += """
+        """,
+    intro="""Now, validate the following designs:
+        """,
+    tail="""
         Notes: 
         - Do not validate the single entities (entity classes), only focus on the correctness of the pairs of entities (subject, object pairs) based on the Design.
 
-        Respond with the design_id, s_o_id, validity_sop, and comment_sop in valid JSON format, like this:
-        {
-            "design_id": 478, 
-            "s_o_id": "a", 
-            "validity_sop": 1, 
-            "comment_sop": "Correct and meaningful pair."
-        }
-        """
-        prompts.append(prompt)
+""",
+)
 
-    return prompts
 
+def validate_subject_object_pairs(data: pd.DataFrame, batch_size: int, batches: list=None, response_format: str="json", split_prefix: bool=False, lazy: bool=False):
+    return build_prompts("1_1", data, batch_size, batches, response_format, split_prefix, lazy)
 
-def find_predicates_prompts(data: pd.DataFrame, batch_size: int):
-    prompts = []
-    for i in range(0, len(data), batch_size):
-        batch = data.iloc[i:i + batch_size]
-        prompt = """
+
+PREDICATE_ROW = RowTemplate("""
+            {{
+                design_id: {design_id}, // Unique identifier of the design
+                SOP Id: {s_o_id},
+                Subject: {s} ({subject_class}),
+                Object: {o} ({object_class}),
+                Design: "{design_en}"
+            }},
+            """)
+
+
+PREDICATE_SEGMENTS = PromptSegments(
+    preamble="""
         You are an expert relation extraction algorithm for numismatic design descriptions.
         Extract the most likely predicate (action or state) for each subject-object pair relation from the following designs.
         The predicate should be explicitly mentioned in the design description and should be the most likely relation between the subject and object.
@@ -403,19 +600,10 @@ def find_predicates_prompts(data: pd.DataFrame, batch_size: int):
         Expected Response:
         {"design_id": 50, "s_o_id": "a", "predicate": "NULL"},
 
-        Now, process the following designs:
-        """
-        for _, entry in batch.iterrows():
-            prompt += f"""
-            {{
-                design_id: {entry['design_id']}, // Unique identifier of the design
-                SOP Id: {entry['s_o_id']},
-                Subject: {entry['s']} ({entry['subject_class']}),
-                Object: {entry['o']} ({entry['object_class']}),
-                Design: "{entry['design_en']}"
-            }},
-            """
-        prompt += """
+        """,
+    intro="""Now, process the following designs:
+        """,
+    tail="""
         Respond only with the following fields for each subject-object pair:
         {
             design_id: int, // Unique identifier of the design
@@ -430,30 +618,28 @@ def find_predicates_prompts(data: pd.DataFrame, batch_size: int):
         - Double-check the semantic meaning and correctness of each predicate.
         - If no predicate is found, use "NULL" for the predicate field.
 
-        Respond only with the dictionary entries design_id, s_o_id, and predicate in valid JSON format, like this:
-        [
-            {
-                "design_id": 114, 
-                "s_o_id": "a", 
-                "predicate": "containing"
-            },
-            {
-                "design_id": 50, 
-                "s_o_id": "a", 
-                "predicate": "NULL"
-            }
-        ]
-        """
-        prompts.append(prompt)
+""",
+)
 
-    return prompts
 
+def find_predicates_prompts(data: pd.DataFrame, batch_size: int, batches: list=None, response_format: str="json", split_prefix: bool=False, lazy: bool=False):
+    return build_prompts("2", data, batch_size, batches, response_format, split_prefix, lazy)
 
-def validate_spo_triples(data: pd.DataFrame, batch_size: int):
-    prompts = []
-    for i in range(0, len(data), batch_size):
-        batch = data.iloc[i:i + batch_size]
-        prompt = """
+
+VALIDATE_SPO_ROW = RowTemplate("""
+            {{
+                design_id: {design_id}, // Unique identifier of the design
+                SOP Id: {s_o_id},
+                Subject: {s} ({subject_class}),
+                Predicate: {predicate},
+                Object: {o} ({object_class}),
+                Design: "{design_en}"
+            }},
+            """)
+
+
+VALIDATE_SPO_SEGMENTS = PromptSegments(
+    preamble="""
         You are an expert validator algorithm for numismatic design descriptions.
         Your task is to evaluate the validity of the extracted subject-predicate-object (SPO) triples in the following designs.
         Rate each SPO triple based on the following criteria:
@@ -524,20 +710,10 @@ def validate_spo_triples(data: pd.DataFrame, batch_size: int):
             }
         ]
 
-        Now, validate the following designs:
-        """
-        for _, entry in batch.iterrows():
-            prompt += f"""
-            {{
-                design_id: {entry['design_id']}, // Unique identifier of the design
-                SOP Id: {entry['s_o_id']},
-                Subject: {entry['s']} ({entry['subject_class']}),
-                Predicate: {entry['predicate']},
-                Object: {entry['o']} ({entry['object_class']}),
-                Design: "{entry['design_en']}"
-            }},
-            """
-        prompt += """
+        """,
+    intro="""Now, validate the following designs:
+        """,
+    tail="""
         Respond only with the following fields for each SPO triple:
         {
             design_id: int, // Unique identifier of the design
@@ -547,14 +723,116 @@ def validate_spo_triples(data: pd.DataFrame, batch_size: int):
             implicit_pred: string // Implicit predicate if the identified predicate is not plausible or is NULL
         }
 
-        Respond with the design_id, s_o_id, validity_pred, comment_pred, and implicit_pred in valid JSON format, like this:
+""",
+)
+
+
+def validate_spo_triples(data: pd.DataFrame, batch_size: int, batches: list=None, response_format: str="json", split_prefix: bool=False, lazy: bool=False):
+    return build_prompts("2_1", data, batch_size, batches, response_format, split_prefix, lazy)
+
+
+# Closing response instructions of each step's prompt in the default JSON format
+JSON_RESPONSE_FORMATS = {
+    "0": """        Respond with the design_id and the enhanced list of strings in valid JSON format for each design, like this:
+        {
+            "design_id": 36,
+            "new_list_of_strings": [("Aphrodite", "PERSON"), ("breast", "OBJECT"), ("pudenda", "OBJECT"), ("Eros", "PERSON"), ("dolphin", "ANIMAL")]
+        }
+        """,
+    "0_1": """        Respond with the design_id, relevance, correctness, and comment_enh in valid JSON format for each design, like this:
+        {
+            "design_id": 36,
+            "relevance": 1,
+            "correctness": 1,
+            "comment_enh": "The enhanced list includes all significant objects mentioned in the design description and has improved relevance by including 'pudenda' and excluding redundant 'head' and 'hand'."
+        }
+        """,
+    "1": """        Respond only with the dictionary entries excluding 'design_en' and in valid JSON format, like this:
+        [
+            {
+                "design_id": 114, 
+                "s_o_id": "a", 
+                "s": "Artemis", 
+                "subject_class": "PERSON", 
+                "o": "torch", 
+                "object_class": "OBJECT"
+            },
+            {
+                "design_id": 90, 
+                "s_o_id": "a", 
+                "s": "NULL", 
+                "subject_class": "NULL", 
+                "o": "NULL", 
+                "object_class": "NULL"
+            }
+        ]
+        """,
+    "1_1": """        Respond with the design_id, s_o_id, validity_sop, and comment_sop in valid JSON format, like this:
+        {
+            "design_id": 478, 
+            "s_o_id": "a", 
+            "validity_sop": 1, 
+            "comment_sop": "Correct and meaningful pair."
+        }
+        """,
+    "2": """        Respond only with the dictionary entries design_id, s_o_id, and predicate in valid JSON format, like this:
+        [
+            {
+                "design_id": 114, 
+                "s_o_id": "a", 
+                "predicate": "containing"
+            },
+            {
+                "design_id": 50, 
+                "s_o_id": "a", 
+                "predicate": "NULL"
+            }
+        ]
+        """,
+    "2_1": """        Respond with the design_id, s_o_id, validity_pred, comment_pred, and implicit_pred in valid JSON format, like this:
         {
             "design_id": 478, 
             "s_o_id": "a", 
             "validity_pred": 1, 
             "comment_pred": "Correct and meaningful SPO triple.", "implicit_pred": "NULL"
         }
-        """
-        prompts.append(prompt)
-
-    return prompts
+        """,
+}
+
+
+def response_instructions(step: str, response_format: str="json"):
+    """Closing instructions of a step's prompt for `response_format` "json" or "compact"."""
+    if response_format == "json":
+        return JSON_RESPONSE_FORMATS[step]
+    if response_format == "compact":
+        return compact_format.instructions(step)
+    raise ValueError(f"Unknown response format: {response_format}")
+
+
+# Builders, fixed prompt segments and row templates keyed by the pipeline step names used in the notebooks
+STEP_BUILDERS = {
+    "0": enhance_objects_in_designs,
+    "0_1": validate_overall_objects_in_designs,
+    "1": find_subject_object_pairs_prompts,
+    "1_1": validate_subject_object_pairs,
+    "2": find_predicates_prompts,
+    "2_1": validate_spo_triples,
+}
+
+PROMPT_SEGMENTS = {
+    "0": ENHANCE_SEGMENTS,
+    "0_1": VALIDATE_ENHANCED_SEGMENTS,
+    "1": SOP_SEGMENTS,
+    "1_1": VALIDATE_SOP_SEGMENTS,
+    "2": PREDICATE_SEGMENTS,
+    "2_1": VALIDATE_SPO_SEGMENTS,
+}
+
+ROW_RENDERERS = {
+    "0": ENHANCE_ROW,
+    "0_1": VALIDATE_ENHANCED_ROW,
+    "1": SOP_ROW,
+    "1_1": VALIDATE_SOP_ROW,
+    "2": PREDICATE_ROW,
+    "2_1": VALIDATE_SPO_ROW,
+}
@@ -0,0 +1,195 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+from pathlib import Path
+from contextlib import closing
+
+from modules.scripts import (build_messages, make_custom_id, parse_custom_id, decode_response, iter_batch_output_lines,
+                             write_batch_output)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_created ON responses (created_at);
+CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access);
+"""
+
+
+class ResponseCache():
+    """On-disk cache of completions keyed by a hash of (model, temperature, messages).
+
+    Entries older than `max_age_days` are dropped, and the least recently used entries
+    are evicted once the stored responses exceed `max_bytes`.
+    """
+
+    def __init__(self,
+                 db_path: Path=Path("./data/results/tmp/response_cache.sqlite"),
+                 max_bytes: int=512 * 1024 * 1024,
+                 max_age_days: float=30,
+                 evict_every: int=100):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.evict_every = evict_every
+        self._puts = 0
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+        self.evict()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+    @staticmethod
+    def make_key(model: str, temperature, messages: list):
+        """Hash of the request; the messages hold the rendered prompt, so a changed template changes the key."""
+        payload = json.dumps([model, temperature, messages], sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Return the cached response for `key`, or None."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self._expired(row[1], now):
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def __contains__(self, key: str):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        return row is not None and not self._expired(row[0], time.time())
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now))
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def discard(self, key: str):
+        """Remove an entry, e.g. a response that turned out to be unusable."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _expired(self, created_at: float, now: float):
+        return self.max_age_days is not None and now - created_at > self.max_age_days * 86400
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until under `max_bytes`."""
+        with closing(self._connect()) as conn, conn:
+            removed = 0
+            if self.max_age_days is not None:
+                removed += conn.execute("DELETE FROM responses WHERE created_at < ?",
+                                        (time.time() - self.max_age_days * 86400,)).rowcount
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                to_free = total - self.max_bytes
+                keys = []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                    keys.append((key,))
+                    to_free -= size
+                    if to_free <= 0:
+                        break
+                conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+                removed += len(keys)
+        if removed:
+            logging.info(f"Evicted {removed} entries from the response cache.")
+
+    def complete_batch_result(self,
+                              result,
+                              prompts: list,
+                              model: str="gpt-4o",
+                              temperature=0,
+                              step: str=None,
+                              design_ids: list=None,
+                              response_format: str="json",
+                              output_path: Path=None):
+        """Cache the responses of a downloaded batch result and add the cached ones it lacks.
+
+        `prompts` is the full prompt list the tasks were created from (see
+        `scripts.create_tasks`), so each task's prompt index maps back to its prompt. Only
+        responses that decode for `step` and `response_format` (see `scripts.decode_response`)
+        are cached; an undecodable one is discarded, so its prompt is sent again. `result` is
+        anything `scripts.iter_batch_output_lines` reads and is read line by line. Returns the
+        result extended with output lines for every prompt answered from the cache, as bytes,
+        or written to `output_path` (which must not be the file read) and returned as its path.
+        """
+        lines = self._completed_lines(result, prompts, model, temperature, step, design_ids, response_format)
+        return write_batch_output(lines, output_path)
+
+    def _completed_lines(self, result, prompts, model, temperature, step, design_ids, response_format):
+        answered = set()
+        n_rejected = 0
+        for line in iter_batch_output_lines(result):
+            if isinstance(line, str):
+                line = line.encode("utf-8")
+            if not line.strip():
+                continue
+            yield line.rstrip(b"\r\n") + b"\n"
+            try:
+                res = json.loads(line)
+                index = parse_custom_id(res["custom_id"])["prompt_idx"]
+                content = res["response"]["body"]["choices"][0]["message"]["content"]
+            except (json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError):
+                continue
+            answered.add(index)
+            if index >= len(prompts):
+                continue
+            key = self.make_key(model, temperature, build_messages(prompts[index]))
+            if self._decodes(content, step, response_format):
+                self.put(key, content)
+            else:
+                n_rejected += 1
+                self.discard(key)
+        if n_rejected:
+            logging.warning(f"{n_rejected} batch responses could not be decoded and were not cached.")
+
+        n_cached = 0
+        for index, prompt in enumerate(prompts):
+            if index in answered:
+                continue
+            key = self.make_key(model, temperature, build_messages(prompt))
+            response = self.get(key)
+            if response is None:
+                continue
+            if not self._decodes(response, step, response_format):
+                self.discard(key)
+                continue
+            n_cached += 1
+            yield (json.dumps({
+                "custom_id": make_custom_id(index, step, design_ids[index] if design_ids is not None else None),
+                "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"message": {"role": "assistant", "content": response}}]},
+                },
+                "error": None,
+            }) + "\n").encode("utf-8")
+        logging.info(f"Added {n_cached} cached responses to the batch result.")
+
+    @staticmethod
+    def _decodes(content, step: str=None, response_format: str="json"):
+        if not content or not content.strip():
+            return False
+        try:
+            decode_response(content, step, response_format)
+        except ValueError:
+            # LenientJSONError and CompactFormatError are ValueErrors
+            return False
+        return True
@@ -0,0 +1,345 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import pandas as pd
+
+from pathlib import Path
+from contextlib import closing
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    n_records INTEGER NOT NULL,
+    committed_at REAL NOT NULL,
+    template_version TEXT
+);
+CREATE TABLE IF NOT EXISTS records (
+    segment TEXT NOT NULL REFERENCES segments(name),
+    line INTEGER NOT NULL,
+    design_id INTEGER,
+    s_o_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_records_design ON records (design_id);
+CREATE INDEX IF NOT EXISTS idx_records_design_pair ON records (design_id, s_o_id);
+CREATE INDEX IF NOT EXISTS idx_records_segment ON records (segment);
+"""
+
+SEGMENT_SUFFIX = ".jsonl"
+INDEXED_KEYS = ("design_id", "s_o_id")
+COMPACT_MARKER = "-compact-"
+QUARANTINE_SUFFIX = ".invalid"
+
+
+def _segment_seq(name: str):
+    return int(name.split("-", 1)[0])
+
+
+def coerce_keys(df: pd.DataFrame):
+    """`df` with integer `design_id`s, as the index stores them; raises ValueError for any other value."""
+    if "design_id" not in df or pd.api.types.is_integer_dtype(df["design_id"]):
+        return df
+    design_ids = pd.to_numeric(df["design_id"], errors="coerce")
+    invalid = df["design_id"].notna() & (design_ids.isna() | (design_ids % 1 != 0))
+    if invalid.any():
+        raise ValueError(f"{invalid.sum()} records have a design_id that is not an integer, "
+                         f"e.g. {df.loc[invalid, 'design_id'].iloc[0]!r}.")
+    return df.assign(design_id=design_ids.astype("Int64" if design_ids.isna().any() else "int64"))
+
+
+class ResultStore():
+    """Append-only store of pipeline results in JSON Lines segments with a SQLite index.
+
+    Every `append` writes one new segment to a temporary file and renames it into place,
+    then registers it and the `design_id` / `(design_id, s_o_id)` keys of its records in the
+    index in a single transaction. Readers only see registered segments, so a crash never
+    leaves a half-written result visible. `compact` merges all segments into one.
+    The store assumes a single writer at a time, like the notebooks that fill it.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / "index.sqlite"
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+        self._recover()
+
+    def _connect(self):
+        return sqlite3.connect(self.index_path)
+
+    def _segment_names(self, conn):
+        return [row[0] for row in conn.execute("SELECT name FROM segments ORDER BY seq")]
+
+    def _recover(self):
+        """Clean up after a crash between writing a segment and registering it.
+
+        Unfinished temporary files and unregistered compaction output are deleted, as are
+        unregistered segments older than the newest registered one, which a finished
+        compaction already holds. Newer unregistered segments are complete appends and
+        are registered; one that cannot be read or indexed is renamed with QUARANTINE_SUFFIX.
+        """
+        for tmp_path in self.root.glob(f"*{SEGMENT_SUFFIX}.tmp"):
+            tmp_path.unlink()
+        with closing(self._connect()) as conn:
+            registered = set(self._segment_names(conn))
+            max_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM segments").fetchone()[0]
+        for path in sorted(self.root.glob(f"*{SEGMENT_SUFFIX}")):
+            if path.name in registered:
+                continue
+            if COMPACT_MARKER in path.name or _segment_seq(path.name) <= max_seq:
+                logging.warning(f"Removing segment {path.name} left by an interrupted compaction.")
+                path.unlink()
+            else:
+                logging.warning(f"Registering segment {path.name} written before an interrupted commit.")
+                try:
+                    df = coerce_keys(pd.read_json(path, lines=True, dtype=False))
+                except ValueError as e:
+                    logging.error(f"Quarantining segment {path.name}, which cannot be registered: {e}")
+                    path.rename(path.with_name(path.name + QUARANTINE_SUFFIX))
+                    continue
+                self._register(path, df)
+
+    def _new_segment_path(self, conn, marker: str="-"):
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM segments").fetchone()[0]
+        return self.root / f"{seq:06d}{marker}{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIX}"
+
+    @staticmethod
+    def _write_segment(df: pd.DataFrame, path: Path):
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("w", encoding="utf-8") as file:
+            df.to_json(file, orient="records", lines=True, force_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    def _register(self, path: Path, df: pd.DataFrame, replaces: list=(), template_version: str=None):
+        design_ids = df["design_id"] if "design_id" in df else pd.Series([None] * len(df))
+        s_o_ids = df["s_o_id"] if "s_o_id" in df else pd.Series([None] * len(df))
+        rows = [
+            (path.name, line, None if pd.isna(design_id) else int(design_id), None if pd.isna(s_o_id) else str(s_o_id))
+            for line, (design_id, s_o_id) in enumerate(zip(design_ids, s_o_ids))
+        ]
+        with closing(self._connect()) as conn, conn:
+            for name in replaces:
+                conn.execute("DELETE FROM records WHERE segment = ?", (name,))
+                conn.execute("DELETE FROM segments WHERE name = ?", (name,))
+            conn.execute(
+                "INSERT INTO segments (name, seq, n_records, committed_at, template_version) VALUES (?, ?, ?, ?, ?)",
+                (path.name, _segment_seq(path.name), len(df), time.time(), template_version))
+            conn.executemany("INSERT INTO records (segment, line, design_id, s_o_id) VALUES (?, ?, ?, ?)", rows)
+
+    def append(self, df: pd.DataFrame, template_version: str=None):
+        """Commit the rows of `df` as a new segment; returns the segment name.
+
+        `template_version` records the prompt template the results were produced with
+        (see `prompts.template_version`). A `design_id` that is not an integer raises
+        ValueError before anything is written.
+        """
+        if df.empty:
+            logging.info("Nothing to append to the result store.")
+            return None
+        df = coerce_keys(df)
+        with closing(self._connect()) as conn:
+            path = self._new_segment_path(conn)
+        self._write_segment(df, path)
+        self._register(path, df, template_version=template_version)
+        logging.info(f"Appended {len(df)} records to {self.root} as {path.name}.")
+        return path.name
+
+    def __len__(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COALESCE(SUM(n_records), 0) FROM segments").fetchone()[0]
+
+    def segments(self):
+        """Registered segments with their record counts and template versions, oldest first."""
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query("SELECT name, seq, n_records, committed_at, template_version FROM segments ORDER BY seq", conn)
+
+    def keys(self, pairs: bool=False):
+        """Indexed keys of all records: `design_id`, plus `s_o_id` with `pairs`, without reading segments."""
+        columns = "design_id, s_o_id" if pairs else "design_id"
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(
+                f"SELECT DISTINCT {columns} FROM records WHERE design_id IS NOT NULL", conn)
+
+    def read_segment(self, name: str):
+        return pd.read_json(self.root / name, lines=True, dtype=False)
+
+    def segment_keys(self, names: list, keys: tuple=("design_id",)):
+        """Indexed keys of the records in the segments `names`; `keys` is a subset of INDEXED_KEYS."""
+        placeholders = ", ".join("?" * len(names))
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(
+                f"SELECT {', '.join(keys)} FROM records WHERE segment IN ({placeholders}) AND design_id IS NOT NULL",
+                conn, params=list(names))
+
+    def read(self, design_ids: list=None, columns: list=None):
+        """Read the stored records as one DataFrame, like `pd.read_json` on the old results file.
+
+        With `design_ids`, only segments holding those designs are read, using the index.
+        """
+        with closing(self._connect()) as conn:
+            if design_ids is None:
+                names = self._segment_names(conn)
+            else:
+                design_ids = [int(design_id) for design_id in design_ids]
+                conn.execute("CREATE TEMP TABLE wanted (design_id INTEGER PRIMARY KEY)")
+                conn.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", [(design_id,) for design_id in design_ids])
+                names = [row[0] for row in conn.execute(
+                    "SELECT s.name FROM segments s WHERE EXISTS (SELECT 1 FROM records r JOIN wanted w "
+                    "ON r.design_id = w.design_id WHERE r.segment = s.name) ORDER BY s.seq")]
+
+        frames = [self.read_segment(name) for name in names]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame(columns=columns or ["design_id"])
+        df = pd.concat(frames, ignore_index=True)
+        if design_ids is not None:
+            df = df[df["design_id"].isin(design_ids)].reset_index(drop=True)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def compact(self, keys: tuple=None):
+        """Merge all segments into one; with `keys`, keep only the last record per key.
+
+        The merged segment is committed before the old ones are deleted, so an interrupted
+        compaction leaves either the old or the new segments registered.
+        """
+        with closing(self._connect()) as conn:
+            old_names = self._segment_names(conn)
+            if len(old_names) <= 1 and keys is None:
+                return None
+            path = self._new_segment_path(conn, COMPACT_MARKER)
+            versions = [row[0] for row in conn.execute("SELECT DISTINCT template_version FROM segments")]
+        df = self.read()
+        n_before = len(df)
+        if keys is not None:
+            df = df.drop_duplicates(subset=list(keys), keep="last").reset_index(drop=True)
+        self._write_segment(df, path)
+        # The merged segment keeps the template version only if all its segments agree
+        self._register(path, df, replaces=old_names, template_version=versions[0] if len(versions) == 1 else None)
+        for name in old_names:
+            (self.root / name).unlink(missing_ok=True)
+        logging.info(f"Compacted {len(old_names)} segments with {n_before} records into {path.name} "
+                     f"with {len(df)} records.")
+        return path.name
+
+    def export_json(self, file_path: Path, indent: int=4):
+        """Write all records to a single JSON file in the layout of the old results files."""
+        file_path = Path(file_path)
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+        self.read().to_json(tmp_path, orient="records", indent=indent)
+        os.replace(tmp_path, file_path)
+
+
+class CompletedKeys():
+    """Keys of the records in a store that count as done, for resuming a run with an anti-join.
+
+    A record is done when none of its `required` columns is null. The keys are collected
+    per segment and refreshed incrementally: only segments committed since the last call
+    are looked at, from the SQLite index alone when `required` is empty. A compaction
+    triggers a full rebuild.
+    """
+
+    def __init__(self, store: ResultStore, keys: tuple=("design_id",), required: tuple=()):
+        self.store = store
+        self.keys = tuple(keys)
+        self.required = tuple(required)
+        self._segments = set()
+        self._frames = []
+        self._index = None
+
+    def _segment_frame(self, name: str):
+        if not self.required and set(self.keys) <= set(INDEXED_KEYS):
+            return self.store.segment_keys([name], self.keys)
+        df = self.store.read_segment(name)
+        if df.empty:
+            return pd.DataFrame(columns=list(self.keys))
+        return df.loc[df[list(self.required)].notna().all(axis=1), list(self.keys)]
+
+    def refresh(self):
+        names = list(self.store.segments()["name"])
+        if not self._segments <= set(names):
+            self._segments, self._frames = set(), []
+        new_names = [name for name in names if name not in self._segments]
+        if not new_names and self._index is not None:
+            return self
+        self._frames.extend(self._segment_frame(name) for name in new_names)
+        self._segments.update(new_names)
+        frames = [frame for frame in self._frames if not frame.empty]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=list(self.keys))
+        if len(self.keys) == 1:
+            self._index = pd.Index(df[self.keys[0]].unique())
+        else:
+            self._index = pd.MultiIndex.from_frame(df[list(self.keys)].drop_duplicates())
+        return self
+
+    @property
+    def index(self):
+        """The completed keys as a pandas Index, or a MultiIndex for composite keys."""
+        return self.refresh()._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def is_completed(self, source_df: pd.DataFrame, source_keys: tuple=None):
+        """Boolean mask of the rows of `source_df` whose keys are completed.
+
+        `source_keys` name the key columns in `source_df` when they differ from `keys`,
+        e.g. `("id",)` for the source designs of step "0".
+        """
+        source_keys = list(source_keys or self.keys)
+        if len(source_keys) != len(self.keys):
+            raise ValueError(f"Expected {len(self.keys)} source keys for {self.keys}, got {source_keys}.")
+        if len(source_keys) == 1:
+            return source_df[source_keys[0]].isin(self.index).to_numpy()
+        return pd.MultiIndex.from_frame(source_df[source_keys]).isin(self.index)
+
+    def filter(self, source_df: pd.DataFrame, source_keys: tuple=None):
+        """The rows of `source_df` that are not completed yet."""
+        return source_df[~self.is_completed(source_df, source_keys)].copy()
+
+
+_COMPLETED_KEYS = {}
+
+
+def completed_keys(json_dir: Path, json_filename: str, keys: tuple=("design_id",), required: tuple=()):
+    """The `CompletedKeys` of a results file, kept for the session so later calls only read new segments."""
+    root = store_path(json_dir, json_filename).resolve()
+    cache_key = (root, tuple(keys), tuple(required))
+    if cache_key not in _COMPLETED_KEYS:
+        _COMPLETED_KEYS[cache_key] = CompletedKeys(open_store(json_dir, json_filename), keys, required)
+    return _COMPLETED_KEYS[cache_key]
+
+
+def store_path(json_dir: Path, json_filename: str):
+    """Directory of the store that replaces the results file `json_dir/json_filename`."""
+    return Path(json_dir) / (Path(json_filename).stem + ".store")
+
+
+def open_store(json_dir: Path, json_filename: str):
+    """Open the store for a results file, importing the existing JSON file once as its first segment."""
+    store = ResultStore(store_path(json_dir, json_filename))
+    legacy_path = Path(json_dir) / json_filename
+    if legacy_path.exists() and not store.segments().shape[0]:
+        logging.info(f"Importing {legacy_path} into {store.root}.")
+        store.append(pd.read_json(legacy_path))
+    return store
+
+
+def results_exist(json_dir: Path, json_filename: str):
+    """Whether any results were written for `json_filename`, in its store or as the old JSON file."""
+    if (Path(json_dir) / json_filename).exists():
+        return True
+    root = store_path(json_dir, json_filename)
+    return (root / "index.sqlite").exists() and len(ResultStore(root)) > 0
+
+
+def read_results(json_dir: Path, json_filename: str, columns: list=None):
+    """Drop-in for `pd.read_json(Path(json_dir) / json_filename)` reading from the result store."""
+    return open_store(json_dir, json_filename).read(columns=columns)
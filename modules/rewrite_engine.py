@@ -0,0 +1,150 @@
+import re
+import os
+import logging
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+ROMAN_NUMERALS = ("I", "II", "III", "IV", "V")
+STRIP_CHARS = "?()"
+
+# Below this many designs the process pool costs more than it saves
+MIN_PARALLEL_DESIGNS = 5000
+
+
+def alias_rules(df_entities: pd.DataFrame,
+                language: str="_en",
+                extra_rules: dict=None,
+                roman_numerals: tuple=ROMAN_NUMERALS):
+    """Map every alternative name of `df_entities` to its standard name.
+
+    Built column-wise from the `name` / `alternativenames` columns of `language`. Later
+    entities win for duplicate alternative names, as with repeated `Preprocess.add_rule`
+    calls. Alternative names containing a Roman numeral followed by a period (" II.") are
+    left out, since the numerals are normalized separately.
+    """
+    rules = dict(extra_rules or {})
+    names = df_entities[["name" + language, "alternativenames" + language]].dropna()
+    names = names[names["alternativenames" + language] != "NULL"]
+    aliases = names.assign(alias=names["alternativenames" + language].str.split(", ")).explode("alias")
+    aliases = aliases[aliases["alias"].str.len() > 0]
+    numeral_re = "|".join(re.escape(f" {numeral}.") for numeral in roman_numerals)
+    aliases = aliases[~aliases["alias"].str.contains(numeral_re)]
+    rules.update(zip(aliases["alias"], aliases["name" + language]))
+    return rules
+
+
+def trie_regex(words: list, terminal=lambda word: ""):
+    """A regex matching any of `words`, structured as a character trie.
+
+    Python's `re` tries the branches of an alternation one by one; nesting the words by
+    common prefix keeps each match attempt proportional to the word length rather than
+    the number of words. Longer words are tried before their prefixes. `terminal(word)`
+    is appended where each word ends.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[None] = terminal(word)
+
+    def emit(node):
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items(), key=lambda item: str(item[0]))
+                    if char is not None]
+        if None in node:
+            branches.append(node[None])
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return emit(trie) if trie else ""
+
+
+class RewriteEngine():
+    """Alias rules, Roman-numeral normalization and character stripping compiled into one regex.
+
+    A design is rewritten in a single left-to-right scan: at each position the longest
+    alias starting there is replaced by its standard name (whole words only), " II." becomes
+    " II", and the characters of `strip_chars` are dropped. Replacements are not scanned
+    again, so one rule's output never triggers another rule.
+    """
+
+    def __init__(self, rules: dict, roman_numerals: tuple=ROMAN_NUMERALS, strip_chars: str=STRIP_CHARS):
+        self.rules = dict(rules)
+        self.roman_numerals = tuple(roman_numerals)
+        self.strip_chars = strip_chars
+        self._strip_table = str.maketrans("", "", strip_chars)
+        self._compile()
+
+    def _compile(self):
+        numeral_suffix = tuple(f" {numeral}" for numeral in self.roman_numerals)
+        # An alias ending in a numeral also takes the period that the normalization would drop
+        alias_re = trie_regex(self.rules, lambda alias: r"(?!\w)\.?" if alias.endswith(numeral_suffix) else r"(?!\w)")
+        numeral_re = "|".join(sorted(self.roman_numerals, key=len, reverse=True))
+        parts = []
+        if alias_re:
+            parts.append(rf"(?<!\w)(?P<alias>{alias_re})")
+        parts.append(rf"(?<= )(?P<numeral>{numeral_re})\.")
+        if self.strip_chars:
+            parts.append(f"(?P<strip>[{re.escape(self.strip_chars)}]+)")
+        self.pattern = re.compile("|".join(parts))
+        self._replacements = {alias: replacement.translate(self._strip_table) for alias, replacement in self.rules.items()}
+
+    def __getstate__(self):
+        return {"rules": self.rules, "roman_numerals": self.roman_numerals, "strip_chars": self.strip_chars}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @classmethod
+    def from_entities(cls, df_entities: pd.DataFrame, language: str="_en", extra_rules: dict=None, **kwargs):
+        return cls(alias_rules(df_entities, language, extra_rules), **kwargs)
+
+    def _replace(self, match):
+        kind = match.lastgroup
+        if kind == "alias":
+            alias = match.group("alias")
+            if alias not in self._replacements:
+                alias = alias[:-1]
+            return self._replacements[alias]
+        if kind == "numeral":
+            return match.group("numeral")
+        return ""
+
+    def rewrite(self, design: str):
+        """The design with every rule, the numeral normalization and the stripping applied."""
+        return self.pattern.sub(self._replace, design)
+
+    def rewrite_many(self, designs, n_jobs: int=None, chunk_size: int=2000):
+        """Rewrite a sequence of designs, split into chunks over `n_jobs` processes.
+
+        `n_jobs` defaults to the number of CPUs; with 1, or for fewer than
+        `MIN_PARALLEL_DESIGNS` designs, everything runs in this process.
+        """
+        designs = list(designs)
+        n_jobs = n_jobs or os.cpu_count() or 1
+        if n_jobs == 1 or len(designs) < MIN_PARALLEL_DESIGNS:
+            return [self.rewrite(design) for design in designs]
+
+        chunks = [designs[start:start + chunk_size] for start in range(0, len(designs), chunk_size)]
+        logging.info(f"Rewriting {len(designs)} designs in {len(chunks)} chunks on {n_jobs} processes.")
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(self,)) as executor:
+            return [design for chunk in executor.map(_rewrite_chunk, chunks) for design in chunk]
+
+    def rewrite_series(self, designs: pd.Series, n_jobs: int=None):
+        return pd.Series(self.rewrite_many(designs.tolist(), n_jobs), index=designs.index, name=designs.name)
+
+
+_worker_engine = None
+
+
+def _init_worker(engine: RewriteEngine):
+    # The engine is unpickled, and its regex compiled, once per worker process
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _rewrite_chunk(designs: list):
+    return [_worker_engine.rewrite(design) for design in designs]
@@ -1,12 +1,21 @@
 import pandas as pd
-import tiktoken
 import json
+import time
 import re
+import io
+import os
 
+from contextlib import ExitStack
+from dataclasses import dataclass, field
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 from openai import OpenAI
 
+from modules import lenient_json, compact_format, result_store, prompts as prompt_templates
+from modules.prompts import get_encoding
+from modules.failure_isolation import (RetryPolicy, PromptTask, DECODE_ERRORS, run_with_retry, can_split,
+                                       isolate_failure)
+
 import logging
 
 # Setup logging
@@ -19,39 +28,167 @@ CEST = timezone(timedelta(hours=2))
 # TODO - refactor as classes
 
 
-def create_tasks(prompts: list, 
-                 model: str="gpt-4o", 
-                 temperature: int=0):
-    """Create a list of tasks for processing prompts."""
-    tasks = []
+def build_messages(prompt):
+    """Chat messages sent for a prompt, shared by the chat and batch paths.
+
+    A (prefix, suffix) pair, as built with `split_prefix=True` in `modules.prompts`, is sent
+    as a system message holding the static prefix followed by a user message, so the
+    provider can cache the prefix across all prompts of a step.
+    """
+    if isinstance(prompt, tuple):
+        prefix, suffix = prompt
+        return [
+            {
+                "role": "system",
+                "content": prefix
+            },
+            {
+                "role": "user",
+                "content": suffix
+            }
+        ]
+    return [
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+def prompt_text(prompt):
+    """The full text of a prompt, joining a (prefix, suffix) pair."""
+    if isinstance(prompt, tuple):
+        return "".join(prompt)
+    return prompt
+
+
+def cached_tokens(usage):
+    """Prompt tokens served from the provider's prefix cache, from a usage object or dict."""
+    if usage is None:
+        return 0
+    details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+    return cached or 0
+
+
+def log_completion_usage(usage: dict):
+    """Log the output tokens and price of one completion from the usage reported with it."""
+    if usage is None:
+        return
+    price = calculate_output_price(usage["output_tokens"])
+    logging.info(f"Token count for completion: {usage['output_tokens']}, Price: ${price:.5f}")
+
+
+# Provider limits for a single batch input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 100 * 1024 * 1024
+
+
+def make_custom_id(index: int, step: str=None, design_ids: list=None):
+    """Task id carrying the step, prompt index and design ids, e.g. `1_1:12:478.479`.
+
+    Without a step the legacy `task-{index}` form is used.
+    """
+    if step is None:
+        return f"task-{index}"
+    ids = ".".join(str(design_id) for design_id in (design_ids or []))
+    return f"{step}:{index}:{ids}"
+
+
+def parse_custom_id(custom_id: str):
+    """Inverse of `make_custom_id`; returns the step, prompt index and design ids."""
+    if custom_id.startswith("task-"):
+        return {"step": None, "prompt_idx": int(custom_id[len("task-"):]), "design_ids": []}
+    step, index, ids = custom_id.split(":", 2)
+    return {
+        "step": step,
+        "prompt_idx": int(index),
+        "design_ids": [int(design_id) for design_id in ids.split(".") if design_id],
+    }
+
+
+def iter_tasks(prompts, 
+               model: str="gpt-4o", 
+               temperature: int=0,
+               cache=None,
+               step: str=None,
+               design_ids: list=None):
+    """Lazily create the batch tasks for `prompts`.
+
+    `design_ids` holds the design ids of every prompt (see `prompts.batch_design_ids`) and,
+    together with `step`, is encoded into each task's `custom_id`. With a `ResponseCache`,
+    prompts that already have a cached response are skipped; the remaining tasks keep the
+    index of their prompt.
+    """
     for index, prompt in enumerate(prompts):
-        task = {
-            "custom_id": f"task-{index}",
+        messages = build_messages(prompt)
+        if cache is not None and cache.make_key(model, temperature, messages) in cache:
+            continue
+        yield {
+            "custom_id": make_custom_id(index, step, design_ids[index] if design_ids is not None else None),
             "method": "POST",
             "url": "/v1/chat/completions",
             "body": {
                 "model": model,
                 "temperature": temperature,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
+                "messages": messages,
             }
         }
-        tasks.append(task)
+
+
+def create_tasks(prompts: list, 
+                 model: str="gpt-4o", 
+                 temperature: int=0,
+                 cache=None,
+                 step: str=None,
+                 design_ids: list=None):
+    """Create a list of tasks for processing prompts."""
+    tasks = list(iter_tasks(prompts, model, temperature, cache, step, design_ids))
+    skipped = len(prompts) - len(tasks)
+    if skipped:
+        print(f"Skipped {skipped} prompts with a cached response")
     print(f"Created {len(tasks)} tasks")
     return tasks
 
 
-def save_tasks_to_file(tasks: list, 
-                       file_path: Path):
-    """Save tasks to a JSONL file."""
-    with open(file_path, 'w') as file:
+def save_tasks_to_file(tasks, 
+                       file_path: Path,
+                       max_requests: int=None,
+                       max_bytes: int=None):
+    """Stream tasks to a JSONL file, or to numbered shards when a request or size limit is given.
+
+    Returns the paths of the written files; no file is written for an empty task stream.
+    """
+    file_path = Path(file_path)
+    sharded = max_requests is not None or max_bytes is not None
+    paths = []
+    file = None
+    n_requests = n_bytes = 0
+    try:
         for obj in tasks:
-            file.write(json.dumps(obj) + '\n')
-    print(f"Tasks saved to {file_path}")
+            line = (json.dumps(obj) + '\n').encode('utf-8')
+            shard_full = file is not None and sharded and (
+                (max_requests is not None and n_requests >= max_requests)
+                or (max_bytes is not None and n_bytes + len(line) > max_bytes))
+            if file is None or shard_full:
+                if file is not None:
+                    file.close()
+                path = file_path.with_name(f"{file_path.stem}_{len(paths):03d}{file_path.suffix}") if sharded else file_path
+                file = open(path, 'wb')
+                paths.append(path)
+                n_requests = n_bytes = 0
+            file.write(line)
+            n_requests += 1
+            n_bytes += len(line)
+    finally:
+        if file is not None:
+            file.close()
+
+    for path in paths:
+        print(f"Tasks saved to {path}")
+    return paths
 
 
 def upload_batch_file(client: OpenAI, 
@@ -69,19 +206,162 @@ def create_tasks_batch(prompts: list,
                        tmp_dir: Path, 
                        step : str,
                        model: str="gpt-4o", 
-                       temperature=0):
+                       temperature=0,
+                       cache=None,
+                       design_ids: list=None):
     if not prompts:
         raise ValueError("The prompts list is empty. Please provide valid prompts.")
 
-    tasks = create_tasks(prompts, model, temperature)
     file_name = Path(f"batchinput_{step}.jsonl")
     Path(tmp_dir).mkdir(parents=True, exist_ok=True)
-    batch_file_path = tmp_dir / file_name
-    save_tasks_to_file(tasks, batch_file_path)
+    batch_file_path = Path(tmp_dir) / file_name
+    tasks = iter_tasks(prompts, model, temperature, cache, step, design_ids)
+    if not save_tasks_to_file(tasks, batch_file_path):
+        logging.info(f"All prompts of step {step} are cached, nothing to upload.")
+        return None
     batch_file = upload_batch_file(client, batch_file_path)
     return batch_file
 
 
+def create_sharded_batch_jobs(prompts: list,
+                              client: OpenAI,
+                              tmp_dir: Path,
+                              step: str,
+                              design_ids: list=None,
+                              job_ids_file_path: Path=None,
+                              max_requests: int=BATCH_MAX_REQUESTS,
+                              max_bytes: int=BATCH_MAX_BYTES,
+                              model: str="gpt-4o",
+                              temperature=0,
+                              cache=None,
+                              completion_window: str="24h",
+                              registry=None):
+    """Write the step's tasks as shards within the file limits and submit one batch job per shard.
+
+    Job ids are appended to `job_ids_file_path` and/or added to a `BatchJobRegistry`.
+    """
+    if not prompts:
+        raise ValueError("The prompts list is empty. Please provide valid prompts.")
+
+    Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+    tasks = iter_tasks(prompts, model, temperature, cache, step, design_ids)
+    shard_paths = save_tasks_to_file(tasks, Path(tmp_dir) / f"batchinput_{step}.jsonl", max_requests, max_bytes)
+
+    batch_jobs = []
+    for shard_path in shard_paths:
+        batch_file = upload_batch_file(client, shard_path)
+        batch_job = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=completion_window,
+            metadata={"step": step, "shard": shard_path.name}
+        )
+        if job_ids_file_path is not None:
+            add_job_to_file(job_ids_file_path, batch_job.id, step)
+        if registry is not None:
+            registry.add_job(batch_job.id, step, shard=shard_path.name, input_file_id=batch_file.id)
+        batch_jobs.append(batch_job)
+
+    logging.info(f"Submitted {len(batch_jobs)} batch jobs for step {step}.")
+    return batch_jobs
+
+
+def write_batch_output(lines, output_path: Path=None):
+    """Write the newline-terminated byte `lines` to `output_path` and return it, or return them joined as bytes."""
+    if output_path is None:
+        return b"".join(lines)
+    output_path = Path(output_path)
+    with output_path.open('wb') as file:
+        file.writelines(lines)
+    return output_path
+
+
+def merge_batch_results(results: list, output_path: Path=None):
+    """Merge the output files of several shard jobs into one result, keyed by `custom_id`.
+
+    `results` are file paths or downloaded contents. They are read line by line and only
+    the position of each task's line is kept; the lines are then copied in prompt order,
+    the last one of a task seen twice winning. With an `output_path` the merged result is
+    written there without holding it in memory, and the path is returned; otherwise it is
+    returned as bytes.
+    """
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(result, 'rb') if isinstance(result, (str, os.PathLike))
+                                     else io.BytesIO(result)) for result in results]
+        positions = {}
+        for file in files:
+            offset = 0
+            for line in file:
+                start, offset = offset, offset + len(line)
+                if not line.strip():
+                    continue
+                try:
+                    custom_id = json.loads(line)['custom_id']
+                except (json.JSONDecodeError, KeyError) as e:
+                    logging.error(f"Error reading custom_id of line: {e}")
+                    continue
+                positions[custom_id] = (file, start, offset - start)
+
+        def ordered_lines():
+            for custom_id in sorted(positions, key=lambda custom_id: parse_custom_id(custom_id)["prompt_idx"]):
+                file, start, length = positions[custom_id]
+                file.seek(start)
+                yield file.read(length).rstrip(b"\r\n") + b"\n"
+
+        return write_batch_output(ordered_lines(), output_path)
+
+
+def save_batch_file(client: OpenAI, file_id: str, path: Path):
+    """Stream a file of the Files API to `path` without holding it in memory."""
+    with client.files.with_streaming_response.content(file_id) as response:
+        response.stream_to_file(path)
+    return Path(path)
+
+
+def download_batch_files(client: OpenAI, file_ids: list, output_path: Path=None):
+    """Download the given batch output or error files and merge them with `merge_batch_results`.
+
+    With an `output_path`, the files are streamed to disk and merged into that file, whose
+    path is returned; otherwise they are downloaded into memory and merged as bytes.
+    """
+    if output_path is None:
+        return merge_batch_results([client.files.content(file_id).content for file_id in file_ids])
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    part_paths = []
+    try:
+        for file_id in file_ids:
+            part_path = output_path.with_name(f"{output_path.stem}_{file_id}.part")
+            part_paths.append(save_batch_file(client, file_id, part_path))
+        return merge_batch_results(part_paths, output_path)
+    finally:
+        for part_path in part_paths:
+            part_path.unlink()
+
+
+def download_batch_results(client: OpenAI, job_ids: list, output_path: Path=None):
+    """Download and merge the output files of the given batch jobs; see `download_batch_files` for `output_path`."""
+    file_ids = []
+    for job_id in job_ids:
+        batch_job = client.batches.retrieve(job_id)
+        if batch_job.output_file_id is None:
+            logging.warning(f"Batch job {job_id} has no output file (status: {batch_job.status}).")
+            continue
+        file_ids.append(batch_job.output_file_id)
+    return download_batch_files(client, file_ids, output_path)
+
+
+def download_batch_errors(client: OpenAI, job_ids: list, output_path: Path=None):
+    """Download and merge the error files of the given batch jobs, i.e. the lines of their failed tasks."""
+    file_ids = []
+    for job_id in job_ids:
+        batch_job = client.batches.retrieve(job_id)
+        if batch_job.error_file_id is not None:
+            file_ids.append(batch_job.error_file_id)
+    return download_batch_files(client, file_ids, output_path)
+
+
 def load_newest_job_id(file_path: Path, step: str):
     if not file_path.exists():
         raise FileNotFoundError(f"The file {file_path} does not exist.")
@@ -98,8 +378,8 @@ def load_newest_job_id(file_path: Path, step: str):
         if not filtered_data:
             raise ValueError(f"No job ID found for task number {step}")
         
-        # Sort the data by timestamp in descending order
-        data_sorted = sorted(data, key=lambda x: x['timestamp'], reverse=True)
+        # Sort the step's jobs by timestamp in descending order
+        data_sorted = sorted(filtered_data, key=lambda x: x['timestamp'], reverse=True)
         
         logging.info(f"The newest job ID for task {data_sorted[0]['step']} is: {data_sorted[0]['job_id']}")
         logging.info(f"Timestamp: {data_sorted[0]['timestamp']}")
@@ -162,171 +442,438 @@ def retrieve_batch_job_status(client, job_id):
         "status": status,
         "batch_job_id": batch_job_id,
         "input_file_id": input_file_id,
+        "output_file_id": batch_job.output_file_id,
+        "error_file_id": batch_job.error_file_id,
         "completed": completed,
         "failed": failed,
-        "total": total
+        "total": total,
+        "created_at": batch_job.created_at,
+        "in_progress_at": batch_job.in_progress_at,
+        "completed_at": batch_job.completed_at,
+        "failed_at": batch_job.failed_at,
+        "expired_at": batch_job.expired_at
     }
 
 
-def parse_and_clean_batch_responses(result):
-    """Parse and clean JSON responses from a result string."""
-    results = []
-    for line in result.splitlines():
+@dataclass
+class BatchParseReport:
+    """Bookkeeping of a streamed batch output parse.
+
+    `record_ranges` maps every decoded task's `custom_id` to the (start, stop) positions of
+    its records in the emitted stream; `failures` holds one entry per line or task that
+    could not be decoded.
+    """
+    n_lines: int = 0
+    n_tasks: int = 0
+    n_records: int = 0
+    record_ranges: dict = field(default_factory=dict)
+    failures: list = field(default_factory=list)
+
+    def add_failure(self, custom_id, line_no: int, stage: str, error):
+        self.failures.append({"custom_id": custom_id, "line_no": line_no, "stage": stage, "error": str(error)})
+
+    @property
+    def failed_custom_ids(self):
+        return [failure["custom_id"] for failure in self.failures if failure["custom_id"] is not None]
+
+    def failures_frame(self):
+        return pd.DataFrame(self.failures, columns=["custom_id", "line_no", "stage", "error"])
+
+
+def iter_batch_output_lines(source):
+    """Yield the lines of a batch output given as a file path (`str` or `Path`), bytes content,
+    a file object or a streamed response (anything with `iter_lines`)."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as file:
+            yield from file
+    elif isinstance(source, bytes):
+        yield from io.BytesIO(source)
+    elif hasattr(source, 'iter_lines'):
+        yield from source.iter_lines()
+    else:
+        yield from source
+
+
+def iter_batch_records(source, 
+                       chunk_size: int=5000, 
+                       report: BatchParseReport=None, 
+                       ledger=None, 
+                       step: str=None,
+                       response_format: str="json",
+                       metrics=None):
+    """Stream the cleaned records of a batch output as DataFrames of at most `chunk_size` rows.
+
+    Lines are decoded one at a time, so memory stays bounded by the chunk size. Pass a
+    `BatchParseReport` to collect the `custom_id` mapping and the per-task failures.
+    `response_format` is the format the prompts asked for (see `decode_response`). With a
+    `PipelineMetrics`, the usage and parse time of every task are recorded for `step`.
+    """
+    if report is None:
+        report = BatchParseReport()
+    chunk = []
+    usages = []
+
+    for line_no, line in enumerate(iter_batch_output_lines(source), start=1):
+        if not line.strip():
+            continue
+        report.n_lines += 1
         try:
-            # Parsing the JSON string into a dict and appending to the list of results
-            json_object = json.loads(line.strip())
-            results.append(json_object)
+            res = json.loads(line)
         except json.JSONDecodeError as e:
-            logging.error(f"Error decoding line: {e}")
+            logging.error(f"Error decoding line {line_no}: {e}")
+            report.add_failure(None, line_no, "line", e)
             continue
 
-    logging.info(f"Parsed {len(results)} JSON objects.")
+        custom_id = res.get('custom_id')
+        report.n_tasks += 1
+        if ledger is not None:
+            usages.append(batch_usage(res))
+        if metrics is not None:
+            metrics.increment(step, "batch", "requests")
+            metrics.record_usage(step, "batch", batch_usage(res))
+            parse_start = time.perf_counter()
 
-    cleaned_responses = []
-    for res in results:
         try:
             raw_response = res['response']['body']['choices'][0]['message']['content']
-            cleaned_response = clean_json_response(raw_response)
-            # Load the cleaned JSON and append each design's data
-            cleaned_json = json.loads(cleaned_response)
-            # cleaned_responses.extend(cleaned_json)
-            for item in cleaned_json:
-                cleaned_responses.append(item)
-        except json.JSONDecodeError as e:
-            logging.error(f"Error decoding cleaned response: {e}")
+            items = decode_response(raw_response, step, response_format)
+        except (KeyError, IndexError, TypeError) as e:
+            logging.error(f"Missing response content for {custom_id}: {e}")
+            report.add_failure(custom_id, line_no, "response", res.get('error') or e)
+            if metrics is not None:
+                metrics.increment(step, "batch", "errors")
             continue
-        except KeyError as e:
-            logging.error(f"Key error: {e}")
+        except ValueError as e:
+            # LenientJSONError and CompactFormatError are ValueErrors
+            logging.error(f"Error decoding response of {custom_id}: {e}")
+            report.add_failure(custom_id, line_no, "content", e)
+            if metrics is not None:
+                metrics.increment(step, "batch", "errors")
             continue
-
-    logging.info(f"Cleaned {len(cleaned_responses)} responses.")
-    
-    df_responses = pd.DataFrame(cleaned_responses, index=None)
+        if metrics is not None:
+            metrics.observe(step, "batch", "parse_time", time.perf_counter() - parse_start)
+
+        start = report.n_records
+        chunk.extend(items)
+        report.n_records += len(items)
+        report.record_ranges[custom_id] = (start, report.n_records)
+
+        if len(chunk) >= chunk_size:
+            yield pd.DataFrame(chunk)
+            chunk = []
+        if ledger is not None and len(usages) >= chunk_size:
+            ledger.record_actuals(step, usages, api_mode="batch")
+            usages = []
+
+    if chunk:
+        yield pd.DataFrame(chunk)
+    if ledger is not None:
+        ledger.record_actuals(step, usages, api_mode="batch")
+
+
+def parse_and_clean_batch_responses(result, 
+                                    ledger=None, 
+                                    step: str=None, 
+                                    report: BatchParseReport=None,
+                                    chunk_size: int=5000,
+                                    response_format: str="json",
+                                    metrics=None):
+    """Parse and clean JSON responses from a batch result into one DataFrame.
+
+    `result` may be the downloaded content, a path to the output file or a streamed
+    response; it is parsed line by line (see `iter_batch_records`), but the records of all
+    tasks end up in memory. To keep memory flat for a large output, iterate over
+    `iter_batch_records` or write the records to the result store with
+    `store_batch_responses`. With a `TokenLedger`, the usage reported for every task is
+    recorded for `step`; with a `PipelineMetrics`, also the parse time of every task.
+    """
+    if report is None:
+        report = BatchParseReport()
+    chunks = list(iter_batch_records(result, chunk_size, report, ledger, step, response_format, metrics))
+    log_batch_parse_report(report)
+
+    if not chunks:
+        return pd.DataFrame(columns=["design_id"])
+    df_responses = pd.concat(chunks, ignore_index=True)
     df_responses["design_id"] = df_responses["design_id"].astype(int)
     logging.info("DataFrame created from cleaned responses.")
     return df_responses
 
+
+def store_batch_responses(result,
+                          json_dir: Path,
+                          json_filename: str,
+                          ledger=None,
+                          step: str=None,
+                          report: BatchParseReport=None,
+                          chunk_size: int=5000,
+                          response_format: str="json",
+                          metrics=None,
+                          template_version: str=None):
+    """Parse a batch result like `parse_and_clean_batch_responses` and append it to the result store of `json_filename`.
+
+    Every chunk of at most `chunk_size` records is committed as its own segment as soon as
+    it is parsed, so memory stays flat however large the output is. Returns the
+    `BatchParseReport`; read the records with `result_store.read_results`.
+    """
+    if report is None:
+        report = BatchParseReport()
+    store = result_store.open_store(json_dir, json_filename)
+    for chunk in iter_batch_records(result, chunk_size, report, ledger, step, response_format, metrics):
+        store.append(chunk, template_version)
+    log_batch_parse_report(report)
+    return report
+
+
+def log_batch_parse_report(report: BatchParseReport):
+    logging.info(f"Parsed {report.n_tasks} JSON objects.")
+    logging.info(f"Cleaned {report.n_records} responses.")
+    if report.failures:
+        logging.warning(f"{len(report.failures)} lines or tasks could not be decoded.")
+
+
+def batch_usage(res: dict):
+    """Token usage of one batch output line, keyed by the task's prompt index."""
+    usage = ((res.get('response') or {}).get('body') or {}).get('usage') or {}
+    return {
+        "prompt_idx": parse_custom_id(res['custom_id'])["prompt_idx"],
+        "input_tokens": usage.get('prompt_tokens', 0),
+        "output_tokens": usage.get('completion_tokens', 0),
+        "cached_tokens": cached_tokens(usage),
+    }
+
 ############
 # -------------------
 
-def get_chat_completion(prompt, client, model="gpt-4o"):
-    stream = client.chat.completions.create(
+def get_chat_completion(prompt, client, model="gpt-4o", cache=None, stats: dict=None):
+    """Stream one chat completion and return its text.
+
+    If a `stats` dict is given, it is filled with the request's `sent_at`, `first_token_at`
+    and `finished_at` times, the `client_retries` taken by the client and the reported `usage`
+    (see `metrics.PipelineMetrics.record_request`); a cached prompt sets `cached` instead.
+    """
+    messages = build_messages(prompt)
+    if cache is not None:
+        key = cache.make_key(model, 0, messages)
+        cached_response = cache.get(key)
+        if cached_response is not None:
+            if stats is not None:
+                stats["cached"] = True
+            return cached_response
+
+    sent_at = time.time()
+    raw_response = client.chat.completions.with_raw_response.create(
         model=model,
         # response_format={ 
         #     "type": "json_object"
         # },
-        messages=[
-            {
-                "role": "user", 
-                "content": prompt
-            }
-        ],
+        messages=messages,
         stream=True, 
+        stream_options={"include_usage": True},
         temperature=0  # Controls randomness, set to 0 for deterministic output
     )
+    stream = raw_response.parse()
 
     # Initialize an empty response string
     response = ""
+    first_token_at = None
+    usage = None
     # Iterate over each chunk received from the stream
     for chunk in stream:
         # Check if the chunk contains text content and append it to the response
-        if chunk.choices[0].delta.content is not None:
+        if chunk.choices and chunk.choices[0].delta.content is not None:
+            if first_token_at is None:
+                first_token_at = time.time()
             response += chunk.choices[0].delta.content
+        # With include_usage the final chunk has no choices and carries the usage
+        if chunk.usage is not None:
+            usage = {
+                "input_tokens": chunk.usage.prompt_tokens,
+                "output_tokens": chunk.usage.completion_tokens,
+                "cached_tokens": cached_tokens(chunk.usage),
+            }
 
-    return response
-
-def process_prompts(prompts, client, batch_start, batch_stop):
-    responses_list = []
-    total_output_tokens = 0
-    total_output_price = 0
+    if stats is not None:
+        stats.update(sent_at=sent_at, first_token_at=first_token_at, finished_at=time.time(),
+                     client_retries=getattr(raw_response, "retries_taken", 0), usage=usage)
+    log_completion_usage(usage)
 
-    for idx, prompt in enumerate(prompts[batch_start:batch_stop]):
-        logging.debug(f"Processing prompt {idx + batch_start}: {prompt}")
-        completion = get_chat_completion(prompt, client)
-        logging.debug(f"Received completion: {completion}")
+    if cache is not None and response.strip():
+        cache.put(key, response)
 
-        if completion.strip() == "":
-            raise ValueError("Received an empty response from the model.")
-        
-        # Calculate and log token count and price for the completion
-        completion_token_count = count_tokens_prompt(completion)
-        completion_price = calculate_output_price(completion_token_count)
-        logging.info(f"Token count for completion: {completion_token_count}, Price: ${completion_price:.5f}")
+    return response
 
-        cleaned_completion = clean_json_response(completion)
-        logging.debug(f"Cleaned completion: {cleaned_completion}")
+def process_prompts(prompts, 
+                    client, 
+                    batch_start, 
+                    batch_stop, 
+                    cache=None, 
+                    step: str=None, 
+                    response_format: str="json", 
+                    metrics=None,
+                    retry: RetryPolicy=None,
+                    source: prompt_templates.PromptBatches=None,
+                    dead_letters=None,
+                    failures: list=None,
+                    model: str="gpt-4o",
+                    ledger=None):
+    """Send the prompts `batch_start` to `batch_stop` to `model` one after another and return the decoded entries.
+
+    A failing prompt never stops the run: transient API errors are retried with backoff
+    (see `failure_isolation.RetryPolicy`), and a prompt whose response cannot be decoded is
+    split in two and resent, given the `PromptBatches` it was built from as `source`. Prompts
+    that still fail are appended to `failures` and recorded in the `DeadLetterStore`; the
+    entries of all other prompts are returned. Other errors, like a bug or a wrong API key,
+    stop the run. The client's own retries are turned off, so `retry` alone bounds the
+    requests of a prompt. With a `PipelineMetrics`, the timings and usage of every request
+    and the parse time of every completion are recorded for `step`; with a `TokenLedger`,
+    the actual usage of every request.
+    """
+    retry = retry or RetryPolicy()
+    client = client.with_options(max_retries=0)
+    results = {}
+    usages = []
+    n_failed = 0
+    enqueued_at = time.time()
+    pending = [PromptTask(idx, prompt) for idx, prompt in enumerate(prompts[batch_start:batch_stop], start=batch_start)]
+    pending.reverse()
+
+    while pending:
+        task = pending.pop()
+        last = {}
+
+        def attempt():
+            stats = {"enqueued_at": enqueued_at}
+            last["completion"] = completion = get_chat_completion(task.prompt, client, model, cache, stats)
+            if stats.get("cached"):
+                logging.debug(f"Prompt {task.label} answered from cache")
+                if metrics is not None:
+                    metrics.increment(step, "chat", "cache_hits")
+            else:
+                logging.debug(f"Prompt {task.label}: {len(completion)} characters in "
+                              f"{stats['finished_at'] - stats['sent_at']:.2f}s")
+                if metrics is not None:
+                    metrics.record_request(step, stats)
+                if stats["usage"] is not None:
+                    usages.append(dict(stats["usage"], prompt_idx=task.prompt_idx, started_at=stats["sent_at"],
+                                       finished_at=stats["finished_at"]))
+
+            parse_start = time.perf_counter()
+            try:
+                return parse_completion(completion, step, response_format)
+            except DECODE_ERRORS:
+                if cache is not None:
+                    cache.discard(cache.make_key(model, 0, build_messages(task.prompt)))
+                raise
+            finally:
+                if metrics is not None:
+                    metrics.observe(step, "chat", "parse_time", time.perf_counter() - parse_start)
+
+        records, error, attempts = run_with_retry(attempt, retry, can_split(task, source), task.label)
+        if metrics is not None and attempts > 1:
+            metrics.increment(step, "chat", "task_retries", attempts - 1)
+        if error is None:
+            results[task.key] = records
+            continue
+        if metrics is not None:
+            metrics.increment(step, "chat", "errors")
+        halves = isolate_failure(task, error, attempts, step, source, dead_letters, failures, last.get("completion"))
+        n_failed += not halves
+        # The halves are sent next, so the prompts stay in order
+        pending.extend(reversed(halves))
+
+    if ledger is not None:
+        ledger.record_actuals(step, usages, api_mode="chat")
+    if n_failed:
+        logging.warning(f"{n_failed} prompts of step {step} failed; returning the results of the others.")
+    return [record for key in sorted(results) for record in results[key]]
+
+
+def decode_response(text: str, step: str=None, response_format: str="json"):
+    """Decode one model response into a list of entries.
+
+    `response_format` "json" decodes leniently with `lenient_json.loads`; "compact" reads
+    the tabular format of `step` (see `modules.compact_format`) into the same keys.
+    """
+    if response_format == "json":
+        return lenient_json.loads(text)
+    if response_format == "compact":
+        return compact_format.loads(text, step)
+    raise ValueError(f"Unknown response format: {response_format}")
+
+
+def parse_completion(completion: str, step: str=None, response_format: str="json"):
+    """Validate and leniently decode one chat completion into a list of entries."""
+    if completion.strip() == "":
+        raise lenient_json.LenientJSONError("Received an empty response from the model.")
 
-        try:
-            entries = json.loads(cleaned_completion)
-            for entry in entries:
-                responses_list.append(entry)
-        except json.JSONDecodeError as e:
-            logging.error("Final JSON format error:", e)
-            logging.debug("Debug - Final cleaned response:\n%s", cleaned_completion)
-            raise e
+    try:
+        return decode_response(completion, step, response_format)
+    except (lenient_json.LenientJSONError, compact_format.CompactFormatError) as e:
+        logging.error("Final response format error: %s", e)
+        logging.debug("Debug - Final response:\n%s", completion[:200])
+        raise e
+
+
+def filter_completed(source_df: pd.DataFrame,
+                     json_dir: Path,
+                     json_filename: str,
+                     keys: tuple=("design_id",),
+                     source_keys: tuple=None,
+                     required: tuple=()):
+    """Drop the rows of `source_df` whose keys already have results in `json_filename`.
+
+    Generic resume filter for any step: `keys` are the key columns of the results,
+    `source_keys` the matching columns of `source_df` if they are named differently, and
+    results with a null value in one of the `required` columns do not count as done.
+    The completed keys come from the index of the result store and are refreshed with
+    each new segment, so the anti-join does not re-read earlier results.
+    """
+    json_filepath = Path(json_dir) / json_filename
+    if not result_store.results_exist(json_dir, json_filename):
+        print(f"JSON file {json_filepath} does not exist.")
+        return source_df
 
-    return responses_list
+    completed = result_store.completed_keys(json_dir, json_filename, keys, required)
+    return completed.filter(source_df, source_keys)
 
 
 def filter_source_dataframe(source_df: pd.DataFrame, 
                             json_dir: Path, 
                             json_filename:str ="enhanced_designs.json"):
-    json_filepath = Path(json_dir) / json_filename
-    if not json_filepath.exists():
-        Path(json_dir).mkdir(parents=True, exist_ok=True)
-        print(f"JSON file {json_filepath} does not exist.")
-        return source_df 
-
-    target_df = pd.read_json(json_filepath)
-    design_ids = set(target_df['design_id'])
-    filtered_source_df = source_df[~source_df['id'].isin(design_ids)].copy()
-
-    return filtered_source_df
+    Path(json_dir).mkdir(parents=True, exist_ok=True)
+    return filter_completed(source_df, json_dir, json_filename, source_keys=("id",))
 
 
 def filter_enhanced_designs(source_df: pd.DataFrame, 
                             json_dir: Path, 
                             json_filename: str="subject_object_pairs.json"):
-    json_filepath = Path(json_dir) / json_filename
-    if not json_filepath.exists():
-        print(f"JSON file {json_filepath} does not exist.")
-        return source_df 
-
-    target_df = pd.read_json(json_filepath)
-    design_ids = set(target_df['design_id'])
-    filtered_source_df = source_df[~source_df['design_id'].isin(design_ids)].copy()
-
-    return filtered_source_df
-
+    return filter_completed(source_df, json_dir, json_filename)
 
 
 def filter_sop_dataframe(source_df, json_dir, json_filename="subject_object_pairs_with_predicates.json"):
-    json_filepath = Path(json_dir) / json_filename
-    if not json_filepath.exists():
-        print(f"JSON file {json_filepath} does not exist.")
-        return source_df 
-
-    target_df = pd.read_json(json_filepath)
-    target_df_not_nan = target_df[~target_df['predicate'].isna()]
-    pairs_to_drop = set(zip(target_df_not_nan['design_id'], target_df_not_nan['s_o_id']))
-    filtered_source_df = source_df[~source_df.apply(lambda row: (row['design_id'], row['s_o_id']) in pairs_to_drop, axis=1)]
-    
-    return filtered_source_df
+    return filter_completed(source_df, json_dir, json_filename, keys=("design_id", "s_o_id"), required=("predicate",))
 
 
 def update_json_with_merged_df(merged_df: pd.DataFrame, 
                                columns: list, 
                                json_dir: Path, 
-                               json_filename: str):
-    json_filepath = Path(json_dir) / json_filename
-    if json_filepath.exists():
-        existing_df = pd.read_json(json_filepath)
-    else:
-        existing_df = pd.DataFrame(columns=columns)
-        
-    merged_df = pd.concat([existing_df, merged_df], ignore_index=True)
-
-    merged_df.to_json(json_filepath, orient='records', indent=4)
+                               json_filename: str,
+                               template_version: str=None,
+                               export_json: bool=True):
+    """Append new results to the result store of `json_filename` as one committed segment.
+
+    Earlier results are not read or rewritten in the store. With `export_json`, all results
+    are then written to `json_dir / json_filename` in the old single-file layout, so readers
+    of that file stay in sync; turn it off to skip the rewrite and read the results with
+    `result_store.read_results(json_dir, json_filename)` instead. `columns` is kept for
+    existing callers and not used: the records keep the columns of `merged_df`.
+    `template_version` is stored with the segment as the provenance of the results.
+    """
+    Path(json_dir).mkdir(parents=True, exist_ok=True)
+    store = result_store.open_store(json_dir, json_filename)
+    store.append(merged_df, template_version)
+    if export_json:
+        store.export_json(Path(json_dir) / json_filename)
 
 
 # def clean_json_response(response):
@@ -353,6 +900,7 @@ def update_json_with_merged_df(merged_df: pd.DataFrame,
 
 
 def clean_json_response(response):
+    """Regex-based cleaner, superseded by `lenient_json.loads` and kept for comparison."""
     # Initial cleaning to remove extraneous characters or code block delimiters
     cleaned_response = response.strip().strip("```").strip("json").strip()
     cleaned_response = re.sub(r"#.*", "", cleaned_response)
@@ -386,51 +934,101 @@ def clean_json_response(response):
     return cleaned_response
 
 
+def count_prompt_tokens(prompts: list, model: str="gpt-4o", step: str=None, response_format: str="json"):
+    """Input tokens of every prompt, tokenizing only the design rows of prompts built from a template.
+
+    The fixed text of a step's template is counted once (see `prompts.PromptTemplate`); without
+    a `step`, the template is recognised from the first prompt. Prompts that do not match the
+    template are tokenized in full.
+    """
+    prompts = list(prompts)
+    if not prompts:
+        return []
+    if step is not None:
+        template = prompt_templates.get_template(step, response_format)
+    else:
+        template = prompt_templates.match_template(prompts[0])
+    rows = [template.rows_text(prompt) if template is not None else None for prompt in prompts]
+    matched = [idx for idx, text in enumerate(rows) if text is not None]
+    unmatched = [idx for idx, text in enumerate(rows) if text is None]
+
+    token_counts = [0] * len(prompts)
+    for idx, count in zip(matched, count_tokens_batch([rows[idx] for idx in matched], model)):
+        token_counts[idx] = count + template.static_token_count(model, isinstance(prompts[idx], tuple))
+    for idx, count in zip(unmatched, count_tokens_batch([prompt_text(prompts[idx]) for idx in unmatched], model)):
+        token_counts[idx] = count
+    return token_counts
+
+
 def calculate_total_tokens_and_price(prompts: list, 
                                      batch_start: int, 
                                      batch_stop: int, 
-                                     batch: bool=False):
-    total_tokens = 0
-    
-    for idx, prompt in enumerate(prompts):
-        if idx >= (batch_stop - batch_start):
-            continue
-        token_count = count_tokens_prompt(prompt)
-        total_tokens += token_count
-        price = calculate_input_price(token_count)
-        if batch:
-            price *= 0.5
-        print(f"Token count for prompt {idx}: {token_count}, Price: ${price:.5f}")
-
-    total_price = calculate_input_price(total_tokens)
-    if batch:
-        total_price *= 0.5
-    print(f"Total token count: {total_tokens}")
-    print(f"Total input price: ${total_price:.5f}")
-    
+                                     batch: bool=False,
+                                     ledger=None,
+                                     step: str=None,
+                                     model: str="gpt-4o",
+                                     response_format: str="json"):
+    """Estimate the input tokens and price of prompts[batch_start:batch_stop].
+
+    The per-prompt counts are logged at DEBUG level and, when a `TokenLedger` is given,
+    recorded as the estimate for `step`.
+    """
+    selected = prompts[batch_start:batch_stop]
+    token_counts = count_prompt_tokens(selected, model, step, response_format)
+    api_mode = "batch" if batch else "chat"
+
+    for idx, token_count in enumerate(token_counts, start=batch_start):
+        logging.debug(f"Token count for prompt {idx}: {token_count}, "
+                      f"Price: ${calculate_input_price(token_count, api_mode):.5f}")
+
+    total_tokens = sum(token_counts)
+    total_price = calculate_input_price(total_tokens, api_mode)
+    logging.info(f"Total token count: {total_tokens}")
+    logging.info(f"Total input price: ${total_price:.5f}")
+
+    if ledger is not None:
+        ledger.record_estimate(step, token_counts, api_mode, prompt_offset=batch_start)
+
     return total_tokens, total_price
 
 
+def count_tokens_batch(texts: list, model: str="gpt-4o", num_threads: int=8):
+    """Count the tokens of many texts at once with tiktoken's multi-threaded encoder."""
+    encoding = get_encoding(model)
+    return [len(tokens) for tokens in encoding.encode_batch(list(texts), num_threads=num_threads)]
+
+
 def count_tokens_prompt(prompt, model="gpt-4o"):
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     tokens = encoding.encode(prompt)
     return len(tokens)
 
 
 def count_tokens_dict(data_dict, model="gpt-4o"):
     json_str = json.dumps(data_dict)
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     tokens = encoding.encode(json_str)
 
     return len(tokens)
 
 
-def calculate_input_price(token_count):
-    return token_count / 1000000 * 5
+# Batch API requests are billed at half the chat price
+API_MODE_PRICE_FACTOR = {
+    "chat": 1.0,
+    "batch": 0.5,
+}
+
+# Input tokens read from the provider's prompt cache are billed at half the input price
+CACHED_INPUT_PRICE_FACTOR = 0.5
+
+
+def calculate_input_price(token_count, api_mode: str="chat", cached_token_count: int=0):
+    uncached = token_count - cached_token_count
+    return (uncached + cached_token_count * CACHED_INPUT_PRICE_FACTOR) / 1000000 * 5 * API_MODE_PRICE_FACTOR[api_mode]
 
 
-def calculate_output_price(token_count):
-    return token_count / 1000000 * 15
+def calculate_output_price(token_count, api_mode: str="chat"):
+    return token_count / 1000000 * 15 * API_MODE_PRICE_FACTOR[api_mode]
 
 
 def generate_list_of_strings(row):
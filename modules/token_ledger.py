@@ -0,0 +1,153 @@
+import time
+import uuid
+import sqlite3
+import logging
+import pandas as pd
+
+from pathlib import Path
+from contextlib import closing
+
+from modules.scripts import calculate_input_price, calculate_output_price
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    label TEXT,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    step TEXT,
+    prompt_idx INTEGER,
+    api_mode TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    price REAL NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_usage_run_step ON usage (run_id, step, kind);
+"""
+
+
+class TokenLedger():
+    """Persistent record of estimated and actual token usage per run, step, prompt and API mode.
+
+    Estimates are written by `scripts.calculate_total_tokens_and_price`, actual usage by the
+    chat executor and the batch response parser. Everything lands in one SQLite file, so the
+    spend and throughput of earlier runs stay available through `summary`.
+    """
+
+    def __init__(self, db_path: Path=Path("./data/results/tmp/token_ledger.sqlite"), label: str=None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+        self.run_id = self.start_run(label)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def start_run(self, label: str=None):
+        """Open a new run; subsequent records are attributed to it."""
+        run_id = uuid.uuid4().hex[:12]
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT INTO runs (run_id, label, started_at) VALUES (?, ?, ?)",
+                         (run_id, label, time.time()))
+        self.run_id = run_id
+        logging.info(f"Token ledger run {run_id} started ({self.db_path}).")
+        return run_id
+
+    def record_estimate(self, step: str, token_counts: list, api_mode: str="chat", prompt_offset: int=0):
+        """Record the estimated input tokens of each prompt of a step."""
+        rows = [
+            (self.run_id, step, idx, api_mode, "estimated", count, 0, 0,
+             calculate_input_price(count, api_mode), None, None)
+            for idx, count in enumerate(token_counts, start=prompt_offset)
+        ]
+        self._insert(rows)
+
+    def record_actual(self,
+                      step: str,
+                      prompt_idx: int,
+                      input_tokens: int,
+                      output_tokens: int,
+                      api_mode: str="chat",
+                      started_at: float=None,
+                      finished_at: float=None,
+                      cached_tokens: int=0):
+        """Record the usage reported by the API for one prompt.
+
+        `cached_tokens` are the input tokens served from the provider's prompt cache.
+        """
+        price = (calculate_input_price(input_tokens, api_mode, cached_tokens)
+                 + calculate_output_price(output_tokens, api_mode))
+        self._insert([(self.run_id, step, prompt_idx, api_mode, "actual", input_tokens, output_tokens,
+                       cached_tokens, price, started_at, finished_at)])
+
+    def record_actuals(self, step: str, usages: list, api_mode: str="chat"):
+        """Record many actual usages at once, given as dicts with the `record_actual` arguments."""
+        rows = []
+        for usage in usages:
+            input_tokens = usage.get("input_tokens", 0)
+            output_tokens = usage.get("output_tokens", 0)
+            cached_tokens = usage.get("cached_tokens", 0)
+            price = (calculate_input_price(input_tokens, api_mode, cached_tokens)
+                     + calculate_output_price(output_tokens, api_mode))
+            rows.append((self.run_id, step, usage.get("prompt_idx"), api_mode, "actual",
+                         input_tokens, output_tokens, cached_tokens, price,
+                         usage.get("started_at"), usage.get("finished_at")))
+        self._insert(rows)
+
+    def _insert(self, rows: list):
+        if not rows:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO usage (run_id, step, prompt_idx, api_mode, kind, input_tokens, output_tokens, "
+                "cached_tokens, price, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def usage(self, run_id: str=None):
+        """Return the raw usage records, optionally restricted to one run."""
+        query = "SELECT * FROM usage"
+        params = ()
+        if run_id is not None:
+            query += " WHERE run_id = ?"
+            params = (run_id,)
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+    def summary(self, run_id: str=None):
+        """Estimated vs actual tokens, spend, prompt cache hits and throughput per run, step and API mode."""
+        df_usage = self.usage(run_id)
+        keys = ["run_id", "step", "api_mode"]
+        if df_usage.empty:
+            return pd.DataFrame(columns=keys)
+
+        estimated = df_usage[df_usage["kind"] == "estimated"].groupby(keys, dropna=False).agg(
+            est_prompts=("prompt_idx", "count"),
+            est_input_tokens=("input_tokens", "sum"),
+            est_price=("price", "sum"),
+        )
+        actual = df_usage[df_usage["kind"] == "actual"].groupby(keys, dropna=False).agg(
+            prompts=("prompt_idx", "count"),
+            input_tokens=("input_tokens", "sum"),
+            output_tokens=("output_tokens", "sum"),
+            cached_tokens=("cached_tokens", "sum"),
+            price=("price", "sum"),
+            first_started=("started_at", "min"),
+            last_finished=("finished_at", "max"),
+        )
+        df_summary = estimated.join(actual, how="outer").reset_index()
+
+        df_summary["cache_hit_rate"] = df_summary["cached_tokens"] / df_summary["input_tokens"].where(
+            df_summary["input_tokens"] > 0)
+        wall_time = df_summary["last_finished"] - df_summary["first_started"]
+        df_summary["wall_time_s"] = wall_time
+        df_summary["output_tokens_per_s"] = df_summary["output_tokens"] / wall_time.where(wall_time > 0)
+        df_summary["prompts_per_min"] = df_summary["prompts"] / (wall_time.where(wall_time > 0) / 60)
+        return df_summary.drop(columns=["first_started", "last_finished"])